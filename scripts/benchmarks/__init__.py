@@ -0,0 +1,8 @@
+# benchmarks of the sample generation pipeline that run without blender
+#
+# fake_blender.py stands in for the blender executable, micro.py times the file utilities and the parameter sampling,
+# end_to_end.py times whole sample_generation.py runs. Both write their results as json, compare.py compares two
+# result files. Run them from the scripts directory:
+#
+#   python3 -m benchmarks.micro -o base.json
+#   python3 -m benchmarks.compare base.json new.json
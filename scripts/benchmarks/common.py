@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# timing, result files and synthetic samples shared by the benchmarks
+
+import os
+import sys
+import json
+import random
+import platform
+import subprocess
+import numpy as np
+from time import time
+
+__author__ = "Andrin Jenal"
+__copyright__ = "Copyright 2016, ETH Zurich"
+__license__ = "GPL"
+
+SCRIPTS_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if SCRIPTS_PATH not in sys.path:
+    sys.path.insert(0, SCRIPTS_PATH)
+
+import skeleton_graph
+import worker_stub
+
+BRANCHES = 12  # branches of a synthetic tree
+
+
+# Results
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=SCRIPTS_PATH, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'commit': commit,
+    }
+
+
+def measure(name, run, items, repeats=3, setup=None, **parameters):
+    """
+    Time run(state) repeats times, state = setup() is prepared before every repeat and not timed.
+    items is the number of samples, images or trees a single run processes.
+    """
+    seconds = []
+    for _ in range(repeats):
+        state = setup() if setup is not None else None
+        start_time = time()
+        run(state)
+        seconds.append(time() - start_time)
+
+    best = min(seconds)
+    result = {
+        'name': name,
+        'parameters': parameters,
+        'items': items,
+        'seconds': seconds,
+        'best': best,
+        'median': float(np.median(seconds)),
+        'items_per_second': items / max(best, 1e-9),
+    }
+    print('%-28s %10.4f s best %10.4f s median %12.1f items/s  %s' %
+          (name, best, result['median'], result['items_per_second'], parameters), flush=True)
+    return result
+
+
+def write_results(path, results):
+    with open(path, 'w') as _file:
+        json.dump({'environment': environment(), 'results': results}, _file, indent=1)
+    print('results written to:', path)
+
+
+def read_results(path):
+    with open(path) as _file:
+        return json.load(_file)
+
+
+# Synthetic samples
+def synthetic_silhouette(image_size, seed, angle=0):
+    """
+    Black tree on white: a trunk and a few straight branches, different for every seed and view angle.
+    """
+    rng = np.random.RandomState((seed * 360 + angle) % (2 ** 32))
+    image = np.full((image_size, image_size), 255, dtype=np.uint8)
+    center = image_size // 2
+    width = max(1, image_size // 32)
+    image[image_size // 4:, center - width:center + width + 1] = 0
+
+    t = np.linspace(0, 1, image_size)
+    for _ in range(BRANCHES):
+        y0 = rng.randint(image_size // 4, image_size * 3 // 4)
+        direction = rng.uniform(-np.pi, 0)
+        length = rng.uniform(0.1, 0.4) * image_size
+        xs = np.clip(center + t * length * np.cos(direction), 0, image_size - 1).astype(np.int64)
+        ys = np.clip(y0 + t * length * np.sin(direction), 0, image_size - 1).astype(np.int64)
+        image[ys, xs] = 0
+    return image
+
+
+def synthetic_png(image_size, seed, angle=0):
+    return worker_stub.png_rows_bytes([row.tobytes() for row in synthetic_silhouette(image_size, seed, angle)])
+
+
+def synthetic_obj(seed):
+    return 'o tree_%d\nv 0 0 0\nv 0 0 1\nl 1 2\n' % seed
+
+
+def synthetic_graph(seed):
+    # a trunk of seed dependent length as a chain of nodes
+    nodes = 3 + seed % 5
+    neighbours = [[n for n in (i - 1, i + 1) if 0 <= n < nodes] for i in range(nodes)]
+    return {
+        skeleton_graph.POSITIONS: np.array([[0.0, 0.0, float(z)] for z in range(nodes)], dtype=np.float32),
+        skeleton_graph.RADII: np.linspace(1.0, 0.1, nodes).astype(np.float32),
+        skeleton_graph.LEVELS: np.zeros(nodes, dtype=np.int8),
+        skeleton_graph.INDPTR: np.cumsum([0] + [len(n) for n in neighbours]).astype(np.int64),
+        skeleton_graph.INDICES: np.array([n for ns in neighbours for n in ns], dtype=np.int64),
+    }
+
+
+def write_samples(prefix, samples, image_size, export=False):
+    """
+    Write the files of (seed, angles) samples named like TreeGenerator does: <prefix>_<seed>_<angle>.png, or
+    <prefix>_<seed>.obj if export is set. Returns the written paths.
+    """
+    files = []
+    for seed, angles in samples:
+        if export:
+            files.append(prefix + '_' + str(seed) + '.obj')
+            with open(files[-1], 'w') as f:
+                f.write(synthetic_obj(seed))
+            continue
+        for angle in angles:
+            files.append(prefix + '_' + str(seed) + '_' + str(angle) + '.png')
+            with open(files[-1], 'wb') as f:
+                f.write(synthetic_png(image_size, seed, angle))
+    return files
+
+
+def random_samples(start_seed, number_samples, views):
+    # distinct view angles per seed, reproducible
+    return [(s, random.Random(s).sample(range(0, 360), views)) for s in range(start_seed, start_seed + number_samples)]
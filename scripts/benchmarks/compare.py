@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# compare two benchmark result files, e.g. before and after a change
+#
+#   python3 -m benchmarks.compare base.json new.json
+
+import argparse
+
+from benchmarks import common
+
+__author__ = "Andrin Jenal"
+__copyright__ = "Copyright 2016, ETH Zurich"
+__license__ = "GPL"
+
+
+def compare(base, new):
+    """
+    (name, base items/s, new items/s, speedup) of every benchmark in both result files.
+    """
+    base_results = dict((r['name'], r) for r in base['results'])
+    rows = []
+    for result in new['results']:
+        if result['name'] in base_results:
+            before = base_results[result['name']]['items_per_second']
+            rows.append((result['name'], before, result['items_per_second'], result['items_per_second'] / max(before, 1e-9)))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='compare two benchmark result files')
+    parser.add_argument('base', help='results of the baseline')
+    parser.add_argument('new', help='results to compare against the baseline')
+    args = parser.parse_args()
+
+    base, new = common.read_results(args.base), common.read_results(args.new)
+    print('base: %s, new: %s' % (base['environment'].get('commit'), new['environment'].get('commit')))
+    print('%-28s %14s %14s %9s' % ('benchmark', 'base items/s', 'new items/s', 'speedup'))
+    for name, before, after, speedup in compare(base, new):
+        print('%-28s %14.1f %14.1f %8.2fx' % (name, before, after, speedup))
+
+if __name__ == '__main__':
+    main()
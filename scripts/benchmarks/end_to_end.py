@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# samples per second of whole sample_generation.py runs with the blender stand-in
+#
+#   python3 -m benchmarks.end_to_end -n 200 -W 4 --latency 0.05 --startup 1.0 -o e2e.json
+#
+# Every variant runs sample_generation.py in a fresh output directory with -B fake_blender.py and --metrics, the
+# result holds the wall time and the metrics file of the run (see metrics.py).
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from benchmarks import common
+from benchmarks import fake_blender
+
+import metrics
+
+__author__ = "Andrin Jenal"
+__copyright__ = "Copyright 2016, ETH Zurich"
+__license__ = "GPL"
+
+FAKE_BLENDER = os.path.join(common.SCRIPTS_PATH, 'benchmarks', 'fake_blender.py')
+FILE_NAME = 'benchmark'
+
+# sample_generation.py arguments of every variant
+VARIANTS = {
+    'zip': [],
+    'hdf5': ['-H'],
+    'zip-persistent': ['-P'],
+    'hdf5-persistent': ['-H', '-P'],
+    'hdf5-stream': ['-H', '--pixel-stream'],
+}
+
+
+def sample_generation_command(output_path, number_samples, models_path, workers, variant_args, extra_args):
+    return ([sys.executable, 'sample_generation.py', output_path, str(number_samples), models_path,
+             '-B', FAKE_BLENDER, '-W', str(workers), '-F', FILE_NAME, '--metrics'] + variant_args + extra_args)
+
+
+def run_variant(root, name, args):
+    output_path = os.path.join(root, name)
+    command = sample_generation_command(output_path, args.number_samples, args.models_path, args.workers, VARIANTS[name], args.extra)
+    models = len(os.listdir(args.models_path)) if os.path.isdir(args.models_path) else 1
+    env = dict(os.environ)
+    env[fake_blender.STARTUP_VARIABLE] = str(args.startup)
+    env[fake_blender.LATENCY_VARIABLE] = str(args.latency)
+
+    def setup():
+        shutil.rmtree(output_path, ignore_errors=True)
+
+    def run(_):
+        subprocess.check_call(command, cwd=common.SCRIPTS_PATH, env=env, stdout=subprocess.DEVNULL)
+
+    result = common.measure('end_to_end_' + name, run, args.number_samples * models, args.repeats, setup,
+                            workers=args.workers, startup=args.startup, latency=args.latency, extra=args.extra)
+    result['metrics'] = common.read_results(os.path.join(output_path, FILE_NAME + metrics.METRICS_EXTENSION))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='end to end samples per second of sample_generation.py without blender')
+    parser.add_argument('-n', '--number-samples', type=int, default=100, help='samples per tree model')
+    parser.add_argument('-m', '--models-path', default=os.path.join(common.SCRIPTS_PATH, 'presets'), help='tree model or directory of tree models')
+    parser.add_argument('-W', '--workers', type=int, default=2, help='blender jobs that run at once')
+    parser.add_argument('-r', '--repeats', type=int, default=1, help='runs per variant, the best one counts')
+    parser.add_argument('--startup', type=float, default=0.0, help='seconds the stand-in spends starting up')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the stand-in spends per sample')
+    parser.add_argument('--variants', nargs='+', choices=sorted(VARIANTS), default=['zip', 'hdf5'], help='storage and worker variants to run')
+    parser.add_argument('--extra', nargs=argparse.REMAINDER, default=[], help='further sample_generation.py arguments of every run')
+    parser.add_argument('-o', '--output', help='write the results as json')
+    args = parser.parse_args()
+    args.models_path = os.path.abspath(args.models_path)
+
+    root = tempfile.mkdtemp(prefix='treenet_benchmark_')
+    try:
+        results = [run_variant(root, name, args) for name in args.variants]
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    if args.output:
+        common.write_results(args.output, results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# stand-in for the blender executable running sapling_tree_generator.py, for benchmarks without blender
+#
+#   python3 sample_generation.py samples/ 100 presets/ -B benchmarks/fake_blender.py [-P]
+#
+# Takes blender's command line (--background --python <script> -- <script arguments>), parses the script arguments
+# like sapling_tree_generator.main and writes synthetic silhouettes (.png) or models (.obj) with the same names as
+# TreeGenerator, plus chain graphs with --graph, also as persistent worker (--worker), from sample plans and over a
+# pixel stream (--pixel-fd). Latencies are set in the environment:
+# FAKE_BLENDER_STARTUP seconds once per process (blender start up and add-on registration) and FAKE_BLENDER_LATENCY
+# seconds per sample (building and rendering the tree). FAKE_BLENDER_HANG_SEEDS and FAKE_BLENDER_CRASH_SEEDS, comma
+# separated seeds, make the stand-in hang or exit with an error at these seeds, e.g. to try --timeout and --retries.
+
+import os
+import sys
+import argparse
+from time import sleep
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks import common
+
+import utils
+import pixel_stream
+import sample_plan
+import skeleton_graph
+import worker_protocol
+
+__author__ = "Andrin Jenal"
+__copyright__ = "Copyright 2016, ETH Zurich"
+__license__ = "GPL"
+
+STARTUP_VARIABLE = 'FAKE_BLENDER_STARTUP'
+LATENCY_VARIABLE = 'FAKE_BLENDER_LATENCY'
+HANG_VARIABLE = 'FAKE_BLENDER_HANG_SEEDS'
+CRASH_VARIABLE = 'FAKE_BLENDER_CRASH_SEEDS'
+
+
+def latency(variable):
+    return float(os.environ.get(variable, 0.0))
+
+
+def seeds(variable):
+    return set(int(s) for s in os.environ.get(variable, '').split(',') if s.strip())
+
+
+def plan_samples(plan_path, start_row, stop_row):
+    plan = sample_plan.read_plan(plan_path)
+    return [(int(plan['seed'][r]), [int(a) for a in plan['angles'][r]]) for r in range(start_row, stop_row)]
+
+
+def render(prefix, samples, image_size, export, pixel_writer=None, graph=False):
+    directory = os.path.dirname(prefix)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    sample_latency = latency(LATENCY_VARIABLE)
+    hang_seeds, crash_seeds = seeds(HANG_VARIABLE), seeds(CRASH_VARIABLE)
+    for seed, angles in samples:
+        sleep(sample_latency)
+        while seed in hang_seeds:
+            sleep(60)
+        if seed in crash_seeds:
+            sys.stderr.write('Error: degenerate tree at seed %d\n' % seed)
+            sys.exit(1)
+        if graph:
+            skeleton_graph.save_graph(prefix + '_' + str(seed) + skeleton_graph.GRAPH_EXTENSION, common.synthetic_graph(seed))
+        if pixel_writer is None:
+            common.write_samples(prefix, [(seed, angles)], image_size, export)
+            continue
+        for angle in angles:
+            name = '%s_%d_%d.png' % (os.path.basename(prefix), seed, angle)
+            pixel_writer.write(name, common.synthetic_silhouette(image_size, seed, angle))
+    return len(samples)
+
+
+def handle_job(job):
+    # a worker job of worker_protocol.job_message
+    prefix = os.path.join(job['render_path'], utils.get_filename(job['model']))
+    if job.get('plan'):
+        start_row, stop_row = job['plan_rows']
+        samples = plan_samples(job['plan'], start_row, stop_row)
+    else:
+        samples = common.random_samples(job['start_seed'], job['number_samples'], job['views'])
+    return render(prefix, samples, job['image_size'], job['export'], graph=job.get('graph', False))
+
+
+def script_arguments(argv):
+    # blender ignores everything after "--", the script gets it
+    if '--' not in argv:
+        return []
+    return argv[argv.index('--') + 1:]
+
+
+def main():
+    # same arguments as sapling_tree_generator.main
+    parser = argparse.ArgumentParser(description='stand-in for blender running sapling_tree_generator.py')
+    parser.add_argument('render_path', nargs='?')
+    parser.add_argument('model', nargs='?')
+    parser.add_argument('--total-samples', default=1000, type=int)
+    parser.add_argument('-n', '--number-samples', type=int, default=1)
+    parser.add_argument('-f', '--filename')
+    parser.add_argument('-o', '--override', action='store_true')
+    parser.add_argument('-size', '--image-size', type=int, default=64)
+    parser.add_argument('-seed', '--start-seed', type=int, default=0)
+    parser.add_argument('-views', '--number-views', type=int, default=1)
+    parser.add_argument('-S', '--render-silhouette', action='store_true')
+    parser.add_argument('-R', '--random', action='store_true')
+    parser.add_argument('-E', '--export', action='store_true')
+    parser.add_argument('-G', '--geometry', action='store_true')
+    parser.add_argument('--graph', action='store_true')
+    parser.add_argument('--multi-view', action='store_true')
+    parser.add_argument('--reuse-scene', action='store_true')
+    parser.add_argument('--worker', action='store_true')
+    parser.add_argument('--plan')
+    parser.add_argument('--plan-rows')
+    parser.add_argument('--cache')
+    parser.add_argument('--cache-size', type=int)
+    parser.add_argument(pixel_stream.PIXEL_FD_OPTION, type=int)
+
+    args = parser.parse_args(script_arguments(sys.argv))
+    sleep(latency(STARTUP_VARIABLE))
+
+    if args.geometry:
+        parser.error('geometry exports are not simulated')
+
+    if args.worker:
+        worker_protocol.serve(handle_job)
+        return
+
+    if args.render_path is None or args.model is None:
+        parser.error('the following arguments are required: render_path, model')
+
+    filename = utils.get_filename(args.model)
+    if args.filename:
+        filename = args.filename + '_' + filename
+
+    if args.plan:
+        if not args.plan_rows:
+            parser.error('--plan requires --plan-rows start:stop')
+        start_row, stop_row = [int(r) for r in args.plan_rows.split(':')]
+        samples = plan_samples(args.plan, start_row, stop_row)
+    else:
+        samples = common.random_samples(args.start_seed, args.number_samples, args.number_views)
+    pixel_writer = pixel_stream.PixelWriter(args.pixel_fd) if args.pixel_fd is not None else None
+    try:
+        render(os.path.join(args.render_path, filename), samples, args.image_size, args.export, pixel_writer, args.graph)
+    finally:
+        if pixel_writer is not None:
+            pixel_writer.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# microbenchmarks of the parameter sampling and the file utilities
+#
+#   python3 -m benchmarks.micro -n 2000 -S 64 -o micro.json
+#
+# Every benchmark runs on synthetic samples in a temporary directory, see common.synthetic_silhouette.
+
+import os
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+from benchmarks import common
+
+import file_utils
+import sample_plan
+import utils
+from treeconfigs import TreeConfig
+
+__author__ = "Andrin Jenal"
+__copyright__ = "Copyright 2016, ETH Zurich"
+__license__ = "GPL"
+
+DEFAULT_MODEL = os.path.join(common.SCRIPTS_PATH, 'presets', 'pine_template.py')
+PREVIEW_BATCH_SIZE = 64
+VARIATION = 0.1  # parameters vary by +-10% around the preset value
+
+
+# Tree model parameters
+def preset_config(model):
+    """
+    TreeConfig that varies every numeric parameter of a preset, list parameters element wise.
+    """
+    tree_config = TreeConfig()
+    for name, value in sorted(utils.read_tree_model(model).items()):
+        if isinstance(value, bool) or isinstance(value, str):
+            continue
+        if isinstance(value, (int, float)):
+            tree_config.add_float_parameter(name, value - abs(value) * VARIATION, value + abs(value) * VARIATION)
+        elif isinstance(value, tuple) and all(isinstance(v, (int, float)) for v in value):
+            values = np.array(value, dtype=np.float64)
+            tree_config.add_float_list_parameter(name, values - np.abs(values) * VARIATION, values + np.abs(values) * VARIATION)
+    return tree_config
+
+
+def bench_tree_config(model, number_samples, repeats):
+    tree_config = preset_config(model)
+
+    def jitter(_):
+        tree_model = {}
+        for _ in range(number_samples):
+            tree_config.jitter(tree_model)
+
+    def jitter_batch(_):
+        tree_config.jitter_batch(number_samples, np.random.RandomState(0))
+
+    def species_plan(_):
+        sample_plan.species_plan(model, number_samples, 4, 500)
+
+    parameters = {'model': utils.get_filename(model), 'parameters': len(tree_config.tree_parameters)}
+    return [common.measure('treeconfig_jitter', jitter, number_samples, repeats, **parameters),
+            common.measure('treeconfig_jitter_batch', jitter_batch, number_samples, repeats, **parameters),
+            common.measure('sample_plan_species', species_plan, number_samples, repeats, **parameters)]
+
+
+# File utilities
+def image_directory(root, number_images, image_size):
+    # fresh directory of synthetic images, the save functions remove the files they stored
+    path = os.path.join(tempfile.mkdtemp(dir=root), '')  # the file utilities glob path + '*.png'
+    common.write_samples(os.path.join(path, 'tree'), common.random_samples(0, number_images, 1), image_size)
+    return path
+
+
+def bench_save(root, number_images, image_size, repeats):
+    def save_zip(path):
+        with file_utils.new_file(os.path.join(path, 'samples'), file_utils.FileType.ZIP) as open_file:
+            file_utils.save_files_to_zip(open_file, path, '.png')
+
+    def save_hdf5(path):
+        with file_utils.new_file(os.path.join(path, 'samples'), file_utils.FileType.HDF5) as open_file:
+            file_utils.save_images_to_hdf5(open_file, path)
+
+    def setup():
+        return image_directory(root, number_images, image_size)
+
+    return [common.measure('save_files_to_zip', save_zip, number_images, repeats, setup, image_size=image_size),
+            common.measure('save_images_to_hdf5', save_hdf5, number_images, repeats, setup, image_size=image_size)]
+
+
+def sample_file(root, number_images, image_size):
+    path = image_directory(root, number_images, image_size)
+    with file_utils.new_file(os.path.join(path, 'samples'), file_utils.FileType.HDF5) as open_file:
+        file_utils.save_images_to_hdf5(open_file, path)
+        return open_file.filename
+
+
+def bench_read(root, number_images, image_size, batch_size, repeats):
+    hdf5_file = sample_file(root, number_images, image_size)
+    names = file_utils.load_dataset_list(hdf5_file)
+    batches = (number_images // batch_size) * batch_size
+
+    def next_batch(_):
+        for _ in file_utils.next_batch(hdf5_file, names, batch_size):
+            pass
+
+    image_batch = file_utils.load_image_batch(hdf5_file, names[:PREVIEW_BATCH_SIZE])
+
+    def preview_batch(_):
+        for _ in range(number_images // PREVIEW_BATCH_SIZE):
+            file_utils.preview_batch(image_batch, channels=1)
+
+    def fuel_convert(_):
+        file_utils.fuel_convert(hdf5_file)
+
+    return [common.measure('next_batch', next_batch, batches, repeats, image_size=image_size, batch_size=batch_size),
+            common.measure('preview_batch', preview_batch, (number_images // PREVIEW_BATCH_SIZE) * len(image_batch), repeats,
+                           image_size=image_size, batch_size=len(image_batch)),
+            common.measure('fuel_convert', fuel_convert, number_images, repeats, image_size=image_size)]
+
+
+BENCHMARKS = ('tree_config', 'save', 'read')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='microbenchmarks of the sample generation pipeline')
+    parser.add_argument('-n', '--number-samples', type=int, default=1000, help='samples, images or tree models per run')
+    parser.add_argument('-S', '--image-size', type=int, default=64, help='size of the synthetic images')
+    parser.add_argument('-b', '--batch-size', type=int, default=64, help='batch size of next_batch')
+    parser.add_argument('-r', '--repeats', type=int, default=3, help='runs per benchmark, the best one counts')
+    parser.add_argument('-m', '--model', default=DEFAULT_MODEL, help='tree model preset of the parameter sampling')
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, default=BENCHMARKS, help='run only some of the benchmarks')
+    parser.add_argument('-o', '--output', help='write the results as json')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='treenet_benchmark_')
+    results = []
+    try:
+        if 'tree_config' in args.only:
+            results += bench_tree_config(args.model, args.number_samples, args.repeats)
+        if 'save' in args.only:
+            results += bench_save(root, args.number_samples, args.image_size, args.repeats)
+        if 'read' in args.only:
+            results += bench_read(root, args.number_samples, args.image_size, args.batch_size, args.repeats)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    if args.output:
+        common.write_results(args.output, results)
+
+if __name__ == '__main__':
+    main()
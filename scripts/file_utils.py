@@ -1,15 +1,22 @@
 #!/usr/bin/env python3
 # auxiliary functions for hdf5 operations
 
+import os
 import h5py
 from zipfile import ZipFile
 from scipy import ndimage
 from scipy.misc import toimage
 from enum import Enum
 import matplotlib.pyplot as plt
+import io
 import math
+import json
+import threading
+from queue import Queue, Full
+from time import time
 import numpy as np
 
+import skeleton_graph
 import utils
 
 """ remove this line if no longer needed """
@@ -19,7 +26,7 @@ __author__ = "Andrin Jenal"
 __copyright__ = "Copyright 2016, ETH Zurich"
 __license__ = "GPL"  # Do you even know what a GPL license is?
 
-FileType = Enum('file_type', 'HDF5 ZIP')
+FileType = Enum('file_type', 'HDF5 ZIP TAR')
 
 
 # Utils
@@ -42,19 +49,33 @@ def files_in_directory(path, file_format):
 
 
 # Files
-def new_file(path_to_file, file_type):
+def new_file(path_to_file, file_type, mode='w', shard_size=None):
+    # mode 'a' reopens an existing file for appending
     if file_type == FileType.HDF5:
-        h5file = h5py.File(path_to_file + '.h5', 'w')
+        h5file = h5py.File(path_to_file + '.h5', mode)
         return h5file
 
     elif file_type == FileType.ZIP:
-        zip_file = ZipFile(path_to_file + '.zip', 'w')
+        zip_file = ZipFile(path_to_file + '.zip', mode)
         return zip_file
 
+    elif file_type == FileType.TAR:
+        import shards  # shards builds on the metadata helpers of this module
+        return shards.ShardWriter(path_to_file + shards.SHARDS_EXTENSION, shard_size or shards.SHARD_SIZE, mode)
+
     else:
         print('file type: ' + file_type + ' not defined')
 
 
+def stored_sample_names(open_file, file_type):
+    # names of all samples in an open output file, without directory and file extension
+    if file_type in (FileType.ZIP, FileType.TAR):
+        return set(utils.get_filename(name) for name in open_file.namelist())
+    if is_contiguous(open_file):
+        return set(decode_names(open_file[FILENAME][()]))
+    return set(name for name in open_file)
+
+
 def save_to_hdf5(open_file, path, file_format, scipy_image_format):
     save_images_to_hdf5(open_file, path, scipy_format=scipy_image_format)
 
@@ -65,49 +86,369 @@ def save_to_zip(open_file, path, file_format):
 
 # ZIP Files
 def save_files_to_zip(open_file, path, file_type, dir_name='samples'):
-    file_list = files_in_directory(path, file_type)
+    save_file_list_to_zip(open_file, files_in_directory(path, file_type), dir_name)
+
+
+def save_file_list_to_zip(open_file, file_list, dir_name='samples', skip_existing=False):
+    # skip_existing leaves members alone that an earlier, interrupted run already stored
+    existing = set(open_file.namelist()) if skip_existing else set()
     for image in file_list:
-        open_file.write(image, dir_name + '/' + utils.get_filename_with_extension(image))
+        arcname = dir_name + '/' + utils.get_filename_with_extension(image)
+        if arcname not in existing:
+            open_file.write(image, arcname)
 
     # clean directory
     remove_files(file_list)
 
 
+def merge_zip_files(open_file, file_list):
+    # copy the members of the zip files in file_list, in order, members already stored are kept
+    existing = set(open_file.namelist())
+    for path in file_list:
+        with ZipFile(path, 'r') as part:
+            for info in part.infolist():
+                if info.filename not in existing:
+                    open_file.writestr(info, part.read(info))
+                    existing.add(info.filename)
+
+
+def save_arrays_to_zip(open_file, images, names, dir_name='samples', skip_existing=False):
+    # store in-memory images, e.g. skeletons, as png members named after their source files
+    existing = set(open_file.namelist()) if skip_existing else set()
+    for img_data, name in zip(images, names):
+        arcname = dir_name + '/' + utils.get_filename(name) + '.png'
+        if arcname not in existing:
+            buffer = io.BytesIO()
+            toimage(img_data, cmin=0, cmax=255).save(buffer, format='PNG')
+            open_file.writestr(arcname, buffer.getvalue())
+
+
+def read_images(image_list, scipy_format='L'):
+    return np.array([ndimage.imread(image, mode=scipy_format) for image in image_list])
+
+
 # HDF5 Files
+#
+# Images are appended to a single resizable (N, H, W[, C]) uint8 dataset 'images'. Parallel 1-D datasets hold the
+# metadata of every row: species, seed, view angle and the original file name. Files written by earlier versions hold
+# one dataset per image instead, the readers below accept both layouts.
+IMAGES = 'images'
+SPECIES = 'species'
+SEED = 'seed'
+ANGLE = 'angle'
+FILENAME = 'filename'
+SKELETONS = 'skeletons'  # optional, row aligned with images
+# optional images_<size>x<size> datasets hold the images downsampled to smaller sizes, see sized_name
+PACKED_WIDTH = 'packed_width'  # attribute of bit packed datasets, see Bit Packing below
+
+CHUNK_BYTES = 2 ** 18  # aim at chunks of roughly 256 KiB
+WRITE_BATCH_SIZE = 256  # number of images buffered before they are written
+
+
+# Bit Packing
+#
+# Binary images can be stored with 8 pixels per byte along the width axis, bit 1 marks a tree pixel (value < 255).
+# Packed datasets and raw exports record the unpacked width, the readers below unpack whole batches at once. Packing
+# is lossy for grey pixels, which become tree pixels.
+def pack_images(images):
+    """
+    Pack a batch of (N, H, W[, C]) images into (N, H, ceil(W / 8)[, C]) bytes.
+    """
+    return np.packbits(np.asarray(images) < 255, axis=2)
+
+
+def unpack_masks(packed, width, dtype=np.float32, out=None):
+    """
+    Unpack a batch into masks of dtype with 1 for the tree and 0 for the background, e.g. straight into a float32
+    training tensor. out optionally receives the result.
+    """
+    bits = np.unpackbits(packed, axis=2)[:, :, :width]
+    if out is None:
+        return bits.astype(dtype)
+    out[...] = bits
+    return out
+
+
+def unpack_images(packed, width, out=None):
+    """
+    Unpack a batch into black on white uint8 images, as they would have been stored without packing.
+    """
+    bits = np.unpackbits(packed, axis=2)[:, :, :width]
+    if out is None:
+        out = np.empty(bits.shape, dtype=np.uint8)
+    np.multiply(bits, 255, out=out)
+    np.subtract(255, out, out=out)
+    return out
+
+
+def packed_width(attrs):
+    # unpacked width of a packed dataset or raw index, None if the images are not packed
+    width = attrs.get(PACKED_WIDTH)
+    return None if width is None else int(width)
+
+
+def read_images_from(dataset, selection=np.s_[...]):
+    # rows of a dataset, unpacked if needed
+    images = dataset[selection]
+    width = packed_width(dataset.attrs)
+    return images if width is None else unpack_images(images, width)
+
+
 def add_group(h5file, path):
     return h5file.create_group(utils.get_filename(path))
 
 
+def parse_sample_name(name):
+    """
+    Split a rendered file name <species>_<seed>_<angle> into its parts. Unknown parts are returned as -1.
+    """
+    parts = utils.get_filename(name).rsplit('_', 2)
+    if len(parts) == 3 and parts[1].isdigit() and parts[2].isdigit():
+        return parts[0], int(parts[1]), int(parts[2])
+    return utils.get_filename(name), -1, -1
+
+
+class AppendableDataset:
+    """
+    A dataset that grows along its first axis. Rows are buffered and written in batches with a single resize and
+    slice assignment each.
+    """
+
+    def __init__(self, h5file, name, item_shape, dtype, batch_size=WRITE_BATCH_SIZE):
+        if name in h5file:
+            self.dataset = h5file[name]
+        else:
+            item_shape = tuple(item_shape)
+            if dtype is str:
+                dtype = h5py.special_dtype(vlen=str)
+            item_bytes = int(np.prod(item_shape, dtype=np.int64)) * np.dtype(dtype).itemsize
+            chunk_rows = max(1, min(CHUNK_BYTES // max(1, item_bytes), 4096))
+            self.dataset = h5file.create_dataset(name, shape=(0,) + item_shape, maxshape=(None,) + item_shape,
+                                                 chunks=(chunk_rows,) + item_shape, dtype=dtype)
+        self.batch_size = batch_size
+        self.buffer = []
+
+    def __len__(self):
+        return self.dataset.shape[0] + len(self.buffer)
+
+    def append(self, row):
+        self.buffer.append(row)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        if self.dataset.dtype.kind == 'O':
+            rows = np.array(self.buffer, dtype=object)
+        else:
+            rows = np.asarray(self.buffer, dtype=self.dataset.dtype)
+        n = self.dataset.shape[0]
+        self.dataset.resize(n + len(rows), axis=0)
+        self.dataset[n:n + len(rows)] = rows
+        self.buffer = []
+
+    def extend(self, rows):
+        # append a whole block of rows with a single write
+        self.flush()
+        if not len(rows):
+            return
+        n = self.dataset.shape[0]
+        self.dataset.resize(n + len(rows), axis=0)
+        self.dataset[n:n + len(rows)] = rows
+
+
+class SampleWriter:
+    """
+    Append images and their metadata to the contiguous layout of an open hdf5 file.
+    """
+
+    def __init__(self, h5file, scipy_format='L', batch_size=WRITE_BATCH_SIZE, packed=False):
+        self.h5file = h5file
+        self.scipy_format = scipy_format
+        self.batch_size = batch_size
+        self.packed = packed
+        self.images = None
+        self.metadata = {
+            SPECIES: AppendableDataset(h5file, SPECIES, (), str, batch_size),
+            SEED: AppendableDataset(h5file, SEED, (), np.int64, batch_size),
+            ANGLE: AppendableDataset(h5file, ANGLE, (), np.int16, batch_size),
+            FILENAME: AppendableDataset(h5file, FILENAME, (), str, batch_size),
+        }
+        if IMAGES in h5file:
+            self.images = AppendableDataset(h5file, IMAGES, None, None, batch_size)
+            # an existing file keeps its storage format
+            self.packed = packed_width(self.images.dataset.attrs) is not None
+        h5file.attrs['layout'] = 'contiguous'
+
+    def __len__(self):
+        return len(self.metadata[FILENAME])
+
+    def append(self, img_data, name):
+        width = img_data.shape[1]
+        if self.packed:
+            img_data = pack_images(img_data[None])[0]
+        if self.images is None:
+            self.images = AppendableDataset(self.h5file, IMAGES, img_data.shape, np.uint8, self.batch_size)
+            self.images.dataset.attrs['scipy_format'] = self.scipy_format
+            if self.packed:
+                self.images.dataset.attrs[PACKED_WIDTH] = width
+
+        species, seed, angle = parse_sample_name(name)
+        self.images.append(img_data)
+        self.metadata[SPECIES].append(species)
+        self.metadata[SEED].append(seed)
+        self.metadata[ANGLE].append(angle)
+        self.metadata[FILENAME].append(utils.get_filename(name))
+
+    def append_batch(self, images, names):
+        for img_data, name in zip(images, names):
+            self.append(img_data, name)
+
+    def add_images(self, image_list):
+        for image in image_list:
+            # 'L' (8-bit pixels, black and white)
+            # 'P' (8-bit pixels, mapped to any other mode using a color palette)
+            # 'RGB' (3x8-bit pixels, true color)
+            # 'RGBA' (4x8-bit pixels, true color with transparency mask)
+            # 'CMYK' (4x8-bit pixels, color separation)
+            # 'YCbCr' (3x8-bit pixels, color video format)
+            self.append(ndimage.imread(image, mode=self.scipy_format), image)
+
+    def flush(self):
+        if self.images is not None:
+            self.images.flush()
+        for dataset in self.metadata.values():
+            dataset.flush()
+
+
 def save_images_to_hdf5(open_h5file, path, image_format='.png', scipy_format='L'):
-    image_list = images_in_directory(path, image_format)
-
-    for image in image_list:
-        # 'L' (8-bit pixels, black and white)
-        # 'P' (8-bit pixels, mapped to any other mode using a color palette)
-        # 'RGB' (3x8-bit pixels, true color)
-        # 'RGBA' (4x8-bit pixels, true color with transparency mask)
-        # 'CMYK' (4x8-bit pixels, color separation)
-        # 'YCbCr' (3x8-bit pixels, color video format)
-        # 'I' (32-bit signed integer pixels)
-        # 'F' (32-bit floating point pixels)
-        img_data = ndimage.imread(image, mode=scipy_format)
-        dataset = open_h5file.create_dataset(utils.get_filename(image), data=img_data, shape=img_data.shape)
-        dataset.attrs['scipy_format'] = scipy_format
+    save_image_list_to_hdf5(open_h5file, images_in_directory(path, image_format), scipy_format)
+
+
+def save_image_list_to_hdf5(open_h5file, image_list, scipy_format='L', packed=False):
+    writer = SampleWriter(open_h5file, scipy_format, packed=packed)
+    writer.add_images(image_list)
+    writer.flush()
 
     # clean directory
     remove_files(image_list)
 
 
+def save_rows_to_hdf5(open_h5file, name, rows, packed=False, **attrs):
+    # append to a uint8 dataset that is row aligned with images, e.g. skeletons or downsampled images
+    if packed:
+        attrs[PACKED_WIDTH] = rows.shape[2]
+        rows = pack_images(rows)
+    dataset = AppendableDataset(open_h5file, name, rows.shape[1:], np.uint8)
+    dataset.extend(rows)
+    dataset.dataset.attrs.update(attrs)
+
+
+def sized_name(name, size):
+    # dataset or zip directory of the samples downsampled to size x size pixels
+    return '%s_%dx%d' % (name, size, size)
+
+
+def truncate_samples(h5file, number_samples):
+    """
+    Shrink every per-sample dataset of the contiguous layout to its first number_samples rows.
+    """
+    for name in h5file:
+        dataset = h5file[name]
+        if isinstance(dataset, h5py.Dataset) and dataset.maxshape and dataset.maxshape[0] is None and dataset.shape[0] > number_samples:
+            dataset.resize(number_samples, axis=0)
+
+
+def merge_hdf5_files(open_h5file, file_list):
+    """
+    Append every per-sample dataset of the contiguous hdf5 files in file_list, in order, to an open hdf5 file.
+    Dataset attributes (e.g. the packed width) are taken from the first file that has the dataset.
+    """
+    open_h5file.attrs['layout'] = 'contiguous'
+    graph_writer = None
+    for path in file_list:
+        with h5py.File(path, 'r') as part:
+            has_graphs = GRAPH_GROUP in part
+            for name in part:
+                source = part[name]
+                if not isinstance(source, h5py.Dataset) or not source.maxshape or source.maxshape[0] is not None:
+                    continue
+                is_string = h5py.check_dtype(vlen=source.dtype) is str
+                created = name not in open_h5file
+                dataset = AppendableDataset(open_h5file, name, source.shape[1:], str if is_string else source.dtype)
+                if created:
+                    dataset.dataset.attrs.update(source.attrs)
+                rows = source[()]
+                dataset.extend(np.array(decode_names(rows), dtype=object) if is_string else rows)
+        if has_graphs:
+            graph_writer = graph_writer or GraphWriter(open_h5file)
+            append_graphs(graph_writer, load_graphs(path))
+    if graph_writer is not None:
+        graph_writer.flush()
+
+
+def row_names(h5file):
+    # sample name of every row of the contiguous layout
+    if not is_contiguous(h5file):
+        return []
+    return decode_names(h5file[FILENAME][()])
+
+
+def number_rows(h5file):
+    return h5file[IMAGES].shape[0] if is_contiguous(h5file) else 0
+
+
+def is_contiguous(h5file):
+    return IMAGES in h5file and isinstance(h5file[IMAGES], h5py.Dataset)
+
+
+def decode_names(names):
+    # depending on the h5py version variable length strings are read as bytes
+    return [n.decode() if isinstance(n, bytes) else n for n in names]
+
+
+def sample_indices(h5file, names):
+    """
+    Map sample names (or row indices) to rows of the contiguous layout.
+    """
+    if len(names) and isinstance(names[0], (int, np.integer)):
+        return np.asarray(names, dtype=np.int64)
+    index = dict((n, i) for i, n in enumerate(decode_names(h5file[FILENAME][()])))
+    return np.array([index[n] for n in decode_names(names)], dtype=np.int64)
+
+
+def read_rows(dataset, rows):
+    """
+    Read arbitrary rows with one increasing-index read and restore the requested order.
+    """
+    unique_rows, inverse = np.unique(rows, return_inverse=True)
+    return dataset[unique_rows.tolist()][inverse]
+
+
+def load_images(h5file, names, dataset_name=IMAGES):
+    # dataset_name=SKELETONS loads the skeletons of the samples instead
+    if is_contiguous(h5file):
+        dataset = h5file[dataset_name]
+        images = read_rows(dataset, sample_indices(h5file, names))
+        width = packed_width(dataset.attrs)
+        return images if width is None else unpack_images(images, width)
+    return np.array([h5file[ds_name].value for ds_name in names])
+
+
 def load_image_batch(hdf5_file, dataset_batch_list):
     with h5py.File(hdf5_file, 'r') as _file:
-        res = []
-        for ds_name in dataset_batch_list:
-            res.append(_file[ds_name].value)
-        return np.array(res)
+        return load_images(_file, dataset_batch_list)
 
 
 def next_batch(hdf5_file, image_list, batch_size):
     with h5py.File(hdf5_file, 'r') as _file:
+        if is_contiguous(_file):
+            rows = sample_indices(_file, image_list)
+            for i in range(0, len(rows) - batch_size + 1, batch_size):
+                yield load_images(_file, rows[i:i + batch_size])
+            return
+
         images = []
         for ds_name in image_list:
             images.append(_file[ds_name].value)
@@ -118,9 +459,415 @@ def next_batch(hdf5_file, image_list, batch_size):
 
 def load_dataset_list(hdf5_file):
     with h5py.File(hdf5_file, 'r') as _file:
+        if is_contiguous(_file):
+            return decode_names(_file[FILENAME][()])
         return [ds for ds in _file[_file.name]]
 
 
+class BatchReader:
+    """
+    Serve batches of a contiguous dataset with slice reads only. Shuffling is chunk-aware: the order of the hdf5
+    chunks is shuffled, a window of buffer_chunks chunks is read with one slice per chunk and the rows are shuffled
+    within that window. Batches are filled into preallocated buffers on a background thread which stays prefetch
+    batches ahead.
+
+    The yielded arrays are reused once the consumer asks for the next batches, copy them if they need to be kept.
+    The remainder that does not fill a whole batch is dropped, as in next_batch. Bit packed datasets are unpacked
+    batch by batch; with float_masks the batches are float32 masks with 1 for the tree, ready for training.
+    """
+
+    _END = object()
+
+    def __init__(self, hdf5_file, batch_size, shuffle=True, buffer_chunks=16, prefetch=2, dataset_name=IMAGES,
+                 random_state=None, float_masks=False):
+        self.hdf5_file = hdf5_file
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.buffer_chunks = max(1, buffer_chunks)
+        self.prefetch = max(0, prefetch)
+        self.dataset_name = dataset_name
+        self.random_state = random_state or np.random.RandomState()
+
+        with h5py.File(hdf5_file, 'r') as _file:
+            if dataset_name not in _file or not isinstance(_file[dataset_name], h5py.Dataset):
+                raise ValueError('no contiguous dataset %s in %s' % (dataset_name, hdf5_file))
+            dataset = _file[dataset_name]
+            self.shape = dataset.shape
+            self.dtype = dataset.dtype
+            self.chunk_rows = dataset.chunks[0] if dataset.chunks else min(self.shape[0], 1024)
+            self.width = packed_width(dataset.attrs)
+
+        # shape and type of the yielded batches
+        self.item_shape = self.shape[1:]
+        if self.width is not None:
+            self.item_shape = self.shape[1:2] + (self.width,) + self.shape[3:]
+        self.float_masks = float_masks
+        self.batch_dtype = np.float32 if float_masks else self.dtype
+
+    def __len__(self):
+        return self.shape[0] // self.batch_size
+
+    def chunk_order(self):
+        starts = np.arange(0, self.shape[0], max(1, self.chunk_rows))
+        if self.shuffle:
+            self.random_state.shuffle(starts)
+        return starts
+
+    def batches(self, buffers):
+        """
+        Synchronously read one epoch, every batch is written into the next buffer of buffers.
+        """
+        n = self.shape[0]
+        window = np.empty((self.buffer_chunks * self.chunk_rows + self.batch_size,) + self.shape[1:], dtype=self.dtype)
+        pending = 0
+
+        with h5py.File(self.hdf5_file, 'r') as _file:
+            dataset = _file[self.dataset_name]
+            starts = self.chunk_order()
+
+            for w in range(0, len(starts), self.buffer_chunks):
+                # read the chunks of a window in file order, one slice each, behind the rows left from the last window
+                fill = pending
+                for start in np.sort(starts[w:w + self.buffer_chunks]):
+                    stop = min(start + self.chunk_rows, n)
+                    dataset.read_direct(window, np.s_[start:stop], np.s_[fill:fill + stop - start])
+                    fill += stop - start
+
+                order = self.random_state.permutation(fill) if self.shuffle else np.arange(fill)
+                full = fill - fill % self.batch_size
+                for b in range(0, full, self.batch_size):
+                    batch = next(buffers)
+                    if self.width is None and not self.float_masks:
+                        np.take(window, order[b:b + self.batch_size], axis=0, out=batch)
+                    else:
+                        self.convert(np.take(window, order[b:b + self.batch_size], axis=0), batch)
+                    yield batch
+
+                rest = order[full:fill]
+                window[:len(rest)] = window[rest]
+                pending = len(rest)
+
+    def convert(self, stored, batch):
+        # unpack and/or turn into float masks in one vectorized call each
+        if self.width is None:
+            np.less(stored, 255, out=batch, casting='unsafe')
+        elif self.float_masks:
+            unpack_masks(stored, self.width, out=batch)
+        else:
+            unpack_images(stored, self.width, out=batch)
+
+    def buffer_pool(self, size):
+        # the consumer holds one buffer, the queue up to prefetch buffers and the reader fills one
+        buffers = [np.empty((self.batch_size,) + self.item_shape, dtype=self.batch_dtype) for _ in range(size)]
+        while True:
+            for b in buffers:
+                yield b
+
+    def __iter__(self):
+        if self.prefetch == 0:
+            for batch in self.batches(self.buffer_pool(1)):
+                yield batch
+            return
+
+        batches = Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for batch in self.batches(self.buffer_pool(self.prefetch + 2)):
+                    if not put(batch):
+                        return
+                put(self._END)
+            except Exception as e:
+                put(e)
+
+        reader = threading.Thread(target=produce, name='batch-reader', daemon=True)
+        reader.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is self._END:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            reader.join()
+
+
+# Raw Files
+#
+# A raw export is a single uint8 array file <name>.raw, written row after row, plus a small json index <name>.idx.json
+# holding shape, dtype, the row ranges of every species and the metadata of every sample. Training code maps the
+# array with np.memmap and slices it without any decoding.
+RAW_EXTENSION = '.raw'
+RAW_INDEX_EXTENSION = '.idx.json'
+
+
+class RawWriter:
+    """
+    Append images to a raw array file and write the index once all images are written.
+    """
+
+    def __init__(self, path_to_file, packed=False):
+        self.path_to_file = path_to_file
+        self.raw_file = open(path_to_file + RAW_EXTENSION, 'wb')
+        self.packed = packed
+        self.width = None
+        self.item_shape = None
+        self.metadata = dict((column, []) for column in (SPECIES, SEED, ANGLE, FILENAME))
+
+    def __len__(self):
+        return len(self.metadata[FILENAME])
+
+    def append(self, img_data, name):
+        if self.packed:
+            self.width = img_data.shape[1]
+            img_data = pack_images(img_data[None])[0]
+        img_data = np.ascontiguousarray(img_data, dtype=np.uint8)
+        if self.item_shape is None:
+            self.item_shape = img_data.shape
+        elif img_data.shape != self.item_shape:
+            raise ValueError('image %s has shape %s, expected %s' % (name, img_data.shape, self.item_shape))
+        img_data.tofile(self.raw_file)
+
+        species, seed, angle = parse_sample_name(name)
+        self.metadata[SPECIES].append(species)
+        self.metadata[SEED].append(seed)
+        self.metadata[ANGLE].append(angle)
+        self.metadata[FILENAME].append(utils.get_filename(name))
+
+    def append_batch(self, images, names):
+        for img_data, name in zip(images, names):
+            self.append(img_data, name)
+
+    def species_ranges(self):
+        # consecutive rows of the same species as [species, start, stop]
+        ranges = []
+        for i, species in enumerate(self.metadata[SPECIES]):
+            if ranges and ranges[-1][0] == species and ranges[-1][2] == i:
+                ranges[-1][2] = i + 1
+            else:
+                ranges.append([species, i, i + 1])
+        return ranges
+
+    def close(self):
+        self.raw_file.close()
+        index = {
+            'shape': [len(self)] + list(self.item_shape or ()),
+            'dtype': 'uint8',
+            PACKED_WIDTH: self.width,
+            'species_ranges': self.species_ranges(),
+            'samples': self.metadata,
+        }
+        with open(self.path_to_file + RAW_INDEX_EXTENSION, 'w') as _index:
+            json.dump(index, _index)
+        return self.path_to_file + RAW_EXTENSION
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def raw_path_prefix(file_path):
+    for extension in (RAW_EXTENSION, RAW_INDEX_EXTENSION, '.h5', '.zip'):
+        if file_path.endswith(extension):
+            return file_path[:-len(extension)]
+    return file_path
+
+
+def iterate_hdf5_images(hdf5_file_name, block_size=1024):
+    """
+    Yield (images, names) blocks of an hdf5 file in storage order, for both layouts.
+    """
+    with h5py.File(hdf5_file_name, 'r') as _file:
+        if is_contiguous(_file):
+            images = _file[IMAGES]
+            names = decode_names(_file[FILENAME][()])
+            for start in range(0, images.shape[0], block_size):
+                yield read_images_from(images, np.s_[start:start + block_size]), names[start:start + block_size]
+        else:
+            names = [ds for ds in _file[_file.name]]
+            for start in range(0, len(names), block_size):
+                block = names[start:start + block_size]
+                yield np.array([_file[ds_name].value for ds_name in block]), block
+
+
+def iterate_zip_images(zip_file_name, scipy_format='L', block_size=1024):
+    with ZipFile(zip_file_name, 'r') as _file:
+        members = sorted(m for m in _file.namelist() if m.endswith('.png'))
+        for start in range(0, len(members), block_size):
+            block = members[start:start + block_size]
+            images = []
+            for member in block:
+                with _file.open(member) as image:
+                    images.append(ndimage.imread(image, mode=scipy_format))
+            yield np.array(images), [utils.get_filename(m) for m in block]
+
+
+def export_raw(file_name, path_to_file=None, packed=False):
+    """
+    Convert an existing .h5 or .zip sample file into a raw array file with its index, bit packed if packed is set.
+    """
+    path_to_file = path_to_file or raw_path_prefix(file_name)
+    if file_name.endswith('.zip'):
+        blocks = iterate_zip_images(file_name)
+    else:
+        blocks = iterate_hdf5_images(file_name)
+
+    with RawWriter(path_to_file, packed) as writer:
+        for images, names in blocks:
+            writer.append_batch(images, names)
+    print('Successfully written:', path_to_file + RAW_EXTENSION)
+    return path_to_file + RAW_EXTENSION
+
+
+def load_raw(file_name):
+    """
+    Map a raw export read-only. Returns the memory mapped (N, H, W[, C]) array and the index; slicing the array
+    returns views into the mapping. Rows of packed exports are unpacked with unpack_images or unpack_masks and the
+    width packed_width(index).
+    """
+    path_to_file = raw_path_prefix(file_name)
+    with open(path_to_file + RAW_INDEX_EXTENSION) as _index:
+        index = json.load(_index)
+    shape = tuple(index['shape'])
+    if shape[0] == 0:
+        return np.empty(shape, dtype=index['dtype']), index
+    images = np.memmap(path_to_file + RAW_EXTENSION, dtype=index['dtype'], mode='r', shape=shape)
+    return images, index
+
+
+def raw_species(images, index, species):
+    """
+    Zero-copy views of all rows of a species, one per consecutive range.
+    """
+    return [images[start:stop] for name, start, stop in index['species_ranges'] if name == species]
+
+
+# Tree Graphs
+#
+# Graphs of many trees (see skeleton_graph.py) share flat arrays in the group 'graph': positions, radii, levels, indptr
+# and indices with global node indices, so that indptr (closed with len(indices)) and indices form the block diagonal
+# CSR adjacency of all trees. node_offsets and edge_offsets hold the first node and first entry of indices of every
+# tree. All graphs of a file are loaded with one read per array and without any per tree objects.
+GRAPH_GROUP = 'graph'
+NODE_OFFSETS = 'node_offsets'
+EDGE_OFFSETS = 'edge_offsets'
+
+
+class GraphWriter:
+    """
+    Append tree graphs to the flat arrays of the graph group of an open hdf5 file.
+    """
+
+    def __init__(self, h5file, group=GRAPH_GROUP):
+        group = h5file.require_group(group)
+        self.datasets = {
+            skeleton_graph.POSITIONS: AppendableDataset(group, skeleton_graph.POSITIONS, (3,), np.float32),
+            skeleton_graph.RADII: AppendableDataset(group, skeleton_graph.RADII, (), np.float32),
+            skeleton_graph.LEVELS: AppendableDataset(group, skeleton_graph.LEVELS, (), np.int8),
+            skeleton_graph.INDPTR: AppendableDataset(group, skeleton_graph.INDPTR, (), np.int64),
+            skeleton_graph.INDICES: AppendableDataset(group, skeleton_graph.INDICES, (), np.int64),
+            NODE_OFFSETS: AppendableDataset(group, NODE_OFFSETS, (), np.int64),
+            EDGE_OFFSETS: AppendableDataset(group, EDGE_OFFSETS, (), np.int64),
+            FILENAME: AppendableDataset(group, FILENAME, (), str),
+        }
+
+    def __len__(self):
+        return len(self.datasets[NODE_OFFSETS])
+
+    def append(self, graph, name):
+        # node and edge indices become global
+        node_offset = len(self.datasets[skeleton_graph.POSITIONS])
+        edge_offset = len(self.datasets[skeleton_graph.INDICES])
+        self.datasets[NODE_OFFSETS].append(node_offset)
+        self.datasets[EDGE_OFFSETS].append(edge_offset)
+        self.datasets[FILENAME].append(utils.get_filename(name))
+
+        for column in (skeleton_graph.POSITIONS, skeleton_graph.RADII, skeleton_graph.LEVELS):
+            self.datasets[column].extend(graph[column])
+        self.datasets[skeleton_graph.INDPTR].extend(graph[skeleton_graph.INDPTR][:-1] + edge_offset)
+        self.datasets[skeleton_graph.INDICES].extend(graph[skeleton_graph.INDICES] + node_offset)
+
+    def flush(self):
+        for dataset in self.datasets.values():
+            dataset.flush()
+
+
+def append_graphs(writer, graphs):
+    # the graphs of load_graphs, e.g. of another file
+    for tree, name in enumerate(graphs[FILENAME]):
+        writer.append(graph_of_tree(graphs, tree), name)
+
+
+def number_graphs(h5file, group=GRAPH_GROUP):
+    return h5file[group][NODE_OFFSETS].shape[0] if group in h5file else 0
+
+
+def truncate_graphs(h5file, number_trees, group=GRAPH_GROUP):
+    """
+    Shrink the graph group to the graphs of its first number_trees trees.
+    """
+    if number_graphs(h5file, group) <= number_trees:
+        return
+    graphs = h5file[group]
+    nodes = graphs[NODE_OFFSETS][number_trees]
+    edges = graphs[EDGE_OFFSETS][number_trees]
+    for name, size in ((skeleton_graph.POSITIONS, nodes), (skeleton_graph.RADII, nodes), (skeleton_graph.LEVELS, nodes),
+                       (skeleton_graph.INDPTR, nodes), (skeleton_graph.INDICES, edges), (NODE_OFFSETS, number_trees),
+                       (EDGE_OFFSETS, number_trees), (FILENAME, number_trees)):
+        graphs[name].resize(size, axis=0)
+
+
+def save_graph_files_to_hdf5(open_h5file, file_list):
+    writer = GraphWriter(open_h5file)
+    for f in file_list:
+        writer.append(skeleton_graph.read_graph(f), f)
+    writer.flush()
+    return len(writer)
+
+
+def load_graphs(hdf5_file_name, group=GRAPH_GROUP):
+    """
+    All graphs of a file, one read per array. indptr gets its closing entry.
+    """
+    with h5py.File(hdf5_file_name, 'r') as _file:
+        graphs = dict((name, dataset[()]) for name, dataset in _file[group].items())
+    graphs[skeleton_graph.INDPTR] = np.append(graphs[skeleton_graph.INDPTR], len(graphs[skeleton_graph.INDICES]))
+    graphs[FILENAME] = decode_names(graphs[FILENAME])
+    return graphs
+
+
+def graph_of_tree(graphs, tree):
+    """
+    Views into the flat arrays of load_graphs for a single tree, with node indices local to the tree.
+    """
+    offsets = graphs[NODE_OFFSETS]
+    start = offsets[tree]
+    stop = offsets[tree + 1] if tree + 1 < len(offsets) else len(graphs[skeleton_graph.POSITIONS])
+    indptr = graphs[skeleton_graph.INDPTR][start:stop + 1]
+    return {
+        skeleton_graph.POSITIONS: graphs[skeleton_graph.POSITIONS][start:stop],
+        skeleton_graph.RADII: graphs[skeleton_graph.RADII][start:stop],
+        skeleton_graph.LEVELS: graphs[skeleton_graph.LEVELS][start:stop],
+        skeleton_graph.INDPTR: indptr - indptr[0],
+        skeleton_graph.INDICES: graphs[skeleton_graph.INDICES][indptr[0]:indptr[-1]] - start,
+    }
+
+
 def preview_batch(image_batch, channels):
     if channels == 1:
         n, height, width = image_batch.shape
@@ -150,11 +897,18 @@ def glimpse(hdf5_file_name):
     batch_size = 64
     plt.ion()
 
-    ds_list = np.array(load_dataset_list(hdf5_file_name))
-    ds_list = shuffle(ds_list)
+    with h5py.File(hdf5_file_name, 'r') as _file:
+        contiguous = is_contiguous(_file)
+
+    if contiguous:
+        batches = BatchReader(hdf5_file_name, batch_size, shuffle=True)
+    else:
+        ds_list = np.array(load_dataset_list(hdf5_file_name))
+        ds_list = shuffle(ds_list)
+        batches = next_batch(hdf5_file_name, ds_list, batch_size)
 
     fig, ax = plt.subplots()
-    for imgs in next_batch(hdf5_file_name, ds_list, batch_size):
+    for imgs in batches:
         if imgs.shape[-1] == 3:
             image_matrix = preview_batch(imgs, channels=3)
             plt.imshow(toimage(image_matrix))
@@ -166,29 +920,53 @@ def glimpse(hdf5_file_name):
         plt.pause(1)
 
 
-def fuel_convert(hdf5_file_name):
+FUEL_BLOCK_SIZE = 1024  # images converted at once, bounds the memory use of fuel_convert
+
+
+def number_of_images(hdf5_file_name):
+    with h5py.File(hdf5_file_name, 'r') as _file:
+        if is_contiguous(_file):
+            return _file[IMAGES].shape[0]
+        return len(_file[_file.name])
+
+
+def fuel_features(images):
+    """
+    Binary (N, C, H, W) features of a block of (N, H, W[, C]) images: 1 for the tree, 0 for the background.
+    """
+    features = (images < 255).astype(np.uint8)
+    if features.ndim == 3:
+        return features[:, None]
+    return features.transpose(0, 3, 1, 2)
+
+
+def fuel_convert(hdf5_file_name, block_size=FUEL_BLOCK_SIZE):
     """
         proof of concept DRAW-jbornschein
         delete if no longer needed
+
+        The images are streamed block by block, only one block is held in memory at a time.
     """
+    start_time = time()
     fuel_file_name = 'fuel_' + utils.basename(hdf5_file_name)
-    with h5py.File(hdf5_file_name, 'r') as _file:
-        dataset = load_dataset_list(hdf5_file_name)
-        fuel_dataset = []
-        for img in dataset:
-            _img = _file[img].value
-            _true = _img < 255
-            _false = _img == 255
-            _img[_true] = 1
-            _img[_false] = 0
-            fuel_dataset.append(_img)
-        fuel_dataset = np.array(fuel_dataset)
+    batch_size = number_of_images(hdf5_file_name)
+
     with h5py.File(utils.create_filepath(utils.get_path(hdf5_file_name), fuel_file_name), 'w') as _file:
-        batch_size = len(dataset)
-        channels = 1
-        image_size = 64
-        image_features = _file.create_dataset('features', (batch_size, channels, image_size, image_size), dtype='uint8')
-        image_features[...] = np.reshape(fuel_dataset, (batch_size, channels, image_size, image_size))
+        image_features = None
+        start = 0
+        for images, _ in iterate_hdf5_images(hdf5_file_name, block_size):
+            features = fuel_features(images)
+            if image_features is None:
+                # channels and image size are taken from the data
+                shape = features.shape[1:]
+                image_features = _file.create_dataset('features', (batch_size,) + shape, dtype='uint8',
+                                                      chunks=(max(1, min(block_size, CHUNK_BYTES // int(np.prod(shape)))),) + shape)
+            image_features[start:start + len(features)] = features
+            start += len(features)
+
+        if image_features is None:
+            print('no images found in:', hdf5_file_name)
+            return
         image_features.dims[0].label = 'batch'
         image_features.dims[1].label = 'channel'
         image_features.dims[2].label = 'height'
@@ -205,6 +983,10 @@ def fuel_convert(hdf5_file_name):
         _file.attrs['split'] = H5PYDataset.create_split_array(split_dict)
         print('Successfully written:', _file.filename)
 
+    elapsed = max(time() - start_time, 1e-9)
+    print('converted %d images of shape %s in %.2f seconds (%.0f images/s, %.1f MB/s)' %
+          (batch_size, shape, elapsed, batch_size / elapsed, batch_size * np.prod(shape) / elapsed / 2 ** 20))
+
 
 def test_fuel_convert(hdf5_file_name):
     batch_size = 49
@@ -242,6 +1024,10 @@ if __name__ == '__main__':
     parser.add_argument('-I', '--inspect', default=False, action='store_true', help='inspect hdf5 file')
     parser.add_argument('-F', '--file-path', help='path to hdf5 file')
     parser.add_argument('-C', '--convert', default=False, action='store_true', help='blubbi')
+    parser.add_argument('-B', '--block-size', type=int, default=FUEL_BLOCK_SIZE, help='number of images converted at once')
+    parser.add_argument('-R', '--raw', default=False, action='store_true', help='export .h5 or .zip file as raw array file with index')
+    parser.add_argument('-G', '--graphs', help='directory of tree graphs (.npz) to append to the hdf5 file given with -F')
+    parser.add_argument('--packed', default=False, action='store_true', help='store the raw export with 8 binary pixels per byte')
     args = parser.parse_args()
 
     if args.test:
@@ -249,6 +1035,12 @@ if __name__ == '__main__':
     elif args.inspect and args.file_path:
         glimpse(args.file_path)
     elif args.convert and args.file_path:
-        fuel_convert(args.file_path)
+        fuel_convert(args.file_path, args.block_size)
+    elif args.graphs and args.file_path:
+        with h5py.File(args.file_path, 'a') as _file:
+            count = save_graph_files_to_hdf5(_file, sorted(files_in_directory(os.path.join(args.graphs, ''), '.npz')))
+        print('%d graphs stored in %s' % (count, args.file_path))
+    elif args.raw and args.file_path:
+        export_raw(args.file_path, packed=args.packed)
     else:
         parser.print_help()
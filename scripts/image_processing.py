@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# vectorized operations on whole batches of rendered silhouettes
+#
+# Silhouettes are black trees on a white background: pixel values below 255 belong to the tree. All functions take
+# and return (N, H, W) batches (a single (H, W) image is treated as a batch of one).
+
+import numpy as np
+
+__author__ = "Andrin Jenal"
+__copyright__ = "Copyright 2016, ETH Zurich"
+__license__ = "GPL"
+
+BACKGROUND = 255
+FOREGROUND = 0
+
+
+def as_batch(images):
+    images = np.asarray(images)
+    if images.ndim == 2:
+        images = images[None]
+    if images.ndim == 4:
+        # color images: a pixel belongs to the tree if any channel is darker than the background
+        images = images.min(axis=-1)
+    return images
+
+
+def binarize(images, threshold=BACKGROUND):
+    """
+    Boolean tree masks, True where a pixel is darker than threshold.
+    """
+    return as_batch(images) < threshold
+
+
+def neighbours(masks):
+    """
+    The eight neighbours P2..P9 of every pixel, clockwise starting at the top, as uint8 arrays of the batch shape.
+    """
+    p = np.pad(masks, ((0, 0), (1, 1), (1, 1)), mode='constant').astype(np.uint8)
+    return [p[:, :-2, 1:-1], p[:, :-2, 2:], p[:, 1:-1, 2:], p[:, 2:, 2:],
+            p[:, 2:, 1:-1], p[:, 2:, :-2], p[:, 1:-1, :-2], p[:, :-2, :-2]]
+
+
+def thinning_step(masks, first):
+    p2, p3, p4, p5, p6, p7, p8, p9 = neighbours(masks)
+    ring = (p2, p3, p4, p5, p6, p7, p8, p9, p2)
+
+    # number of tree neighbours and number of background to tree transitions around the pixel
+    b = p2 + p3 + p4 + p5 + p6 + p7 + p8 + p9
+    a = sum(((ring[i] == 0) & (ring[i + 1] == 1)).astype(np.uint8) for i in range(8))
+
+    if first:
+        c = (p2 * p4 * p6 == 0) & (p4 * p6 * p8 == 0)
+    else:
+        c = (p2 * p4 * p8 == 0) & (p2 * p6 * p8 == 0)
+
+    remove = masks & (b >= 2) & (b <= 6) & (a == 1) & c
+    return masks & ~remove, remove.any()
+
+
+def skeletonize(masks, max_iterations=1000):
+    """
+    One pixel wide skeletons of a batch of boolean masks by Zhang-Suen thinning, which keeps the topology of the tree
+    but, unlike a medial axis transform, no branch radii. Both sub-iterations are applied to the whole batch at once
+    until no pixel of any image changes; images that converged early stay unchanged.
+    """
+    masks = np.array(as_batch(masks), dtype=bool)
+    for _ in range(max_iterations):
+        masks, changed_first = thinning_step(masks, first=True)
+        masks, changed_second = thinning_step(masks, first=False)
+        if not (changed_first or changed_second):
+            break
+    return masks
+
+
+def to_silhouette(masks):
+    # boolean masks back to black on white uint8 images
+    return np.where(masks, FOREGROUND, BACKGROUND).astype(np.uint8)
+
+
+def skeleton_images(images, threshold=BACKGROUND):
+    """
+    Binarize rendered silhouettes and return their skeletons as black on white uint8 images.
+    """
+    return to_silhouette(skeletonize(binarize(images, threshold)))
+
+
+# Downsampling
+DOWNSAMPLE_MODES = ('area', 'threshold')
+
+
+def area_weights(source, target):
+    """
+    (target, source) matrix whose row i holds the fractions of the source pixels covered by target pixel i, divided
+    by the target pixel's width. Works for any ratio of the two sizes.
+    """
+    scale = source / float(target)
+    edges = np.arange(target + 1) * scale
+    pixels = np.arange(source)[None]
+    overlap = np.minimum(edges[1:, None], pixels + 1) - np.maximum(edges[:-1, None], pixels)
+    return np.clip(overlap, 0, None) / scale
+
+
+def downsample(images, size, mode='area'):
+    """
+    Downsample a batch of (N, H, W[, C]) uint8 images to size x size pixels. 'area' averages the covered source
+    pixels, 'threshold' keeps every target pixel that covers any tree pixel, so thin branches do not fade out.
+    """
+    images = np.asarray(images)
+    if images.ndim == 2:
+        images = images[None]
+    rows = area_weights(images.shape[1], size)
+    cols = area_weights(images.shape[2], size)
+    averaged = np.einsum('ih,nhw...,jw->nij...', rows, images.astype(np.float32), cols)
+
+    if mode == 'area':
+        return np.rint(averaged).astype(np.uint8)
+    if mode == 'threshold':
+        return np.where(averaged < BACKGROUND - 0.5, FOREGROUND, BACKGROUND).astype(np.uint8)
+    raise ValueError('unknown downsample mode: ' + str(mode))
+
+
+def derived_images(images, skeleton=False, sizes=(), downsample_mode='area'):
+    """
+    Everything the ingestion computes from a batch of rendered images: the skeletons (or None) and a dict of the
+    images downsampled to every size in sizes.
+    """
+    skeletons = skeleton_images(images) if skeleton else None
+    return skeletons, dict((size, downsample(images, size, downsample_mode)) for size in sizes)
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+# auxiliary functions for per job scratch directories and background ingestion into the output file
+
+import os
+import json
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from queue import Queue, Empty
+
+import file_utils
+import image_processing
+import pixel_stream
+import skeleton_graph
+import utils
+
+__author__ = "Andrin Jenal"
+__copyright__ = "Copyright 2016, ETH Zurich"
+__license__ = "GPL"
+
+MANIFEST_NAME = 'manifest.json'
+SCRATCH_DIR_NAME = 'scratch'
+SKELETON_MODES = ('add', 'replace')  # store skeletons next to the silhouettes or instead of them
+
+
+# Scratch directories
+def scratch_root(output_path):
+    return os.path.join(output_path, SCRATCH_DIR_NAME, '')
+
+
+def scratch_directory(output_path, job_index):
+    return os.path.join(scratch_root(output_path), 'job_%05d' % job_index, '')
+
+
+def remove_scratch_directory(scratch_path):
+    for f in os.listdir(scratch_path):
+        utils.remove_file(os.path.join(scratch_path, f))
+    os.rmdir(scratch_path)
+
+
+def remove_scratch_root(output_path):
+    # only remove the scratch root if every job directory has been ingested
+    root = scratch_root(output_path)
+    if os.path.isdir(root) and not os.listdir(root):
+        os.rmdir(root)
+
+
+# Manifests
+def write_manifest(job):
+    """
+    Create the scratch directory of a job and describe the files the job is expected to write into it.
+    Files left over from an earlier attempt of the job are removed.
+    """
+    if os.path.exists(job.scratch_path):
+        for f in os.listdir(job.scratch_path):
+            utils.remove_file(os.path.join(job.scratch_path, f))
+    else:
+        os.makedirs(job.scratch_path)
+
+    manifest = {
+        'job': job.index,
+        'prefix': utils.get_filename(job.model),
+        'start_seed': job.start_seed,
+        'number_samples': job.number_samples,
+        'file_extension': '.obj' if job.export else '.png',
+        'files_per_sample': 1 if job.export else job.views,
+        'graphs': 'graph' in job.render_options,  # a graph file per sample next to its views
+    }
+    with open(os.path.join(job.scratch_path, MANIFEST_NAME), 'w') as m:
+        json.dump(manifest, m, indent=2)
+    return manifest
+
+
+def read_manifest(scratch_path):
+    with open(os.path.join(scratch_path, MANIFEST_NAME)) as m:
+        return json.load(m)
+
+
+def manifest_size(manifest):
+    # number of files a job is expected to write
+    return manifest['number_samples'] * manifest['files_per_sample']
+
+
+def manifest_files(scratch_path):
+    """
+    Match the files in a scratch directory against its manifest.
+    Returns the expected files sorted by seed and name as well as the number of missing files.
+    """
+    manifest = read_manifest(scratch_path)
+    prefix = manifest['prefix'] + '_'
+    seeds = range(manifest['start_seed'], manifest['start_seed'] + manifest['number_samples'])
+
+    found = []
+    for f in os.listdir(scratch_path):
+        name, extension = os.path.splitext(f)
+        if extension != manifest['file_extension'] or not name.startswith(prefix):
+            continue
+        # file names are <model>_<seed>_<angle>.png or <model>_<seed>.obj
+        seed = name[len(prefix):].split('_')[0]
+        if seed.isdigit() and int(seed) in seeds:
+            found.append((int(seed), name, os.path.join(scratch_path, f)))
+
+    return [f for _, _, f in sorted(found)], max(0, manifest_size(manifest) - len(found))
+
+
+def graph_file(scratch_path, manifest, seed):
+    return os.path.join(scratch_path, manifest['prefix'] + '_' + str(seed) + skeleton_graph.GRAPH_EXTENSION)
+
+
+def manifest_graphs(scratch_path):
+    """
+    Graph files of a job that exports tree graphs sorted by seed, and the number of missing graphs.
+    """
+    manifest = read_manifest(scratch_path)
+    if not manifest.get('graphs'):
+        return [], 0
+    seeds = range(manifest['start_seed'], manifest['start_seed'] + manifest['number_samples'])
+    found = [f for f in (graph_file(scratch_path, manifest, seed) for seed in seeds) if os.path.exists(f)]
+    return found, len(seeds) - len(found)
+
+
+def missing_seeds(scratch_path, names=None):
+    """
+    Seeds of a job with fewer files than views or without their graph, counted from the files in its scratch
+    directory or from the given sample names, e.g. of streamed pixels.
+    """
+    manifest = read_manifest(scratch_path)
+    if names is None:
+        names = manifest_files(scratch_path)[0]
+    prefix = manifest['prefix'] + '_'
+    counts = {}
+    for name in set(utils.get_filename(n) for n in names):
+        seed = name[len(prefix):].split('_')[0] if name.startswith(prefix) else ''
+        if seed.isdigit():
+            counts[int(seed)] = counts.get(int(seed), 0) + 1
+    seeds = range(manifest['start_seed'], manifest['start_seed'] + manifest['number_samples'])
+    return [seed for seed in seeds if counts.get(seed, 0) < manifest['files_per_sample'] or
+            (manifest.get('graphs') and not os.path.exists(graph_file(scratch_path, manifest, seed)))]
+
+
+def discard_seeds(scratch_path, seeds):
+    # remove the files of incomplete seeds before they are rendered again, possibly from other view angles
+    seeds = set(seeds)
+    manifest = read_manifest(scratch_path)
+    prefix = manifest['prefix'] + '_'
+    for f in manifest_files(scratch_path)[0]:
+        if int(utils.get_filename(f)[len(prefix):].split('_')[0]) in seeds:
+            utils.remove_file(f)
+    if manifest.get('graphs'):
+        for f in [graph_file(scratch_path, manifest, seed) for seed in seeds]:
+            if os.path.exists(f):
+                utils.remove_file(f)
+
+
+# Ingestion
+class Ingestor(threading.Thread):
+    """
+    Background stage that streams the files of finished jobs into the open output file while the next jobs are still
+    rendering. Jobs are ingested strictly in the order they are put, and the ingestor is the only one writing into
+    the output file.
+
+    Skeletons and downsampled images are computed from the decoded images of every job in a process pool. A job is
+    only written once they are ready, the next jobs are decoded meanwhile.
+
+    Jobs rendered with a pixel stream (see pixel_stream.py) are put together with their names and images, which are
+    stored without any files.
+
+    The tree graphs of jobs that export them are stored next to the samples, in the graph group of the hdf5 file or
+    the directory graphs/ of the zip file.
+    """
+
+    _STOP = None
+
+    def __init__(self, open_file, file_type, image_format='L', ledger=None, skip_existing=False, skeleton_mode=None,
+                 image_sizes=(), downsample_mode='area', process_workers=None, packed=False):
+        super().__init__(name='ingestor', daemon=True)
+        self.open_file = open_file
+        self.file_type = file_type
+        self.image_format = image_format
+        self.ledger = ledger
+        self.skip_existing = skip_existing
+        self.packed = packed  # bit packed hdf5 datasets
+        self.jobs = Queue()
+        self.error = None
+        self.ingested_files = 0
+        self.missing_files = 0
+        # bytes the output file grew by since the ingestor started
+        self.initial_size = self.output_size()
+        self.bytes_written = 0
+
+        if skeleton_mode is not None and skeleton_mode not in SKELETON_MODES:
+            raise ValueError('unknown skeleton mode: ' + str(skeleton_mode))
+        if file_type == file_utils.FileType.TAR and (skeleton_mode or image_sizes):
+            raise ValueError('shards store the rendered files only, no skeletons or downsampled images')
+        self.graph_writer = None
+        self.skeleton_mode = skeleton_mode
+        self.image_sizes = tuple(image_sizes)  # smaller sizes the rendered images are downsampled to
+        self.downsample_mode = downsample_mode
+        self.process_pool = None
+        if skeleton_mode or self.image_sizes:
+            self.process_pool = ProcessPoolExecutor(process_workers)
+        self.processed_jobs = deque()  # (job, samples, file_list, names, images, future) in job order
+
+    def put(self, job, streamed=None):
+        # streamed: (names, images) of a job that sent its pixels instead of writing files
+        self.jobs.put((job, streamed))
+
+    def output_size(self):
+        path = str(self.open_file.filename)
+        try:
+            if os.path.isdir(path):
+                # shard directory
+                return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            return os.path.getsize(path)
+        except (OSError, TypeError):
+            return 0
+
+    def queue_depth(self):
+        return self.jobs.qsize() + len(self.processed_jobs)
+
+    def ingest(self, job, streamed=None):
+        if streamed is None:
+            file_list, missing = manifest_files(job.scratch_path)
+            samples = [(utils.get_filename_with_extension(f), utils.file_checksum(f)) for f in file_list]
+            images = None
+        else:
+            file_list = []
+            # same order as the files of manifest_files: by seed, then by name
+            stream_names, images = streamed
+            order = sorted(range(len(stream_names)), key=lambda i: (file_utils.parse_sample_name(stream_names[i])[1],
+                                                                  utils.get_filename(stream_names[i])))
+            stream_names, images = [stream_names[i] for i in order], images[order]
+            missing = max(0, manifest_size(read_manifest(job.scratch_path)) - len(stream_names))
+            samples = [(name, pixel_stream.checksum(pixels)) for name, pixels in zip(stream_names, images)]
+        names = [utils.get_filename(name) for name, _ in samples]
+        missing += manifest_graphs(job.scratch_path)[1]
+
+        if missing:
+            # incomplete jobs are not stored, the scratch directory is kept and the job is redone on resume
+            print('warning: job %d is missing %d files, not stored' % (job.index, missing), flush=True)
+            self.missing_files += missing
+            if self.ledger is not None:
+                self.ledger.failed(job, 'missing %d files' % missing)
+            return
+
+        if self.process_pool is not None:
+            if images is None:
+                images = file_utils.read_images(file_list, self.image_format)
+            future = self.process_pool.submit(image_processing.derived_images, images, self.skeleton_mode is not None,
+                                              self.image_sizes, self.downsample_mode)
+            self.processed_jobs.append((job, samples, file_list, names, images, future))
+            self.store_processed()
+            return
+
+        if images is not None:
+            self.store_images(images, names)
+        elif self.file_type == file_utils.FileType.ZIP:
+            file_utils.save_file_list_to_zip(self.open_file, file_list, skip_existing=self.skip_existing)
+        elif self.file_type == file_utils.FileType.TAR:
+            self.open_file.add_files(file_list, skip_existing=self.skip_existing)
+            file_utils.remove_files(file_list)
+        else:
+            file_utils.save_image_list_to_hdf5(self.open_file, file_list, scipy_format=self.image_format, packed=self.packed)
+        self.finish(job, samples, file_list)
+
+    def store_processed(self, wait=False):
+        # write the jobs at the head of the queue whose derived images are ready, keeping the job order
+        while self.processed_jobs and (wait or self.processed_jobs[0][-1].done()):
+            job, samples, file_list, names, images, future = self.processed_jobs.popleft()
+            skeletons, downsampled = future.result()
+
+            if self.file_type == file_utils.FileType.ZIP:
+                if self.skeleton_mode == 'replace':
+                    file_utils.save_arrays_to_zip(self.open_file, skeletons, names, 'samples', self.skip_existing)
+                    file_utils.remove_files(file_list)
+                elif file_list:
+                    file_utils.save_file_list_to_zip(self.open_file, file_list, skip_existing=self.skip_existing)
+                else:
+                    self.store_images(images, names)
+                if self.skeleton_mode == 'add':
+                    file_utils.save_arrays_to_zip(self.open_file, skeletons, names, 'skeletons', self.skip_existing)
+                for size, sized_images in sorted(downsampled.items()):
+                    file_utils.save_arrays_to_zip(self.open_file, sized_images, names,
+                                                  file_utils.sized_name('samples', size), self.skip_existing)
+            else:
+                self.store_images(skeletons if self.skeleton_mode == 'replace' else images, names)
+                if self.skeleton_mode == 'add':
+                    file_utils.save_rows_to_hdf5(self.open_file, file_utils.SKELETONS, skeletons, packed=self.packed)
+                for size, sized_images in sorted(downsampled.items()):
+                    # only thresholded images are binary
+                    file_utils.save_rows_to_hdf5(self.open_file, file_utils.sized_name(file_utils.IMAGES, size), sized_images,
+                                                 packed=self.packed and self.downsample_mode == 'threshold',
+                                                 downsample_mode=self.downsample_mode)
+                file_utils.remove_files(file_list)
+
+            self.finish(job, samples, file_list)
+
+    def store_images(self, images, names):
+        # in-memory images as members or rows of their own, like images read from files
+        if self.file_type == file_utils.FileType.ZIP:
+            file_utils.save_arrays_to_zip(self.open_file, images, names, 'samples', self.skip_existing)
+        else:
+            writer = file_utils.SampleWriter(self.open_file, self.image_format, packed=self.packed)
+            writer.append_batch(images, names)
+            writer.flush()
+
+    def store_graphs(self, graph_files):
+        # returns the graph rows (start, stop) of an hdf5 file
+        if self.file_type == file_utils.FileType.ZIP:
+            file_utils.save_file_list_to_zip(self.open_file, graph_files, 'graphs', skip_existing=self.skip_existing)
+            return None
+        if self.file_type != file_utils.FileType.HDF5:
+            raise ValueError('tree graphs are stored in hdf5 and zip files only')
+        if self.graph_writer is None:
+            self.graph_writer = file_utils.GraphWriter(self.open_file)
+        start = len(self.graph_writer)
+        for f in graph_files:
+            self.graph_writer.append(skeleton_graph.read_graph(f), f)
+        self.graph_writer.flush()
+        return start, len(self.graph_writer)
+
+    def finish(self, job, samples, file_list):
+        graph_rows = None
+        graph_files = manifest_graphs(job.scratch_path)[0]
+        if graph_files:
+            graph_rows = self.store_graphs(graph_files)
+
+        # make sure the hdf5 rows or the shards and their index are on disk before the job counts as done
+        if self.file_type != file_utils.FileType.ZIP:
+            self.open_file.flush()
+        if self.ledger is not None:
+            rows = None
+            if self.file_type == file_utils.FileType.HDF5:
+                # the rows of the job are the last ones written
+                stop = file_utils.number_rows(self.open_file)
+                rows = (stop - len(samples), stop)
+            self.ledger.done(job, samples, rows, graph_rows)
+
+        remove_scratch_directory(job.scratch_path)
+        self.ingested_files += len(file_list)
+        self.bytes_written = self.output_size() - self.initial_size
+
+    def next_job(self):
+        # while derived images are pending, wake up regularly to store them even if no new job arrives
+        if not self.processed_jobs:
+            return self.jobs.get()
+        while True:
+            try:
+                return self.jobs.get(timeout=0.1)
+            except Empty:
+                if self.error is None:
+                    try:
+                        self.store_processed()
+                    except Exception as e:
+                        self.error = e
+
+    def run(self):
+        while True:
+            item = self.next_job()
+            if item is self._STOP:
+                break
+            # keep draining the queue after an error so that producers never block, but stop writing
+            if self.error is None:
+                try:
+                    self.ingest(*item)
+                except Exception as e:
+                    self.error = e
+
+        if self.error is None:
+            try:
+                self.store_processed(wait=True)
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        self.jobs.put(self._STOP)
+        self.join()
+        if self.process_pool is not None:
+            self.process_pool.shutdown()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# persistent record of the state of every job of a sample generation run
+#
+# The ledger is a json lines file next to the output file. For every job it holds the job's identity (model and seed
+# range), its state (pending, running, done, failed) and, once done, the samples it produced with their checksums and,
+# for hdf5 files, the rows [start, stop) it was stored in and those of its tree graphs. Every state change is appended
+# as one line with the changed values, the file is compacted to one line per job when a run starts.
+# A resumed run skips the done jobs and only redoes the missing work. Redone jobs are appended behind the rows of the
+# others, so the rows of a resumed hdf5 file are not necessarily in job order; the rows of the ledger tell which rows
+# to keep.
+
+import os
+import json
+import threading
+from collections import OrderedDict
+from time import time
+
+import utils
+
+__author__ = "Andrin Jenal"
+__copyright__ = "Copyright 2016, ETH Zurich"
+__license__ = "GPL"
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+LEDGER_EXTENSION = '.ledger.jsonl'
+
+
+def ledger_path(output_path, file_name):
+    return os.path.join(output_path, file_name + LEDGER_EXTENSION)
+
+
+def job_identity(job):
+    return {'model': os.path.basename(job.model), 'start_seed': job.start_seed, 'number_samples': job.number_samples}
+
+
+class JobLedger:
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+        self.log = None  # the file the changes are appended to
+
+    @staticmethod
+    def load(path):
+        ledger = JobLedger(path)
+        with open(path) as _file:
+            for line in _file:
+                try:
+                    values = json.loads(line)
+                except ValueError:  # the last line of an interrupted run may be cut short
+                    continue
+                ledger.jobs.setdefault(values.pop('job'), {}).update(values)
+        return ledger
+
+    def register(self, job_list, resume=False):
+        """
+        Add the jobs of a run. When resuming, existing entries are kept but have to describe the same jobs, i.e. the
+        run has to be started with the same arguments.
+        """
+        with self.lock:
+            for job in job_list:
+                key = str(job.index)
+                entry = self.jobs.get(key)
+                if resume and entry is not None:
+                    if dict((k, entry[k]) for k in job_identity(job)) != job_identity(job):
+                        raise ValueError('ledger %s does not match job %d, resume with the same arguments' % (self.path, job.index))
+                    # a job that was running when the last run stopped has to be redone
+                    if entry['state'] == RUNNING:
+                        entry['state'] = FAILED
+                        entry['error'] = 'interrupted'
+                else:
+                    entry = job_identity(job)
+                    entry['state'] = PENDING
+                    self.jobs[key] = entry
+            self.save()
+
+    def save(self):
+        # one line per job, replaces the file and the changes appended to it
+        self.close()
+        lines = [json.dumps(dict(entry, job=key)) + '\n' for key, entry in self.jobs.items()]
+        utils.atomic_write(self.path, lambda _file: _file.writelines(lines))
+
+    def append(self, key, values):
+        if self.log is None:
+            self.log = open(self.path, 'a')
+        self.log.write(json.dumps(dict(values, job=key)) + '\n')
+        self.log.flush()
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    def update(self, job, state, **values):
+        with self.lock:
+            key = str(job.index)
+            values.update(state=state, updated=time())
+            self.jobs[key].update(values)
+            self.append(key, values)
+
+    def running(self, job):
+        self.update(job, RUNNING, error=None)
+
+    def done(self, job, samples, rows=None, graph_rows=None):
+        """ samples: list of (name, checksum), rows and graph_rows: (start, stop) of the samples and graphs in an hdf5 file """
+        values = {'samples': [list(s) for s in samples], 'error': None}
+        if rows is not None:
+            values['rows'] = list(rows)
+        if graph_rows is not None:
+            values['graph_rows'] = list(graph_rows)
+        self.update(job, DONE, **values)
+
+    def failed(self, job, error):
+        self.update(job, FAILED, error=str(error))
+
+    def verify(self, stored_names):
+        """
+        Mark done jobs as failed if any of their samples is missing from the output file.
+        stored_names holds the names of the stored samples without file extension.
+        """
+        with self.lock:
+            for entry in self.jobs.values():
+                if entry['state'] != DONE:
+                    continue
+                if any(os.path.splitext(name)[0] not in stored_names for name, _ in entry.get('samples', [])):
+                    entry['state'] = FAILED
+                    entry['error'] = 'samples missing from output file'
+            self.save()
+
+    def state(self, job):
+        entry = self.jobs.get(str(job.index))
+        return entry['state'] if entry else PENDING
+
+    def is_done(self, job):
+        return self.state(job) == DONE
+
+    def jobs_in_state(self, state):
+        return [int(key) for key, entry in self.jobs.items() if entry['state'] == state]
+
+    def verify_rows(self, row_names, number_graphs=0):
+        """
+        Check the rows of the done jobs against the sample names of the rows of an hdf5 file, row_names, and the
+        number of graphs it holds. Returns the number of rows and of graphs to keep, those of the done jobs up to the
+        first one whose rows are gone or hold other samples; that job and every done job stored behind it are marked
+        as failed. The rows behind belong to a job that was only partially stored when the last run stopped.
+        """
+        with self.lock:
+            done = sorted((entry['rows'], key) for key, entry in self.jobs.items() if entry['state'] == DONE and 'rows' in entry)
+            keep, keep_graphs = 0, 0
+            for (start, stop), key in done:
+                entry = self.jobs[key]
+                graph_start, graph_stop = entry.get('graph_rows', (keep_graphs, keep_graphs))
+                if (start == keep and row_names[start:stop] == [os.path.splitext(name)[0] for name, _ in entry['samples']] and
+                        graph_start == keep_graphs and graph_stop <= number_graphs):
+                    keep, keep_graphs = stop, graph_stop
+                else:
+                    entry['state'] = FAILED
+                    entry['error'] = 'samples missing from output file'
+            self.save()
+        return keep, keep_graphs
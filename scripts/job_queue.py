@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+# job queue shared by several hosts, for building one dataset on many render machines
+#
+# A coordinator enqueues the jobs of create_job_list into an SQLite database on a shared file system. Any number of
+# worker processes, on any host, claim pending jobs one at a time inside an immediate transaction, so no job is
+# claimed twice. A claim is a lease: the worker renews it with heartbeats while the job renders, a lease that was not
+# renewed in time belongs to a dead worker and its job is claimed again. Every job is rendered into a scratch
+# directory of its worker and stored as a shard of its own (shards/<filename>_job_<index>.h5, .zip or .shards), so workers
+# never write the same file. The merge step appends the shards in job order into the final output file.
+#
+# SQLite needs a file system with working POSIX locks (most NFSv4 setups, not every NFSv3 mount), and lease expiry
+# compares the clocks of different hosts, which should be kept in sync.
+
+import os
+import json
+import socket
+import sqlite3
+import threading
+from time import time, sleep
+
+import file_utils
+import ingest
+import shards
+
+__author__ = "Andrin Jenal"
+__copyright__ = "Copyright 2016, ETH Zurich"
+__license__ = "GPL"
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+LEASE_SECONDS = 120.0  # a worker that did not renew its lease for this long is considered dead
+MAX_ATTEMPTS = 3  # failed jobs are claimed again until they failed this often
+POLL_SECONDS = 5.0  # wait between two claims while other workers still hold leases
+SHARD_DIRECTORY = 'shards'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    job_index INTEGER PRIMARY KEY,
+    job TEXT NOT NULL,
+    state TEXT NOT NULL,
+    owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    shard TEXT,
+    error TEXT,
+    updated REAL
+)
+'''
+
+
+def worker_id():
+    # unique per process and host, also names the worker's scratch directory
+    return '%s_%d' % (socket.gethostname(), os.getpid())
+
+
+# Jobs
+def encode_job(job):
+    # without the blender executable of args[0], every worker runs its own
+    values = job._asdict()
+    values['args'] = list(job.args[1:])
+    return json.dumps(values)
+
+
+def decode_job(job_class, text, blender):
+    values = json.loads(text)
+    # json turns tuples into lists
+    for field in ('plan', 'cache', 'render_options'):
+        if values[field] is not None:
+            values[field] = tuple(values[field])
+    values['args'] = [blender] + values['args']
+    return job_class(**values)
+
+
+def worker_job(job, output_path, owner):
+    """
+    The job with a scratch directory of its own worker, a job claimed again after its lease expired may still be
+    rendered by the dead-looking worker.
+    """
+    scratch_path = os.path.join(ingest.scratch_root(output_path), owner, 'job_%05d' % job.index, '')
+    args = [scratch_path if a == job.scratch_path else a for a in job.args]
+    return job._replace(scratch_path=scratch_path, args=args)
+
+
+def shard_prefix(output_path, file_name, job):
+    # file_utils.new_file adds the extension
+    return os.path.join(output_path, SHARD_DIRECTORY, '%s_job_%05d' % (file_name, job.index))
+
+
+class JobQueue:
+
+    def __init__(self, path, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # autocommit, transactions are started explicitly
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()  # the heartbeat thread shares the connection
+        with self.lock:
+            self.connection.execute(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def transaction(self, statements):
+        # run (sql, parameters) statements in one immediate transaction, returns the row count of the last one
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                for sql, parameters in statements:
+                    cursor.execute(sql, parameters)
+                rowcount = cursor.rowcount
+                cursor.execute('COMMIT')
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+            return rowcount
+
+    def enqueue(self, job_list):
+        """
+        Add the jobs of a run. Enqueuing the same jobs again, e.g. after a restart of the coordinator, changes
+        nothing; a queue that holds different jobs is refused.
+        """
+        with self.lock:
+            existing = dict(self.connection.execute('SELECT job_index, job FROM jobs').fetchall())
+        added = []
+        for job in job_list:
+            if job.index in existing:
+                if existing[job.index] != encode_job(job):
+                    raise ValueError('queue %s holds a different job %d, enqueue with the same arguments' % (self.path, job.index))
+                continue
+            added.append(('INSERT INTO jobs (job_index, job, state, updated) VALUES (?, ?, ?, ?)',
+                          (job.index, encode_job(job), PENDING, time())))
+        if added:
+            self.transaction(added)
+        return len(added)
+
+    def claim(self, owner, job_class, blender):
+        """
+        Lease the first job that is pending, failed fewer than max_attempts times or whose lease expired.
+        Returns the job, run with the blender executable of this worker, or None.
+        """
+        now = time()
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                row = cursor.execute('SELECT job_index, job FROM jobs WHERE state = ? OR (state = ? AND attempts < ?) OR '
+                                     '(state = ? AND lease_expires < ?) ORDER BY job_index LIMIT 1',
+                                     (PENDING, FAILED, self.max_attempts, LEASED, now)).fetchone()
+                if row is not None:
+                    cursor.execute('UPDATE jobs SET state = ?, owner = ?, lease_expires = ?, attempts = attempts + 1, '
+                                   'error = NULL, updated = ? WHERE job_index = ?',
+                                   (LEASED, owner, now + self.lease_seconds, now, row[0]))
+                cursor.execute('COMMIT')
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+        return decode_job(job_class, row[1], blender) if row is not None else None
+
+    def renew(self, job, owner):
+        # extend the lease, False if the lease was lost to another worker
+        return self.transaction([('UPDATE jobs SET lease_expires = ?, updated = ? WHERE job_index = ? AND owner = ? AND state = ?',
+                                  (time() + self.lease_seconds, time(), job.index, owner, LEASED))]) == 1
+
+    def done(self, job, owner, shard):
+        return self.transaction([('UPDATE jobs SET state = ?, shard = ?, lease_expires = NULL, updated = ? '
+                                  'WHERE job_index = ? AND owner = ? AND state = ?',
+                                  (DONE, shard, time(), job.index, owner, LEASED))]) == 1
+
+    def failed(self, job, owner, error):
+        self.transaction([('UPDATE jobs SET state = ?, error = ?, lease_expires = NULL, updated = ? '
+                           'WHERE job_index = ? AND owner = ? AND state = ?',
+                           (FAILED, str(error), time(), job.index, owner, LEASED))])
+
+    def counts(self):
+        with self.lock:
+            counts = dict(self.connection.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+            retries_left = self.connection.execute('SELECT COUNT(*) FROM jobs WHERE state = ? AND attempts < ?',
+                                                   (FAILED, self.max_attempts)).fetchone()[0]
+        counts['retryable'] = retries_left
+        return counts
+
+    def finished(self):
+        # nothing left to claim now or later: every job is done or failed for good
+        counts = self.counts()
+        return not counts.get(PENDING) and not counts.get(LEASED) and not counts['retryable']
+
+    def shards(self):
+        # shards of the done jobs in job order and the indices of the jobs that are not done
+        with self.lock:
+            rows = self.connection.execute('SELECT job_index, state, shard FROM jobs ORDER BY job_index').fetchall()
+        return [shard for _, state, shard in rows if state == DONE], [i for i, state, _ in rows if state != DONE]
+
+
+class Heartbeat(threading.Thread):
+    """
+    Renews the lease of a job every third of the lease time until stopped.
+    """
+
+    def __init__(self, queue, job, owner):
+        super().__init__(name='heartbeat-%d' % job.index, daemon=True)
+        self.queue = queue
+        self.job = job
+        self.owner = owner
+        self.stopped = threading.Event()
+        self.lost = False
+
+    def run(self):
+        while not self.stopped.wait(self.queue.lease_seconds / 3.0):
+            if not self.queue.renew(self.job, self.owner):
+                print('lease of job %d lost' % self.job.index, flush=True)
+                self.lost = True
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def store_shard(job, output_path, file_name, file_type, owner, ingest_options, shard_size=None):
+    """
+    Ingest the rendered files of a job into a shard of its own. The shard is written under a temporary name and
+    renamed when complete. Returns the shard path or None if files are missing.
+    """
+    prefix = shard_prefix(output_path, file_name, job)
+    if not os.path.exists(os.path.dirname(prefix)):
+        os.makedirs(os.path.dirname(prefix), exist_ok=True)
+
+    tmp_prefix = prefix + '.' + owner
+    with file_utils.new_file(tmp_prefix, file_type, shard_size=shard_size) as open_file:
+        ingestor = ingest.Ingestor(open_file, file_type, **ingest_options)
+        ingestor.start()
+        ingestor.put(job)
+        ingestor.close()
+        tmp_path = str(open_file.filename)
+    extension = os.path.splitext(tmp_path)[1]
+    if ingestor.missing_files:
+        if file_type == file_utils.FileType.TAR:
+            shards.remove_shards(tmp_path)
+        else:
+            file_utils.remove_files([tmp_path])
+        return None
+    # os.replace only replaces empty directories, e.g. the shard directory of a job that was redone
+    shards.remove_shards(prefix + extension)
+    os.replace(tmp_path, prefix + extension)
+    return prefix + extension
+
+
+def work(queue_path, output_path, file_name, file_type, runner, job_class, blender, threads=1, ingest_options=None,
+         lease_seconds=LEASE_SECONDS, poll_seconds=POLL_SECONDS, shard_size=None):
+    """
+    Claim, render and store jobs on threads worker threads until the queue is finished. runner(job) renders a job with
+    the blender executable of this worker, e.g. sample_generation.timed_job_runner, and raises if it failed. shard_size
+    is the number of samples per tar shard of FileType.TAR. Returns the number of jobs this process completed.
+    """
+    owner = worker_id()
+    completed = []
+    stopping = threading.Event()  # set on Ctrl-C, no further jobs are claimed
+
+    def work_thread(n):
+        queue = JobQueue(queue_path, lease_seconds)
+        thread_owner = '%s_%d' % (owner, n)
+        try:
+            while not stopping.is_set():
+                job = queue.claim(thread_owner, job_class, blender)
+                if job is None:
+                    if queue.finished():
+                        return
+                    sleep(poll_seconds)
+                    continue
+
+                heartbeat = Heartbeat(queue, job, thread_owner)
+                heartbeat.start()
+                try:
+                    local_job = worker_job(job, output_path, thread_owner)
+                    runner(local_job)
+                    shard = store_shard(local_job, output_path, file_name, file_type, thread_owner, ingest_options or {},
+                                        shard_size)
+                except Exception as e:
+                    heartbeat.stop()
+                    print('job %d failed: %s\n' % (job.index, e), flush=True)
+                    queue.failed(job, thread_owner, e)
+                    continue
+                heartbeat.stop()
+
+                if shard is None:
+                    queue.failed(job, thread_owner, 'missing files')
+                elif queue.done(job, thread_owner, os.path.relpath(shard, output_path)):
+                    completed.append(job.index)
+                    print('job %d stored in %s\n' % (job.index, shard), flush=True)
+                else:
+                    # the lease expired meanwhile, the job belongs to another worker now
+                    print('job %d was claimed by another worker, %s is not registered\n' % (job.index, shard), flush=True)
+        finally:
+            queue.close()
+            # the job directories are removed once ingested
+            try:
+                os.rmdir(os.path.join(ingest.scratch_root(output_path), thread_owner))
+            except OSError:
+                pass
+
+    workers = [threading.Thread(target=work_thread, args=(n,), name='queue-worker-%d' % n) for n in range(threads)]
+    for w in workers:
+        w.start()
+    try:
+        for w in workers:
+            w.join()
+    except KeyboardInterrupt:
+        stopping.set()
+        raise
+    ingest.remove_scratch_root(output_path)
+    return len(completed)
+
+
+def merge(queue_path, output_path, file_name, file_type):
+    """
+    Append the shards of all done jobs in job order into the output file. Refuses to merge while jobs are not done.
+    """
+    queue = JobQueue(queue_path)
+    try:
+        done_shards, missing = queue.shards()
+    finally:
+        queue.close()
+    if missing:
+        raise RuntimeError('%d jobs are not done yet: %s' % (len(missing), missing))
+
+    shard_files = [os.path.join(output_path, shard) for shard in done_shards]
+    with file_utils.new_file(os.path.join(output_path, file_name), file_type) as open_file:
+        if file_type == file_utils.FileType.HDF5:
+            file_utils.merge_hdf5_files(open_file, shard_files)
+        elif file_type == file_utils.FileType.TAR:
+            # the tar shards of the jobs are linked, not copied, the last shard of every job may be smaller
+            shards.merge_shards(open_file, shard_files)
+        else:
+            file_utils.merge_zip_files(open_file, shard_files)
+        return str(open_file.filename)
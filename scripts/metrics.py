@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# throughput metrics and remaining time estimate of a sample generation run
+#
+# Later jobs of a species render more complex trees (see sample_plan.complexity_variation) and take longer, so the
+# mean job time underestimates the remaining time. The estimate here models the time per sample as a function of the
+# job's position within its species: the level is an exponentially weighted moving average (EWMA) of the finished
+# jobs, the trend a least squares slope over all of them. Metrics are written periodically as json and in the
+# Prometheus text format, e.g. for the node exporter's textfile collector.
+
+import json
+import threading
+import numpy as np
+from time import time
+
+import utils
+
+__author__ = "Andrin Jenal"
+__copyright__ = "Copyright 2016, ETH Zurich"
+__license__ = "GPL"
+
+EWMA_ALPHA = 0.3  # weight of the latest job
+WRITE_INTERVAL = 10.0  # seconds between two metrics files
+METRICS_EXTENSION = '.metrics.json'
+PROMETHEUS_EXTENSION = '.metrics.prom'
+PROMETHEUS_PREFIX = 'treenet_'
+
+
+def complexity(job):
+    # relative position of the job's samples within its species, 0 for the first and 1 for the last sample
+    return (job.start_seed + job.number_samples * 0.5) / float(max(job.total_samples, 1))
+
+
+def sample_seconds(job, elapsed):
+    return elapsed / max(job.number_samples, 1)
+
+
+def ewma(average, value, alpha=EWMA_ALPHA):
+    return value if average is None else alpha * value + (1 - alpha) * average
+
+
+class Metrics:
+
+    def __init__(self, job_list, workers=1, path_prefix=None, interval=WRITE_INTERVAL):
+        self.jobs = dict((job.index, job) for job in job_list)
+        self.remaining = set(self.jobs)
+        self.workers = max(1, workers)
+        self.path_prefix = path_prefix
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.start_time = time()
+
+        self.counters = {'jobs_done': 0, 'jobs_failed': 0, 'samples_done': 0, 'bytes_written': 0}
+        self.gauges = {'queue_depth': 0, 'max_queue_depth': 0}
+        self.job_seconds = []  # seconds of every finished job
+        self.finished_jobs = []  # (job, seconds) of every finished job, e.g. for scheduler.record_timings
+        self.sample_seconds = []  # (complexity, seconds per sample, samples) of every finished job
+
+        # EWMA level of the seconds per sample and of the complexity it was measured at
+        self.level = None
+        self.level_complexity = None
+        self.rate = None  # EWMA of samples per second, measured between job completions
+        self.last_completion = self.start_time
+
+        self.stop_event = threading.Event()
+        self.writer = None
+
+    # Recording
+    def job_done(self, job, elapsed):
+        with self.lock:
+            self.remaining.discard(job.index)
+            self.counters['jobs_done'] += 1
+            self.counters['samples_done'] += job.number_samples
+            self.job_seconds.append(elapsed)
+            self.finished_jobs.append((job, elapsed))
+
+            per_sample = sample_seconds(job, elapsed)
+            self.sample_seconds.append((complexity(job), per_sample, job.number_samples))
+            self.level = ewma(self.level, per_sample)
+            self.level_complexity = ewma(self.level_complexity, complexity(job))
+
+            now = time()
+            self.rate = ewma(self.rate, job.number_samples / max(now - self.last_completion, 1e-6))
+            self.last_completion = now
+
+    def job_failed(self, job):
+        with self.lock:
+            self.remaining.discard(job.index)
+            self.counters['jobs_failed'] += 1
+
+    def set_bytes_written(self, bytes_written):
+        with self.lock:
+            self.counters['bytes_written'] = bytes_written
+
+    def set_queue_depth(self, depth):
+        with self.lock:
+            self.gauges['queue_depth'] = depth
+            self.gauges['max_queue_depth'] = max(self.gauges['max_queue_depth'], depth)
+
+    # Estimates
+    def trend(self):
+        # least squares slope of the seconds per sample over the complexity, weighted by the number of samples
+        if len(self.sample_seconds) < 3:
+            return 0.0
+        x, y, w = [np.array(column, dtype=np.float64) for column in zip(*self.sample_seconds)]
+        if np.ptp(x) < 1e-9:
+            return 0.0
+        x_mean = np.average(x, weights=w)
+        return np.sum(w * (x - x_mean) * (y - np.average(y, weights=w))) / np.sum(w * (x - x_mean) ** 2)
+
+    def seconds_per_sample(self, job_complexity, slope=None):
+        slope = self.trend() if slope is None else slope
+        return max(0.0, self.level + slope * (job_complexity - self.level_complexity))
+
+    def eta(self):
+        """
+        Estimated seconds until all remaining jobs are done, None before the first job finished.
+        """
+        with self.lock:
+            if self.level is None:
+                return None
+            slope = self.trend()
+            seconds = sum(self.jobs[i].number_samples * self.seconds_per_sample(complexity(self.jobs[i]), slope)
+                          for i in self.remaining)
+            return seconds / self.workers
+
+    def snapshot(self):
+        eta = self.eta()
+        with self.lock:
+            elapsed = time() - self.start_time
+            values = dict(self.counters)
+            values.update(self.gauges)
+            values.update({
+                'jobs_total': len(self.jobs),
+                'jobs_remaining': len(self.remaining),
+                'elapsed_seconds': elapsed,
+                'samples_per_second': self.counters['samples_done'] / max(elapsed, 1e-6),
+                'samples_per_second_ewma': self.rate or 0.0,
+                'seconds_per_sample_ewma': self.level or 0.0,
+                'seconds_per_sample_trend': self.trend(),
+                'eta_seconds': eta if eta is not None else -1,
+            })
+            return values
+
+    # Output
+    def write(self):
+        if not self.path_prefix:
+            return
+        values = self.snapshot()
+        utils.atomic_write(self.path_prefix + METRICS_EXTENSION, lambda _file: json.dump(values, _file, indent=1, sort_keys=True))
+        utils.atomic_write(self.path_prefix + PROMETHEUS_EXTENSION, lambda _file: _file.write(prometheus_text(values)))
+
+    def start(self):
+        # write the metrics files every interval seconds until stop
+        def run():
+            while not self.stop_event.wait(self.interval):
+                self.write()
+
+        if self.path_prefix:
+            self.writer = threading.Thread(target=run, name='metrics-writer', daemon=True)
+            self.writer.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.writer is not None:
+            self.writer.join()
+        self.write()
+
+    def summary(self):
+        """
+        Table of the run's totals and timing distributions.
+        """
+        values = self.snapshot()
+        with self.lock:
+            job_seconds = np.array(self.job_seconds)
+            sample_seconds = np.array([s for _, s, _ in self.sample_seconds])
+
+        def quantiles(a):
+            if not len(a):
+                return '-'
+            return 'mean %.3f  p50 %.3f  p95 %.3f  max %.3f' % (a.mean(), np.percentile(a, 50), np.percentile(a, 95), a.max())
+
+        rows = [
+            ('jobs done / failed / total', '%d / %d / %d' % (values['jobs_done'], values['jobs_failed'], values['jobs_total'])),
+            ('samples done', '%d' % values['samples_done']),
+            ('elapsed seconds', '%.1f' % values['elapsed_seconds']),
+            ('samples per second', '%.2f' % values['samples_per_second']),
+            ('seconds per job', quantiles(job_seconds)),
+            ('seconds per sample', quantiles(sample_seconds)),
+            ('trend seconds per sample', '%+.4f from first to last sample of a species' % values['seconds_per_sample_trend']),
+            ('bytes written', '%d (%.2f MB/s)' % (values['bytes_written'], values['bytes_written'] / 2 ** 20 / max(values['elapsed_seconds'], 1e-6))),
+            ('max ingest queue depth', '%d' % values['max_queue_depth']),
+        ]
+        width = max(len(name) for name, _ in rows)
+        return '\n'.join('%s  %s' % (name.ljust(width), value) for name, value in rows)
+
+
+def prometheus_text(values):
+    lines = []
+    for name in sorted(values):
+        metric = PROMETHEUS_PREFIX + name
+        kind = 'counter' if name in ('jobs_done', 'jobs_failed', 'samples_done', 'bytes_written') else 'gauge'
+        lines.append('# TYPE %s %s' % (metric, kind))
+        lines.append('%s %s' % (metric, repr(float(values[name]))))
+    return '\n'.join(lines) + '\n'
+
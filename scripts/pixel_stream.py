@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# rendered pixels sent from blender to sample_generation.py over a pipe instead of image files
+#
+# A blender job started with --pixel-fd <fd> writes one record per rendered view to the inherited pipe: a header of
+# magic, height, width, channels and name length, the file name the view would have been saved as, and height * width
+# * channels uint8 pixels with the rows from top to bottom as in the png files. sample_generation.py reads the records
+# of a job while it renders and hands the images to the ingestor, which stores them like images read from files.
+# No png is encoded, written, listed, decoded or removed. Both sides only need numpy, blender imports this module too.
+
+import os
+import struct
+import hashlib
+import numpy as np
+
+__author__ = "Andrin Jenal"
+__copyright__ = "Copyright 2016, ETH Zurich"
+__license__ = "GPL"
+
+MAGIC = b'TNPX'
+HEADER = struct.Struct('<4sHHBH')  # magic, height, width, channels, name length
+PIXEL_FD_OPTION = '--pixel-fd'
+
+
+# Records
+def encode_record(name, pixels):
+    pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+    height, width = pixels.shape[:2]
+    channels = pixels.shape[2] if pixels.ndim == 3 else 1
+    name = name.encode('utf-8')
+    return HEADER.pack(MAGIC, height, width, channels, len(name)) + name + pixels.tobytes()
+
+
+def read_exact(stream, size):
+    # a pipe returns what is available, read until size bytes or the end of the stream
+    chunks = []
+    while size > 0:
+        chunk = stream.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def read_records(stream):
+    """
+    (name, pixels) of every record until the end of the stream. A record cut short, e.g. by a crashing blender, ends
+    the stream.
+    """
+    while True:
+        header = read_exact(stream, HEADER.size)
+        if len(header) < HEADER.size:
+            return
+        magic, height, width, channels, name_length = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError('not a pixel stream record')
+        name = read_exact(stream, name_length)
+        data = read_exact(stream, height * width * channels)
+        if len(name) < name_length or len(data) < height * width * channels:
+            return
+        shape = (height, width) if channels == 1 else (height, width, channels)
+        yield name.decode('utf-8'), np.frombuffer(data, dtype=np.uint8).reshape(shape)
+
+
+def read_images(stream):
+    """
+    Names and stacked images of all records of a stream.
+    """
+    names, images = [], []
+    for name, pixels in read_records(stream):
+        names.append(name)
+        images.append(pixels)
+    return names, np.array(images, dtype=np.uint8)
+
+
+def checksum(pixels):
+    # ledger checksum of a streamed image, the counterpart of utils.file_checksum
+    return hashlib.sha1(np.ascontiguousarray(pixels).tobytes()).hexdigest()
+
+
+class PixelWriter:
+    """
+    Blender side of the stream: writes records to an inherited file descriptor.
+    """
+
+    def __init__(self, fd):
+        self.stream = os.fdopen(fd, 'wb')
+
+    def write(self, name, pixels):
+        self.stream.write(encode_record(name, pixels))
+
+    def close(self):
+        self.stream.close()
+
+
+# Colour conversion
+def linear_to_srgb(values):
+    # the standard view transform blender applies when saving a png
+    return np.where(values <= 0.0031308, values * 12.92, 1.055 * np.power(values, 1.0 / 2.4) - 0.055)
+
+
+def render_to_grey(pixels, width, height, srgb=True):
+    """
+    8 bit grey image of float RGBA render pixels (rows from bottom to top, linear colours), equal to the saved png read
+    with scipy_format 'L' up to blender's dithering.
+    """
+    rgba = np.asarray(pixels, dtype=np.float32).reshape(height, width, 4)[::-1]
+    rgb = np.clip(rgba[..., :3], 0.0, 1.0)
+    if srgb:
+        rgb = linear_to_srgb(rgb)
+    rgb = np.round(rgb * 255.0).astype(np.uint32)
+    # ITU-R 601-2 luma in the fixed point arithmetic of PIL's convert('L')
+    return ((rgb[..., 0] * 19595 + rgb[..., 1] * 38470 + rgb[..., 2] * 7471 + 0x8000) >> 16).astype(np.uint8)
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# content-addressed on-disk cache of rendered samples
+#
+# A rendered view is fully determined by the final tree model, the view angle, the image size and the render mode,
+# so the hash of these is used as key. Cached files live in <cache_dir>/<first two key characters>/<key><extension>.
+# The cache is bounded in size, the least recently used files are evicted first (a hit refreshes the file's
+# modification time). Hit and miss counters of all processes using the cache are summed up in stats.json, next to a
+# running total of the cached bytes; the cache directory is only scanned once that total exceeds the size limit.
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+
+import utils
+
+try:
+    import fcntl
+except ImportError:  # no file locking available, counters of concurrent processes may get lost
+    fcntl = None
+
+__author__ = "Andrin Jenal"
+__copyright__ = "Copyright 2016, ETH Zurich"
+__license__ = "GPL"
+
+DEFAULT_MAX_BYTES = 10 * 2 ** 30
+EVICTION_INTERVAL = 100  # number of stored files between two size checks
+EVICTION_TARGET = 0.9  # a full cache is evicted down to this fraction of its size, so the next scan is far off
+STATS_NAME = 'stats.json'
+STATS_COUNTERS = ('hits', 'misses', 'stored', 'evicted')
+CACHED_BYTES = 'bytes'
+
+
+def canonical(value):
+    # json friendly, order independent representation of tree model values
+    if isinstance(value, dict):
+        return dict((str(k), canonical(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [canonical(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def sample_key(tree_model, angle, image_size, render_mode):
+    description = {'tree_model': canonical(tree_model), 'angle': canonical(angle), 'image_size': image_size, 'render_mode': render_mode}
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+class RenderCache:
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.counters = dict((c, 0) for c in STATS_COUNTERS)
+        self.stored_since_eviction = 0
+        self.stored_bytes = 0  # added to the total of stats.json with the next flush
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key, extension):
+        return os.path.join(self.cache_dir, key[:2], key + extension)
+
+    def contains(self, key, extension):
+        return os.path.isfile(self.path(key, extension))
+
+    def get(self, key, extension, destination):
+        """
+        Copy a cached file to destination. Returns False on a miss.
+        """
+        path = self.path(key, extension)
+        try:
+            shutil.copyfile(path, destination)
+            os.utime(path)  # most recently used
+        except (FileNotFoundError, OSError):
+            self.counters['misses'] += 1
+            return False
+        self.counters['hits'] += 1
+        return True
+
+    def get_all(self, keys_destinations, extension):
+        """
+        Copy a group of cached files, e.g. all views of a sample, only if every one of them is cached.
+        """
+        if all(self.contains(key, extension) for key, _ in keys_destinations):
+            if all(self.get(key, extension, destination) for key, destination in keys_destinations):
+                return True
+            return False
+        self.counters['misses'] += len(keys_destinations)
+        return False
+
+    def put(self, key, extension, source):
+        path = self.path(key, extension)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            replaced = os.path.getsize(path)  # stored by another process meanwhile
+        except FileNotFoundError:
+            replaced = 0
+        self.stored_bytes += os.path.getsize(source) - replaced
+        with open(source, 'rb') as source_file:
+            utils.atomic_write(path, lambda _file: shutil.copyfileobj(source_file, _file), 'wb')
+        self.counters['stored'] += 1
+
+        self.stored_since_eviction += 1
+        if self.stored_since_eviction >= EVICTION_INTERVAL:
+            self.evict()
+
+    def cached_files(self):
+        files = []
+        for sub_dir in os.listdir(self.cache_dir):
+            sub_path = os.path.join(self.cache_dir, sub_dir)
+            if not os.path.isdir(sub_path):
+                continue
+            for f in os.listdir(sub_path):
+                if f.endswith('.tmp'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(sub_path, f))
+                except FileNotFoundError:  # evicted by another process
+                    continue
+                files.append((stat.st_mtime, stat.st_size, os.path.join(sub_path, f)))
+        return files
+
+    def size(self):
+        return sum(size for _, size, _ in self.cached_files())
+
+    def evict(self):
+        """
+        Add the bytes stored since the last check to the total of stats.json, remove the least recently used files if
+        the total exceeds max_bytes.
+        """
+        self.stored_since_eviction = 0
+        return self.flush_stats(evict=True)
+
+    def remove_least_recently_used(self):
+        # scans the whole cache, returns the size of the remaining files
+        files = sorted(self.cached_files())
+        total = sum(size for _, size, _ in files)
+        if total <= self.max_bytes:
+            return total
+        for _, size, path in files:
+            if total <= self.max_bytes * EVICTION_TARGET:
+                break
+            try:
+                os.remove(path)
+                self.counters['evicted'] += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        return total
+
+    def stats(self):
+        path = os.path.join(self.cache_dir, STATS_NAME)
+        if not os.path.isfile(path):
+            return dict((c, 0) for c in STATS_COUNTERS)
+        with open(path) as f:
+            return json.load(f)
+
+    def flush_stats(self, evict=False):
+        """
+        Add the counters and stored bytes of this process to the shared statistics and reset them. With evict, files
+        are removed while the lock is held if the total exceeds max_bytes or is not known yet.
+        """
+        path = os.path.join(self.cache_dir, STATS_NAME)
+        with open(path, 'a+') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            content = f.read()
+            stats = json.loads(content) if content else {}
+            total = stats.get(CACHED_BYTES)
+            if total is not None:
+                total += self.stored_bytes
+            self.stored_bytes = 0
+            if evict and (total is None or total > self.max_bytes):
+                # the scan also corrects the total for files removed by hand
+                total = self.remove_least_recently_used()
+            if total is not None:
+                stats[CACHED_BYTES] = total
+            for c in STATS_COUNTERS:
+                stats[c] = stats.get(c, 0) + self.counters[c]
+                self.counters[c] = 0
+            f.seek(0)
+            f.truncate()
+            json.dump(stats, f)
+        return stats
+
+    def close(self):
+        return self.flush_stats(evict=self.stored_since_eviction > 0)
+
+
+def format_stats(stats):
+    lookups = stats['hits'] + stats['misses']
+    hit_rate = 100.0 * stats['hits'] / lookups if lookups else 0.0
+    return 'cache hits: %d, misses: %d (%.1f%% hit rate), stored: %d, evicted: %d' % (stats['hits'], stats['misses'], hit_rate, stats['stored'], stats['evicted'])
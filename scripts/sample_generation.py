@@ -1,12 +1,26 @@
 #!/usr/bin/env python3
 
 import os
+import signal
+import asyncio
 import argparse
-from subprocess import Popen, DEVNULL
+from collections import namedtuple, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import Popen, DEVNULL, PIPE, TimeoutExpired
 from time import time, sleep
 import numpy as np
 
 import file_utils
+import image_processing
+import ingest
+import job_ledger
+import job_queue
+import metrics
+import pixel_stream
+import render_cache
+import sample_plan
+import scheduler
+import worker_protocol
 
 __author__ = "Andrin Jenal"
 __copyright__ = "Copyright 2016, ETH Zurich"
@@ -14,8 +28,22 @@ __license__ = "GPL"
 __version__ = "0.1"
 
 JOB_CHUNK_SIZE = 500  # number of samples a single process will generate
+BLENDER = '/home/ajenal/Apps/blender2.78/blender'
 
-job_times = []
+# a single blender process: the tree model, the seed range it renders, its scratch directory, the sample plan rows
+# (plan path, start row, stop row) if parameters are precomputed, the render cache (cache directory, size in megabytes)
+# if one is used, the names of the enabled RENDER_OPTIONS and the full command line
+Job = namedtuple('Job', ['index', 'model', 'start_seed', 'number_samples', 'total_samples', 'image_size', 'views',
+                         'export', 'scratch_path', 'plan', 'cache', 'render_options', 'args'])
+
+# boolean options of sapling_tree_generator.py passed on to every job, e.g. multi_view -> --multi-view; they change how
+# the views are rendered or, like graph, add files next to them
+RENDER_OPTIONS = ('multi_view', 'reuse_scene', 'graph')
+
+RETRIES = 2  # times the missing samples of a job are rendered again, in smaller chunks each time
+STDERR_TAIL_LINES = 20  # last lines of standard error kept for the error of a failed job
+KILL_GRACE_SECONDS = 5.0  # between SIGTERM and SIGKILL to the process group of a job
+MIN_CHUNK_TIMEOUT = 30.0  # timeouts shrink with the chunks of a retried job, but not below this
 
 
 def human_readable_time(seconds):
@@ -26,15 +54,43 @@ def human_readable_time(seconds):
     return "%dh %2dm %2ds" % (h, m, s)
 
 
-def run_subprocess(args):
+def terminate_process_group(proc):
+    # blender and everything it started, the process leads a session of its own
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            break
+        try:
+            proc.wait(KILL_GRACE_SECONDS)
+            break
+        except TimeoutExpired:
+            pass
+
+
+def run_subprocess(args, timeout=None, running=None):
+    """
+    Run a blender process in a session of its own, it is killed with its process group after timeout seconds. A
+    process that did not exit with 0 raises RuntimeError. running is a set that holds the process while it runs.
+    """
     start_time = time()
-    proc = Popen(args, stdout=DEVNULL)  # pipe standard output to DEVNULL (discard standard output)
-    out = proc.communicate()[0]  # for now keep the process in foreground
+    proc = Popen(args, stdout=DEVNULL, start_new_session=True)  # pipe standard output to DEVNULL (discard standard output)
+    if running is not None:
+        running.add(proc)
+    try:
+        proc.wait(timeout)
+    except TimeoutExpired:
+        terminate_process_group(proc)
+        raise RuntimeError('killed after %.0f seconds: %s' % (timeout, args))
+    finally:
+        if running is not None:
+            running.discard(proc)
     end_time = time()
     elapsed_time = '%.3f' % (end_time - start_time)
-    job_times.append(end_time - start_time)
     print('Done: ' + str(args), flush=True)
     print('Elapsed time: ' + elapsed_time + ' seconds\n', flush=True)
+    if proc.returncode != 0:
+        raise RuntimeError('blender exited with code %d: %s' % (proc.returncode, args))
 
 
 def job_arguments_chunk(pars_args, total_samples, chunk_size, seed, export):
@@ -63,9 +119,9 @@ def job_arguments_model(script_args, model, image_size, number_views):
     return model_args
 
 
-def job_arguments_default(output_path):
+def job_arguments_default(output_path, blender=BLENDER):
     script_args = list()
-    script_args.append('/home/ajenal/Apps/blender2.78/blender')
+    script_args.append(blender)
     script_args.append('--background')
     script_args.append('--python')
     script_args.append('sapling_tree_generator.py')
@@ -84,48 +140,525 @@ def save_to_zip(open_file, path, file_format):
     file_utils.save_to_zip(open_file, path, file_format)
 
 
-def create_job_list(script_args, models, num_samples, image_size, num_views, chunk_size, export):
+def job_arguments_plan(args, plan_path, start_row, stop_row):
+    args = list(args)
+    args.append('--plan')
+    args.append(plan_path)
+    args.append('--plan-rows')
+    args.append('%d:%d' % (start_row, stop_row))
+    return args
+
+
+def job_arguments_cache(args, cache_dir, cache_size):
+    args = list(args)
+    args.append('--cache')
+    args.append(cache_dir)
+    args.append('--cache-size')
+    args.append(str(cache_size))
+    return args
+
+
+def job_arguments_render(args, render_options):
+    args = list(args)
+    for option in render_options:
+        args.append('--' + option.replace('_', '-'))
+    return args
+
+
+def job_command(blender, scratch_path, model, total_samples, image_size, num_views, number_samples, start_seed, export, plan=None,
+                cache=None, render_options=()):
+    # full command line of a blender job
+    model_args = job_arguments_model(job_arguments_default(scratch_path, blender), model, image_size, num_views)
+    args = job_arguments_chunk(model_args, total_samples, number_samples, start_seed, export)
+    if plan:
+        args = job_arguments_plan(args, *plan)
+    if cache:
+        args = job_arguments_cache(args, *cache)
+    return job_arguments_render(args, render_options)
+
+
+def chunk_job(job, start_seed, number_samples):
+    """
+    A job for part of the seeds of job, rendering into the same scratch directory. Without a sample plan the tree
+    models depend on the seed range, see TreeGenerator.generate.
+    """
+    plan = job.plan
+    if plan:
+        start_row = plan[1] + start_seed - job.start_seed
+        plan = (plan[0], start_row, start_row + number_samples)
+    args = job_command(job.args[0], job.scratch_path, job.model, job.total_samples, job.image_size, job.views, number_samples,
+                       start_seed, job.export, plan, job.cache, job.render_options)
+    return job._replace(start_seed=start_seed, number_samples=number_samples, plan=plan, args=args)
+
+
+def split_seeds(seeds):
+    # (start_seed, number_samples) of both halves of every run of consecutive seeds
+    runs = []
+    for seed in sorted(seeds):
+        if runs and runs[-1][0] + runs[-1][1] == seed:
+            runs[-1][1] += 1
+        else:
+            runs.append([seed, 1])
+    chunks = []
+    for start_seed, number_samples in runs:
+        half = (number_samples + 1) // 2
+        chunks.append((start_seed, half))
+        if number_samples > half:
+            chunks.append((start_seed + half, number_samples - half))
+    return chunks
+
+
+def fixed_chunks(models, num_samples, chunk_size):
+    # (model, start_seed, number_samples) of chunk_size samples each, the last chunk of a species takes the rest
+    return [(model, start_seed, min(chunk_size, num_samples - start_seed)) for model in models for start_seed in range(0, num_samples, chunk_size)]
+
+
+def create_job_list(output_path, models, num_samples, image_size, num_views, chunk_size, export, blender=BLENDER, plan_path=None, cache=None,
+                    render_options=(), chunks=None):
+    # chunks (model, start_seed, number_samples) in dispatch order, e.g. from scheduler.schedule, default fixed chunks
     job_list = []
 
-    for model in models:
-        model_args = job_arguments_model(script_args, model, image_size, num_views)
+    def add_job(model, number_samples, start_seed):
+        # every job renders into its own scratch directory
+        scratch_path = ingest.scratch_directory(output_path, len(job_list))
+
+        # the samples of the n-th model are the plan rows [n * num_samples, (n + 1) * num_samples)
+        plan = None
+        if plan_path:
+            start_row = models.index(model) * num_samples + start_seed
+            plan = (plan_path, start_row, start_row + number_samples)
 
-        chunks = int(num_samples / chunk_size)
+        args = job_command(blender, scratch_path, model, num_samples, image_size, num_views, number_samples, start_seed, export,
+                           plan, cache, render_options)
 
-        # for each junk create job arguments
-        for n in range(chunks):
-            job_list.append(job_arguments_chunk(model_args, num_samples, chunk_size, (n * chunk_size), export))
+        job_list.append(Job(len(job_list), model, start_seed, number_samples, num_samples, image_size, num_views,
+                            export, scratch_path, plan, cache, tuple(render_options), args))
 
-        # process remaining renders
-        if (num_samples - chunks * chunk_size) > 0:
-            job_list.append(job_arguments_chunk(model_args, num_samples, (num_samples - chunks * chunk_size), (chunks * chunk_size), export))
+    for model, start_seed, number_samples in (chunks or fixed_chunks(models, num_samples, chunk_size)):
+        add_job(model, number_samples, start_seed)
 
     return job_list
 
 
-def run_sequential_code(output_path, file_name, job_list, export, file_type=file_utils.FileType.ZIP, image_format='L'):
-    with file_utils.new_file(os.path.abspath(os.path.join(output_path, file_name)), file_type=file_type) as open_file:
-        file_path_name = str(open_file.filename)
+def run_job(job, timeout=None, running=None):
+    ingest.write_manifest(job)
+    run_subprocess(job.args, timeout, running)
+
+
+def timed_job_runner(timeout, running):
+    # a hanging blender would keep the lease of its job alive with the heartbeats of the queue worker
+    def run_timed_job(job):
+        run_job(job, timeout, running)
+
+    return run_timed_job
+
+
+def persistent_job_runner(worker_pool):
+    """
+    Run jobs on long-lived workers instead of starting a new blender process per job.
+    """
+    def run_persistent_job(job):
+        ingest.write_manifest(job)
+        start_time = time()
+        worker_pool.run(job)
+        end_time = time()
+        print('Done: job %d, %s seeds %d-%d' % (job.index, os.path.basename(job.model), job.start_seed, job.start_seed + job.number_samples - 1), flush=True)
+        print('Elapsed time: ' + '%.3f' % (end_time - start_time) + ' seconds\n', flush=True)
+
+    return run_persistent_job
+
+
+def ledger_job_runner(runner, ledger):
+    def run_ledger_job(job):
+        ledger.running(job)
+        runner(job)
+
+    return run_ledger_job
+
+
+def metrics_job_runner(runner, job_metrics):
+    # time every job from the worker thread, so the metrics see jobs as they finish and not in job order
+    def run_measured_job(job):
+        start_time = time()
+        try:
+            runner(job)
+        except Exception:
+            job_metrics.job_failed(job)
+            raise
+        job_metrics.job_done(job, time() - start_time)
+
+    return run_measured_job
+
+
+def run_jobs(job_list, workers, runner=run_job):
+    """
+    Run the blender jobs on a pool of worker threads, each one waiting for its own blender process. Jobs are yielded
+    in job list order as soon as they and all of their predecessors are finished, no matter which one finishes first.
+    Yields (job, error), error is None unless the job raised.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(runner, job) for job in job_list]
+        for job, future in zip(job_list, futures):
+            try:
+                future.result()
+                yield job, None
+            except Exception as e:
+                yield job, e
+
+
+# Orchestrator
+def read_pixel_stream(read_fd):
+    with os.fdopen(read_fd, 'rb') as stream:
+        return pixel_stream.read_images(stream)
+
+
+async def read_tail(stream, tail):
+    while True:
+        line = await stream.readline()
+        if not line:
+            return
+        tail.append(line.decode('utf-8', 'replace').rstrip())
+
+
+async def stop_reader(reader, read_fd):
+    # after the process was killed: a reader that never started leaves the read end to us, a running one reads
+    # until the end of the stream and returns the samples sent before the kill
+    if reader.cancel():
+        os.close(read_fd)
+        return None
+    return await asyncio.wrap_future(reader)
+
+
+async def kill_process_group(proc):
+    # blender and everything it started, the process leads a session of its own
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            break
+        try:
+            await asyncio.wait_for(proc.wait(), KILL_GRACE_SECONDS)
+            break
+        except asyncio.TimeoutError:
+            pass
+
+
+class JobOrchestrator:
+    """
+    Runs a blender process per job on an asyncio event loop, at most workers jobs at once. Every process runs in a
+    session of its own and is killed with its process group once it exceeds the timeout or the run is interrupted
+    with Ctrl-C. The samples a job did not deliver are rendered again in two halves per run of missing seeds, up to
+    retries times, before the job fails with the last lines of standard error of its processes.
+    """
+
+    def __init__(self, workers, timeout=None, retries=RETRIES, stream_pixels=False):
+        self.workers = workers
+        self.timeout = timeout
+        self.retries = retries
+        self.stream_pixels = stream_pixels
+        self.received = {}  # names and images of streamed jobs until the ingestor takes them
+        self.readers = None  # a thread per running job reads its pixel stream, see run
+
+    def chunk_timeout(self, job, chunk):
+        if self.timeout is None:
+            return None
+        return max(self.timeout * chunk.number_samples / float(job.number_samples), min(self.timeout, MIN_CHUNK_TIMEOUT))
+
+    async def run_process(self, args, timeout):
+        """
+        Run a blender process, returns the tail of its standard error and, if streaming, the names and images it sent.
+        """
+        start_time = time()
+        tail = deque(maxlen=STDERR_TAIL_LINES)
+        pass_fds = ()
+        if self.stream_pixels:
+            read_fd, write_fd = os.pipe()
+            args = list(args) + [pixel_stream.PIXEL_FD_OPTION, str(write_fd)]
+            pass_fds = (write_fd,)
+        try:
+            proc = await asyncio.create_subprocess_exec(*args, stdout=DEVNULL, stderr=PIPE, pass_fds=pass_fds, start_new_session=True)
+        except BaseException:
+            # e.g. a wrong blender path, the pipe of every retried chunk would stay open
+            if self.stream_pixels:
+                os.close(read_fd)
+                os.close(write_fd)
+            raise
+        reader = None
+        waits = [read_tail(proc.stderr, tail), proc.wait()]
+        if self.stream_pixels:
+            os.close(write_fd)  # the stream ends when blender closes the last write end
+            reader = self.readers.submit(read_pixel_stream, read_fd)
+            waits.append(asyncio.wrap_future(reader))
+
+        streamed = None
+        try:
+            results = await asyncio.wait_for(asyncio.gather(*waits), timeout)
+            if reader is not None:
+                streamed = results[2]
+        except asyncio.TimeoutError:
+            tail.append('killed after %.0f seconds' % timeout)
+            await kill_process_group(proc)
+            if reader is not None:
+                streamed = await stop_reader(reader, read_fd)
+        except asyncio.CancelledError:
+            await kill_process_group(proc)
+            if reader is not None:
+                await stop_reader(reader, read_fd)
+            raise
+
+        print('Done: ' + str(args), flush=True)
+        print('Elapsed time: ' + '%.3f' % (time() - start_time) + ' seconds\n', flush=True)
+        return list(tail), streamed
+
+    async def run_job(self, job):
+        ingest.write_manifest(job)
+        chunks = [job]
+        samples = OrderedDict()  # streamed name -> image, a retried sample replaces earlier ones
+        for attempt in range(self.retries + 1):
+            tails = []
+            for chunk in chunks:
+                tail, streamed = await self.run_process(chunk.args, self.chunk_timeout(job, chunk))
+                tails.append(tail)
+                if streamed is not None:
+                    samples.update(zip(*streamed))
+
+            missing = ingest.missing_seeds(job.scratch_path, list(samples) if self.stream_pixels else None)
+            if not missing:
+                break
+            if attempt < self.retries:
+                ingest.discard_seeds(job.scratch_path, missing)
+                for name in [n for n in samples if file_utils.parse_sample_name(n)[1] in set(missing)]:
+                    del samples[name]
+                chunks = [chunk_job(job, start_seed, number_samples) for start_seed, number_samples in split_seeds(missing)]
+                print('job %d: %d samples missing, rendering them again in %d chunks\n' % (job.index, len(missing), len(chunks)), flush=True)
+        else:
+            raise RuntimeError('%d samples missing after %d attempts, standard error:\n%s' %
+                               (len(missing), self.retries + 1, '\n'.join(line for tail in tails for line in tail)))
+
+        if self.stream_pixels:
+            self.received[job.index] = (list(samples), np.array(list(samples.values()), dtype=np.uint8))
+
+    async def run_all(self, job_list, handle, started, finished):
+        slots = asyncio.Semaphore(self.workers)
+
+        async def run_slot(job):
+            async with slots:
+                if started is not None:
+                    started(job)
+                start_time = time()
+                try:
+                    await self.run_job(job)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    if finished is not None:
+                        finished(job, time() - start_time, e)
+                    raise
+                if finished is not None:
+                    finished(job, time() - start_time, None)
+
+        tasks = [asyncio.ensure_future(run_slot(job)) for job in job_list]
+        try:
+            for job, task in zip(job_list, tasks):
+                try:
+                    await task
+                    error = None
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    error = e
+                handle(job, error)
+        finally:
+            # kills the processes of all jobs that are still running
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def run(self, job_list, handle, started=None, finished=None):
+        """
+        Run the jobs and call handle(job, error) in job list order as soon as a job and all of its predecessors are
+        finished, error is None unless the job failed. started(job) and finished(job, elapsed, error) are called as
+        jobs start and end. Ctrl-C kills all running processes, then raises KeyboardInterrupt.
+        """
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        if self.stream_pixels:
+            # not the default executor of the loop, which is sized by the number of cpus and shared with other work
+            self.readers = ThreadPoolExecutor(max_workers=self.workers)
+        main = asyncio.ensure_future(self.run_all(job_list, handle, started, finished))
+        loop.add_signal_handler(signal.SIGINT, main.cancel)
+        try:
+            loop.run_until_complete(main)
+        except asyncio.CancelledError:
+            print('interrupted, all blender processes killed\n', flush=True)
+            raise KeyboardInterrupt
+        finally:
+            loop.remove_signal_handler(signal.SIGINT)
+            loop.close()
+            asyncio.set_event_loop(None)
+            if self.readers is not None:
+                self.readers.shutdown()
+                self.readers = None
+
+
+def run_parallel_code(output_path, file_name, job_list, export, file_type=file_utils.FileType.ZIP, image_format='L', workers=1, worker_command=None, resume=False,
+                      skeleton=None, image_sizes=(), downsample_mode='area', process_workers=None, packed=False, write_metrics=False,
+                      metrics_interval=metrics.WRITE_INTERVAL, timings_path=None, shard_size=None, stream_pixels=False,
+                      job_timeout=None, retries=RETRIES):
+    # the ledger records the state of every job, a resumed run only redoes the jobs that are not done
+    ledger_file = job_ledger.ledger_path(output_path, file_name)
+    if resume and os.path.exists(ledger_file):
+        ledger = job_ledger.JobLedger.load(ledger_file)
+    else:
+        resume = False
+        ledger = job_ledger.JobLedger(ledger_file)
+    ledger.register(job_list, resume)
 
-        for job in job_list:
-            # start blender script
-            run_subprocess(job)
+    mode = 'a' if resume else 'w'
+    with file_utils.new_file(os.path.abspath(os.path.join(output_path, file_name)), file_type=file_type, mode=mode,
+                             shard_size=shard_size) as open_file:
+        file_path_name = str(open_file.filename)
 
-            if file_type == file_utils.FileType.ZIP:
-                if export:
-                    file_format = '.obj'
-                else:
-                    file_format = '.png'
-                save_to_zip(open_file, output_path, file_format)
+        if resume:
+            if file_type == file_utils.FileType.HDF5:
+                # keep the rows the ledger records for the done jobs and drop everything behind them, i.e. a job that
+                # was only partially stored when the last run stopped
+                rows, graphs = ledger.verify_rows(file_utils.row_names(open_file), file_utils.number_graphs(open_file))
+                file_utils.truncate_samples(open_file, rows)
+                file_utils.truncate_graphs(open_file, graphs)
+            # done jobs whose samples did not make it into the output file are redone
+            ledger.verify(file_utils.stored_sample_names(open_file, file_type))
+
+            done_jobs = len(ledger.jobs_in_state(job_ledger.DONE))
+            job_list = [job for job in job_list if not ledger.is_done(job)]
+            print('resume: %d jobs done, %d jobs left\n' % (done_jobs, len(job_list)), flush=True)
+
+        # throughput and remaining time, optionally written to <file_name>.metrics.json and .metrics.prom
+        metrics_prefix = os.path.join(output_path, file_name) if write_metrics else None
+        job_metrics = metrics.Metrics(job_list, workers, metrics_prefix, metrics_interval)
+
+        # either a pool of long-lived workers or one blender process per job run by the orchestrator, which streams
+        # their pixels if requested
+        worker_pool = None
+        orchestrator = None
+        received = {}
+        if worker_command:
+            worker_pool = worker_protocol.WorkerPool(worker_command)
+            runner = metrics_job_runner(ledger_job_runner(persistent_job_runner(worker_pool), ledger), job_metrics)
+        else:
+            orchestrator = JobOrchestrator(workers, job_timeout, retries, stream_pixels)
+            received = orchestrator.received
+
+        def measured(job, elapsed, error):
+            if error is None:
+                job_metrics.job_done(job, elapsed)
+            else:
+                job_metrics.job_failed(job)
+
+        # rendering and packing overlap: the ingestor stores finished jobs while the next ones are rendering
+        ingestor = ingest.Ingestor(open_file, file_type, image_format, ledger=ledger, skip_existing=resume,
+                                   skeleton_mode=skeleton, image_sizes=image_sizes, downsample_mode=downsample_mode,
+                                   process_workers=process_workers, packed=packed)
+        ingestor.start()
+        job_metrics.start()
+        def finished(job, error):
+            # called in job order
+            if error is not None:
+                print('job %d failed: %s\n' % (job.index, error), flush=True)
+                ledger.failed(job, error)
+                received.pop(job.index, None)
             else:
-                # save generated images as hdf5
-                save_to_file(open_file, output_path, '.hd5', scipy_image_format=image_format)
+                ingestor.put(job, received.pop(job.index, None))
 
-            print('estimated remaining time:', human_readable_time((np.mean(job_times) * len(job_list)) - np.sum(job_times)), '\n', flush=True)
+            job_metrics.set_queue_depth(ingestor.queue_depth())
+            job_metrics.set_bytes_written(ingestor.bytes_written)
+            eta = job_metrics.eta()
+            if eta is not None:
+                print('estimated remaining time:', human_readable_time(eta), '\n', flush=True)
+
+        try:
+            if orchestrator is not None:
+                orchestrator.run(job_list, finished, ledger.running, measured)
+            else:
+                for job, error in run_jobs(job_list, workers, runner):
+                    finished(job, error)
+        finally:
+            ingestor.close()
+            job_metrics.set_bytes_written(ingestor.bytes_written)
+            job_metrics.stop()
+            if timings_path and job_metrics.finished_jobs:
+                # the cost model of later scheduled runs learns from these
+                scheduler.record_timings(timings_path, job_metrics.finished_jobs)
+            if worker_pool is not None:
+                worker_pool.close()
+
+        ingest.remove_scratch_root(output_path)
+
+    print(job_metrics.summary(), '\n', flush=True)
+
+    ledger.close()
+    failed_jobs = ledger.jobs_in_state(job_ledger.FAILED)
+    if failed_jobs:
+        print('%d jobs failed: %s, run again with --resume to redo them\n' % (len(failed_jobs), failed_jobs), flush=True)
 
     return file_path_name
 
 
+def run_queue(args, output_path, file_type, job_list=None):
+    """
+    Queue mode for several hosts sharing the output path: enqueue the jobs of job_list, render and store jobs of the
+    queue and merge the shards, in this order and as far as requested by --enqueue, --worker and --merge.
+    """
+    if job_list is not None:
+        queue = job_queue.JobQueue(args.queue, args.lease)
+        added = queue.enqueue(job_list)
+        queue.close()
+        print('%d of %d jobs added to queue: %s\n' % (added, len(job_list), args.queue), flush=True)
+
+    if args.worker:
+        worker_command = args.worker_command
+        if args.persistent and not worker_command:
+            worker_command = worker_protocol.worker_command(args.blender)
+        worker_pool = None
+        running = set()  # blender processes of the worker threads, killed on Ctrl-C
+        runner = timed_job_runner(args.timeout, running)
+        if worker_command:
+            worker_pool = worker_protocol.WorkerPool(worker_command)
+            runner = persistent_job_runner(worker_pool)
+
+        # the storage options have to be the same on every worker
+        image_sizes = sorted(set(args.image_sizes or [args.image_size]), reverse=True)
+        ingest_options = dict(skeleton_mode=args.skeleton, image_sizes=image_sizes[1:], downsample_mode=args.downsample,
+                              process_workers=args.ingest_workers, packed=args.packed)
+        try:
+            completed = job_queue.work(args.queue, output_path, args.filename, file_type, runner, Job, args.blender, max(1, args.workers),
+                                       ingest_options, args.lease, shard_size=args.shards)
+        except KeyboardInterrupt:
+            # the jobs fail and are released, the worker threads claim no new ones
+            for proc in list(running):
+                terminate_process_group(proc)
+            print('interrupted, all blender processes killed\n', flush=True)
+            raise
+        finally:
+            if worker_pool is not None:
+                worker_pool.close()
+        print('%d jobs completed by this worker\n' % completed, flush=True)
+
+    if args.merge:
+        try:
+            file_name = job_queue.merge(args.queue, output_path, args.filename, file_type)
+        except RuntimeError as e:
+            print('merge:', e)
+            return
+        print('done with sample generation, saved to:', file_name)
+        if args.raw:
+            file_utils.export_raw(file_name, packed=args.packed)
+
+
+def run_sequential_code(output_path, file_name, job_list, export, file_type=file_utils.FileType.ZIP, image_format='L'):
+    return run_parallel_code(output_path, file_name, job_list, export, file_type, image_format, workers=1)
+
+
 def main():
 
     usage_text = (
@@ -135,18 +668,79 @@ def main():
 
     parser = argparse.ArgumentParser(description=usage_text)
     parser.add_argument('output_path', help='save generated samples into a specific location')
-    parser.add_argument('number_samples', type=int, help='number of samples that should be created')
-    parser.add_argument('models_path', help='tree template model')
+    parser.add_argument('number_samples', type=int, nargs='?', help='number of samples that should be created')
+    parser.add_argument('models_path', nargs='?', help='tree template model')
     parser.add_argument('-S', '--image-size', type=int, default=64, help='optionally pass image size')
     parser.add_argument('-V', '--number-views', type=int, default=1, help='define number of views from which the tree should be rendered')
     parser.add_argument('-H', '--hdf5', default=False, action='store_true', help='set this flag to enforce hdf5 storage')
+    parser.add_argument('--shards', type=int, help='store the samples in tar shards of this many samples each plus a random access index')
     parser.add_argument('-F', '--filename', default='samples', help='samples file name')
     parser.add_argument('-E', '--export', default=False, action='store_true', help='export file as .obj file')
+    parser.add_argument('-W', '--workers', type=int, default=1, help='number of blender jobs that run at once')
+    parser.add_argument('-B', '--blender', default=BLENDER, help='path to the blender executable')
+    parser.add_argument('-P', '--persistent', default=False, action='store_true', help='keep blender workers alive and send them jobs instead of starting a process per job')
+    parser.add_argument('-r', '--resume', default=False, action='store_true', help='skip the jobs the ledger of a previous run marks as done and append to its output file')
+    parser.add_argument('-p', '--plan', default=False, action='store_true', help='precompute all tree model parameters into a sample plan the blender jobs read from')
+    parser.add_argument('--plan-seed', type=int, default=0, help='random seed of the sample plan')
+    parser.add_argument('-C', '--cache', help='directory of a render cache shared by all runs, cached samples are not rendered again')
+    parser.add_argument('--cache-size', type=int, default=render_cache.DEFAULT_MAX_BYTES // 2 ** 20, help='maximum size of the render cache in megabytes')
+    parser.add_argument('--multi-view', default=False, action='store_true', help='render all views of a tree with one animation render instead of one render per view')
+    parser.add_argument('--reuse-scene', default=False, action='store_true', help='keep lamp, camera, world and materials between samples and only swap the tree')
+    parser.add_argument('--graph', default=False, action='store_true', help='export the branch structure of every tree as graph and store the graphs next to the samples')
+    parser.add_argument('--timeout', type=float, help='seconds after which a blender job is killed, its missing samples are rendered again in smaller chunks')
+    parser.add_argument('--retries', type=int, default=RETRIES, help='times the missing samples of a failed job are rendered again before it fails')
+    parser.add_argument('--pixel-stream', default=False, action='store_true', help='send the rendered pixels from blender over a pipe instead of writing png files')
+    parser.add_argument('-M', '--raw', default=False, action='store_true', help='additionally export the samples as raw array file for memory mapping')
+    parser.add_argument('--packed', default=False, action='store_true', help='store binary images with 8 pixels per byte in hdf5 and raw files')
+    parser.add_argument('-K', '--skeleton', choices=ingest.SKELETON_MODES, help='skeletonize the silhouettes and add the skeletons to the output file or replace the silhouettes by them')
+    parser.add_argument('--image-sizes', type=int, nargs='+', help='render once at the largest size and store every smaller size as its own dataset')
+    parser.add_argument('--downsample', choices=image_processing.DOWNSAMPLE_MODES, default='area', help='area averaging or thresholding that keeps thin branches')
+    parser.add_argument('--ingest-workers', type=int, help='number of processes computing skeletons and downsampled images, defaults to the number of cpus')
+    parser.add_argument('--schedule', default=False, action='store_true', help='size jobs by expected render cost and start the longest first, implies -p')
+    parser.add_argument('--timings', help='json file of job timings the schedule learns from, the timings of this run are added to it')
+    parser.add_argument('--min-chunk', type=int, default=scheduler.MIN_CHUNK_SIZE, help='smallest number of samples of a scheduled job')
+    parser.add_argument('--metrics', default=False, action='store_true', help='periodically write throughput metrics as json and prometheus text next to the output file')
+    parser.add_argument('--metrics-interval', type=float, default=metrics.WRITE_INTERVAL, help='seconds between two metrics files')
+    parser.add_argument('--queue', help='sqlite job queue on a file system shared by several hosts, see --enqueue, --worker and --merge')
+    parser.add_argument('--enqueue', default=False, action='store_true', help='add the jobs of this run to the queue instead of running them')
+    parser.add_argument('--worker', default=False, action='store_true', help='render and store jobs of the queue into shards until it is finished')
+    parser.add_argument('--merge', default=False, action='store_true', help='merge the shards of the finished queue into the output file')
+    parser.add_argument('--lease', type=float, default=job_queue.LEASE_SECONDS, help='seconds after which the job of an unresponsive queue worker is claimed again')
+    parser.add_argument('--worker-command', help='command that starts a persistent worker, defaults to blender running sapling_tree_generator.py --worker')
 
     args = parser.parse_args()
 
+    # queue workers and the merge step take their jobs from the queue
+    if (args.enqueue or args.worker or args.merge) and not args.queue:
+        parser.error('--enqueue, --worker and --merge need --queue')
+    if args.queue and not (args.enqueue or args.worker or args.merge):
+        parser.error('--queue needs --enqueue, --worker or --merge')
+    queue_only = args.queue and not args.enqueue
+    if not queue_only and (args.number_samples is None or args.models_path is None):
+        parser.error('the following arguments are required: number_samples, models_path')
+
     print('start sample generation script v' + __version__ + '\n', flush=True)
 
+    # choose file type
+    file_type = file_utils.FileType.ZIP
+    if args.hdf5:
+        file_type = file_utils.FileType.HDF5
+    if args.shards:
+        # shards hold the rendered files as they are
+        if args.hdf5 or args.skeleton or args.image_sizes or args.raw or args.graph:
+            parser.error('--shards cannot be combined with -H, -K, --image-sizes, -M or --graph')
+        file_type = file_utils.FileType.TAR
+    if args.pixel_stream and (args.export or args.persistent or args.worker_command or args.cache or args.multi_view or args.queue or args.shards):
+        # one blender process per job with a pipe of its own, streamed images are not cached
+        parser.error('--pixel-stream cannot be combined with -E, -P, --worker-command, -C, --multi-view, --queue or --shards')
+
+    # enforce correct path formatting
+    output_path = os.path.join(args.output_path, '')
+
+    if queue_only:
+        run_queue(args, output_path, file_type)
+        return
+
     # accept model files or model directories
     if os.path.isdir(args.models_path):
         models = [os.path.abspath(os.path.join(args.models_path, f)) for f in os.listdir(args.models_path) if
@@ -157,28 +751,83 @@ def main():
         print('file not exists:', args.models_path)
         return
 
-    # choose file type
-    file_type = file_utils.FileType.ZIP
-    if args.hdf5:
-        file_type = file_utils.FileType.HDF5
-
-    # enforce correct path formatting
-    output_path = os.path.join(args.output_path, '')
-
     # create output path if not exists
     if not os.path.exists(output_path):
         os.makedirs(output_path)
         print('created directory:', output_path, '\n')
 
-    # rendered images will be written to output path
-    script_args = job_arguments_default(output_path)
+    # compute every tree model parameter and view angle of the dataset up front
+    plan_path = None
+    if args.schedule and not args.plan:
+        # without a plan the tree models of a job depend on its seed range, see TreeGenerator.generate
+        print('the schedule renders from a sample plan, -p is enabled\n')
+        args.plan = True
+    if args.plan:
+        plan = sample_plan.build_plan(models, args.number_samples, args.number_views, JOB_CHUNK_SIZE, plan_seed=args.plan_seed)
+        plan_path = sample_plan.write_plan(os.path.abspath(os.path.join(output_path, args.filename + '.plan.npz')), plan)
+        print('sample plan with', len(plan['seed']), 'rows written to:', plan_path, '\n', flush=True)
+
+    # render cache
+    cache = None
+    if args.cache:
+        cache = (os.path.abspath(args.cache), args.cache_size)
+        cache_stats = render_cache.RenderCache(cache[0]).stats()
+
+    # several resolutions are rendered once at the largest size and downsampled during ingestion
+    image_sizes = sorted(set(args.image_sizes or [args.image_size]), reverse=True)
+    if len(image_sizes) > 1 and args.export:
+        print('warning: exported .obj files have no image size\n')
+        image_sizes = image_sizes[:1]
+
+    # rendered images will be written to a scratch directory per job within the output path
     # create job list with all required script arguments
-    job_list = create_job_list(script_args, models, args.number_samples, args.image_size, args.number_views, JOB_CHUNK_SIZE, args.export)
+    render_options = [option for option in RENDER_OPTIONS if getattr(args, option)]
+    chunks = None
+    if args.schedule:
+        # a resumed run has to use the jobs of the schedule it started with
+        path = scheduler.schedule_path(output_path, args.filename)
+        if args.resume and os.path.exists(path):
+            chunks = scheduler.read_schedule(path)
+        else:
+            cost_model = scheduler.CostModel(models, scheduler.read_timings(args.timings), args.number_views)
+            chunks = scheduler.schedule(models, args.number_samples, max(1, args.workers), cost_model, args.min_chunk, JOB_CHUNK_SIZE)
+            scheduler.write_schedule(path, chunks)
+            print('schedule of %d jobs written to: %s, %d of %d species with recorded timings\n' %
+                  (len(chunks), path, len(cost_model.fits), len(models)), flush=True)
+    job_list = create_job_list(output_path, models, args.number_samples, image_sizes[0], args.number_views, JOB_CHUNK_SIZE, args.export, args.blender, plan_path, cache,
+                               render_options, chunks)
+
+    if args.queue:
+        run_queue(args, output_path, file_type, job_list)
+        return
+
+    # persistent workers
+    worker_command = args.worker_command
+    if args.persistent and not worker_command:
+        worker_command = worker_protocol.worker_command(args.blender)
 
-    file_name = run_sequential_code(output_path, args.filename, job_list, args.export, file_type, image_format='L')
+    # skeletons are computed from rendered silhouettes only
+    skeleton = args.skeleton
+    if skeleton and args.export:
+        print('warning: no skeletons for exported .obj files\n')
+        skeleton = None
+
+    file_name = run_parallel_code(output_path, args.filename, job_list, args.export, file_type, image_format='L', workers=max(1, args.workers), worker_command=worker_command, resume=args.resume,
+                                  skeleton=skeleton, image_sizes=image_sizes[1:], downsample_mode=args.downsample, process_workers=args.ingest_workers,
+                                  packed=args.packed, write_metrics=args.metrics, metrics_interval=args.metrics_interval,
+                                  timings_path=args.timings, shard_size=args.shards, stream_pixels=args.pixel_stream,
+                                  job_timeout=args.timeout, retries=args.retries)
 
     print('done with sample generation, saved to:', file_name)
 
+    if cache:
+        # statistics of this run only, the cache keeps counting across runs
+        total_stats = render_cache.RenderCache(cache[0]).stats()
+        print(render_cache.format_stats(dict((c, total_stats[c] - cache_stats[c]) for c in render_cache.STATS_COUNTERS)))
+
+    if args.raw and not args.export:
+        file_utils.export_raw(file_name, packed=args.packed)
+
 if __name__ == '__main__':
     start = time()
     main()
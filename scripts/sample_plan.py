@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# per sample tree model parameters, independent of blender
+#
+# The functions in the first part are the parameter variations TreeGenerator applies to a tree model before every
+# sample is rendered. The second part computes these parameters for a whole dataset up front and stores them as a
+# columnar sample plan (.npz): one row per sample with species, seed, every sapling parameter, the view angles and
+# the output name. Blender workers then only read their row range from the plan.
+
+import zlib
+import numpy as np
+from collections import OrderedDict
+
+import utils
+from treeconfigs import TreeConfig
+
+__author__ = "Andrin Jenal"
+__copyright__ = "Copyright 2016, ETH Zurich"
+__license__ = "GPL"
+
+BRANCH_LEVELS = 4
+BRANCHES_START_COMPLEXITY = (1, 3, 1, 1)
+SPLITS_START_COMPLEXITY = (0.0, 0.0, 0.0, 0.0)
+SKELETON_RADIUS_DAMPER = 0.005
+
+PARAM_PREFIX = 'param.'
+
+
+# Tree model variations
+def tree_model_defaults(tree_model):
+    # sapling tree add-on specific fixed parameters
+    tree_model['levels'] = 2
+    tree_model['bevel'] = True
+    tree_model['bevelRes'] = 4
+    tree_model['resU'] = 4
+    tree_model['handleType'] = '0'
+    tree_model['curveRes'] = (8, 5, 3, 1)
+    tree_model['showLeaves'] = False
+
+
+def random_variation(tree_config, tree_model, nth_sample):
+    """
+    This function should be removed. Parameters should rather be registered as complexity parameters.
+    """
+    # parameters that depend on the loaded model presets
+    # base splits
+    if tree_model['baseSplits'] > 0:
+        tree_config.add_int_parameter('baseSplits', 1, tree_model['baseSplits'] + 1)  # range[1, baseSplts + 1]
+    # branch rings
+    if tree_model['nrings'] > 0:
+        tree_config.add_int_parameter('nrings', tree_model['nrings'] - 1, tree_model['nrings'] + 1)  # range[nrings - 1, nrings + 1]
+
+    # add parameter variation which increases if the sample number increases
+    tree_model['splitAngleV'] = tree_config.variation(tree_model['splitAngle'], tree_model['splitAngleV'], nth_sample)
+    tree_model['rotateV'] = tree_config.variation(tree_model['rotate'], tree_model['rotateV'], nth_sample)
+
+    # add non variation parameters
+    branch_value = tree_model['branches']
+    branch_variation = np.multiply(branch_value, 0.05)  # 5% variation
+    tree_model['branches'] = tuple([int(np.int32(b)) for b in np.add(branch_value, tree_config.variation(tree_model['branches'], branch_variation, nth_sample))])
+
+    back_curvature_value = tree_model['curveBack']
+    back_curvature_variation = np.multiply(back_curvature_value, 0.05)  # 5% variation
+    tree_model['curveBack'] = tuple([float(b) for b in np.add(back_curvature_value, tree_config.variation(back_curvature_value, np.ones(BRANCH_LEVELS) * back_curvature_variation, nth_sample))])
+
+
+def complexity_variation(tree_model, param, type_func, start_complexity, end_complexity, current_sample, total_samples):
+    """
+    Tree branch structure should vary in complexity. This is accomplished by varying certain parameters as the current
+    tree sample number increases.
+    """
+    complexity_delta = current_sample / total_samples
+    if type(tree_model[param]) is tuple:
+        tree_model[param] = tuple([type_func(elem) for elem in (np.array(start_complexity) + complexity_delta * (np.array(end_complexity) - np.array(start_complexity)))])
+    else:
+        tree_model[param] = type_func(start_complexity + complexity_delta * (end_complexity - start_complexity))
+    print(param, 'end complexity', end_complexity)
+    print(param, 'complexity', tree_model[param])
+
+
+def complexity_targets(tree_model):
+    """
+    Complexity parameters (param, type, start complexity, end complexity), stored once per model before any sample
+    changes the tree model.
+    """
+    return [
+        ('branches', int, BRANCHES_START_COMPLEXITY, tree_model['branches']),
+        ('segSplits', float, SPLITS_START_COMPLEXITY, tree_model['segSplits']),
+        ('scale0', float, tree_model['scale0'], tree_model['scale0'] * 1.3),
+        ('scaleV0', float, 0, tree_model['scale0'] * 0.5),
+    ]
+
+
+def apply_complexity(tree_model, targets, current_sample, total_samples):
+    for param, type_func, start_complexity, end_complexity in targets:
+        complexity_variation(tree_model, param, type_func, start_complexity, end_complexity, current_sample, total_samples)
+
+
+def apply_silhouette(tree_model):
+    # render tree bone structure only, skeleton radius should depend on tree size
+    tree_model['closeTip'] = False
+    tree_model['minRadius'] = SKELETON_RADIUS_DAMPER * tree_model['scale']
+    tree_model['scale0'] = 0.0
+
+
+def variation_sample(current_sample, total_samples, chunk_size):
+    # random_variation is applied once per job with the end of the job's seed range, keep that for every sample
+    return min((current_sample // chunk_size + 1) * chunk_size, total_samples)
+
+
+# Sample plans
+def species_seed(model, plan_seed):
+    return (zlib.crc32(utils.get_filename(model).encode()) + plan_seed) % (2 ** 32)
+
+
+def random_angles(number_samples, views, random_state):
+    # views distinct angles in [0, 360) per sample, like np.random.choice(..., replace=False): the i-th angle is drawn
+    # among the 360 - i free ones and shifted past the angles taken before, in ascending order
+    angles = np.zeros((number_samples, views), dtype=np.int16)
+    for i in range(views):
+        angle = random_state.randint(0, 360 - i, number_samples)
+        for taken in np.sort(angles[:, :i], axis=1).T:
+            angle += angle >= taken
+        angles[:, i] = angle
+    return angles
+
+
+def chunk_columns(base_model, start_sample, number_samples, total_samples, chunk_size, silhouette, pure_random, random_state):
+    """
+    Vectorized parameters of the samples [start_sample, start_sample + number_samples) of one species.
+    """
+    tree_model = dict(base_model)
+    tree_model_defaults(tree_model)
+    tree_config = TreeConfig()
+    random_variation(tree_config, tree_model, variation_sample(start_sample, total_samples, chunk_size))
+    targets = complexity_targets(tree_model)
+
+    samples = np.arange(start_sample, start_sample + number_samples)
+    columns = OrderedDict()
+
+    if pure_random:
+        columns.update(tree_config.jitter_batch(number_samples, random_state))
+
+        delta = samples / float(total_samples)
+        for param, type_func, start_complexity, end_complexity in targets:
+            start_complexity = np.asarray(start_complexity, dtype=np.float64)
+            end_complexity = np.asarray(end_complexity, dtype=np.float64)
+            if start_complexity.ndim:
+                delta_column = delta[:, None]
+            else:
+                delta_column = delta
+            values = start_complexity + delta_column * (end_complexity - start_complexity)
+            columns[param] = np.trunc(values).astype(np.int64) if type_func is int else values
+
+    if silhouette:
+        apply_silhouette(tree_model)
+        for param in ('closeTip', 'minRadius', 'scale0'):
+            columns[param] = np.repeat(np.asarray(tree_model[param])[None], number_samples, axis=0)
+
+    columns['seed'] = samples.astype(np.int64)
+
+    # every other parameter is the same for all samples of the chunk
+    for param in sorted(tree_model):
+        if param not in columns:
+            columns[param] = np.repeat(np.asarray(tree_model[param])[None], number_samples, axis=0)
+
+    return columns
+
+
+def species_plan(model, total_samples, views, chunk_size, silhouette=True, pure_random=True, plan_seed=0):
+    base_model = utils.read_tree_model(model)
+    random_state = np.random.RandomState(species_seed(model, plan_seed))
+
+    chunks = []
+    for start_sample in range(0, total_samples, chunk_size):
+        number_samples = min(chunk_size, total_samples - start_sample)
+        chunks.append(chunk_columns(base_model, start_sample, number_samples, total_samples, chunk_size, silhouette, pure_random, random_state))
+
+    prefix = utils.get_filename(model)
+    seeds = np.arange(total_samples)
+    plan = OrderedDict()
+    plan['species'] = np.array([prefix] * total_samples)
+    plan['model'] = np.array([model] * total_samples)
+    plan['seed'] = seeds.astype(np.int64)
+    plan['angles'] = random_angles(total_samples, views, random_state)
+    plan['output_name'] = np.array([prefix + '_' + str(s) for s in seeds])
+    for param in chunks[0]:
+        plan[PARAM_PREFIX + param] = np.concatenate([c[param] for c in chunks])
+    return plan
+
+
+def build_plan(models, total_samples, views, chunk_size, silhouette=True, pure_random=True, plan_seed=0):
+    """
+    Sample plan of a whole dataset, rows ordered by model and seed: the samples of models[i] are the rows
+    [i * total_samples, (i + 1) * total_samples).
+    """
+    plans = [species_plan(model, total_samples, views, chunk_size, silhouette, pure_random, plan_seed) for model in models]
+    return OrderedDict((column, np.concatenate([p[column] for p in plans])) for column in plans[0])
+
+
+def write_plan(path, plan):
+    np.savez_compressed(path, **plan)
+    return path
+
+
+def read_plan(path):
+    # load every column once, row access on an NpzFile would decompress a column per access
+    with np.load(path) as plan:
+        return dict((column, plan[column]) for column in plan.files)
+
+
+def python_value(value):
+    # sapling operator properties expect python scalars and tuples
+    if np.ndim(value):
+        return tuple(python_value(v) for v in value)
+    return value.item() if hasattr(value, 'item') else value
+
+
+def plan_row(plan, row):
+    """
+    Tree model, seed and view angles of a single plan row.
+    """
+    tree_model = dict((column[len(PARAM_PREFIX):], python_value(plan[column][row])) for column in plan if column.startswith(PARAM_PREFIX))
+    return tree_model, int(plan['seed'][row]), [int(a) for a in plan['angles'][row]]
@@ -16,6 +16,11 @@ dir_name = os.path.dirname(bpy.data.filepath)
 if not dir_name in sys.path:
     sys.path.append(dir_name)
 import utils
+import sample_plan
+import render_cache
+import skeleton_graph
+import worker_protocol
+import pixel_stream
 from treeconfigs import TreeConfig
 
 __author__ = "Andrin Jenal"
@@ -26,14 +31,19 @@ __license__ = "GPL"
 BRANCH_LEVELS = 4
 HEIGHT = 10
 BRANCHES = 50
+PURGE_INTERVAL = 100  # number of samples between two purges of orphaned data blocks when the scene is reused
 
 class TreeGenerator:
-    def __init__(self, start_seed, pure_random, render_path, image_size, render_silhouette, views, export):
+    def __init__(self, start_seed, pure_random, render_path, image_size, render_silhouette, views, export, geometry=False, graph=False):
         # render specific
         self.render_engine = 'BLENDER_RENDER'  # BLENDER_RENDER, CYCLES
         self.export = export
+        self.geometry = geometry  # export the branch geometry for silhouette_rasterizer.py instead of rendering
+        self.graph = graph  # also export the branch structure as graph, see skeleton_graph.py
         if self.export:
             self.file_extension = '.obj'
+        elif self.geometry:
+            self.file_extension = '.npz'
         else:
             self.file_extension = '.png'
 
@@ -67,6 +77,19 @@ class TreeGenerator:
         self.tree = None
         self.views = views
 
+        # optional cache of rendered samples (see render_cache.py)
+        self.cache = None
+
+        # render all views of a tree with a single animation render instead of one still render per view
+        self.multi_view = False
+
+        # keep lamp, camera, world and materials between samples and only swap the tree
+        self.reuse_scene = False
+        self.samples_since_purge = 0
+
+        # optional pixel_stream.PixelWriter, rendered views are sent over it instead of being saved as images
+        self.pixel_writer = None
+
         # tree config
         self.tree_config = TreeConfig()
         # these parameters should be influenced by randmoness
@@ -107,15 +130,17 @@ class TreeGenerator:
         #self.tree_config.add_float_list_parameter('curveBack', -360 * np.ones(4), 360 * np.ones(4))
         #self.tree_config.add_float_list_parameter('attractUp', [-10, -90, 0, 0], [10, 90, 0, 0])
 
+    def set_job(self, start_seed, render_path, image_size, views):
+        # job specific properties, a long-lived worker reuses the generator for all jobs of the same species
+        self.start_seed = start_seed
+        self.image_path = render_path
+        self.image_width = image_size
+        self.image_height = image_size
+        self.views = views
+
     def tree_model_defaults(self, tree_model):
         # sapling tree add-on specific fixed parameters
-        tree_model['levels'] = 2
-        tree_model['bevel'] = True
-        tree_model['bevelRes'] = 4
-        tree_model['resU'] = 4
-        tree_model['handleType'] = '0'
-        tree_model['curveRes'] = (8, 5, 3, 1)
-        tree_model['showLeaves'] = False
+        sample_plan.tree_model_defaults(tree_model)
         #tree_model['scale'] = HEIGHT
 
     def simple_random(self, tree_model):
@@ -130,40 +155,14 @@ class TreeGenerator:
         """
         This function should be removed. Parameters should rather be registered as complexity parameters.
         """
-        # parameters that depend on the loaded model presets
-        # base splits
-        if tree_model['baseSplits'] > 0:
-            self.tree_config.add_int_parameter('baseSplits', 1, tree_model['baseSplits'] + 1)  # range[1, baseSplts + 1]
-        # branch rings
-        if tree_model['nrings'] > 0:
-            self.tree_config.add_int_parameter('nrings', tree_model['nrings'] - 1,
-                                               tree_model['nrings'] + 1)  # range[nrings - 1, nrings + 1]
-
-        # add parameter variation which increases if the sample number increases
-        tree_model['splitAngleV'] = self.tree_config.variation(tree_model['splitAngle'], tree_model['splitAngleV'], nth_sample)
-        tree_model['rotateV'] = self.tree_config.variation(tree_model['rotate'], tree_model['rotateV'], nth_sample)
-
-        # add non variation parameters
-        branch_value = tree_model['branches']
-        branch_variation = np.multiply(branch_value, 0.05)  # 5% variation
-        tree_model['branches'] = tuple([np.asscalar(np.int32(b)) for b in np.add(branch_value, self.tree_config.variation(tree_model['branches'], branch_variation, nth_sample))])
-
-        back_curvature_value = tree_model['curveBack']
-        back_curvature_variation = np.multiply(back_curvature_value, 0.05)  # 5% variation
-        tree_model['curveBack'] = tuple([np.asscalar(b) for b in np.add(back_curvature_value, self.tree_config.variation(back_curvature_value, np.ones(BRANCH_LEVELS) * back_curvature_variation, nth_sample))])
+        sample_plan.random_variation(self.tree_config, tree_model, nth_sample)
 
     def complexity_variation(self, tree_model, param, type_func, start_complexity, end_complexity, current_sample, total_samples):
         """
         Tree branch structure should vary in complexity. This is accomplished by varying certain parameters as the current
         tree sample number increases.
         """
-        complexity_delta = current_sample / total_samples
-        if type(tree_model[param]) is tuple:
-            tree_model[param] = tuple([type_func(elem) for elem in (np.array(start_complexity) + complexity_delta * (np.array(end_complexity) - np.array(start_complexity)))])
-        else:
-            tree_model[param] = type_func(start_complexity + complexity_delta * (end_complexity - start_complexity))
-        print(param, 'end complexity', end_complexity)
-        print(param, 'complexity', tree_model[param])
+        sample_plan.complexity_variation(tree_model, param, type_func, start_complexity, end_complexity, current_sample, total_samples)
 
     def clear_scene(self):
         # it is to say that blender operates in different scopes: global, scene, curves etc.
@@ -183,6 +182,29 @@ class TreeGenerator:
         for c in bpy.data.curves:
             bpy.data.curves.remove(c, do_unlink=True)
 
+    def scene_ready(self):
+        # a reusable scene has a camera and a lamp, possibly set up by another generator of the same worker
+        return self.scene.camera is not None and any(o.type == 'LAMP' for o in self.scene.objects)
+
+    def remove_tree(self):
+        # remove every object but the lamp and the camera, the curve data of the trees right away
+        for o in list(self.scene.objects):
+            if o.type in ('CAMERA', 'LAMP'):
+                continue
+            data = o.data
+            bpy.data.objects.remove(o, do_unlink=True)
+            if data is not None and data.users == 0 and data.name in bpy.data.curves:
+                bpy.data.curves.remove(data, do_unlink=True)
+        self.tree = None
+
+    def purge_orphans(self):
+        # data blocks without users, e.g. meshes the add-on left behind; materials of reused scenes have a fake user
+        for blocks in (bpy.data.curves, bpy.data.meshes, bpy.data.cameras, bpy.data.lamps, bpy.data.materials):
+            for block in list(blocks):
+                if block.users == 0:
+                    blocks.remove(block, do_unlink=True)
+        self.samples_since_purge = 0
+
     def rotate_object(self, obj, angle_degree, direction, point):
         from mathutils import Matrix
         R = Matrix.Rotation(radians(angle_degree), 4, direction)
@@ -267,8 +289,18 @@ class TreeGenerator:
         #cam_obj.location.z = target_obj.dimensions.z * 0.5 # vertical object center
 
     def create_new_scene(self, tree_config):
-        # clear existing objects
-        self.clear_scene()
+        if self.reuse_scene and self.scene_ready():
+            # only swap the tree, lamp, camera and world stay
+            self.remove_tree()
+            self.samples_since_purge += 1
+            if self.samples_since_purge >= PURGE_INTERVAL:
+                self.purge_orphans()
+        else:
+            # clear existing objects
+            self.clear_scene()
+
+        if self.reuse_scene:
+            self.tree_material.use_fake_user = True
 
         # add sapling tree
         self.tree = self.add_sapling_tree(tree_config, self.tree_material)
@@ -282,18 +314,33 @@ class TreeGenerator:
         #if not self.render_silhouette and not self.export:
         #    self.add_ground_plane(material=self.plane_material)
 
-    def render_scene(self, seed):
-        # add lamp
-        self.add_lamp()
+    def render_scene(self, seed, angles=None):
+        if self.reuse_scene and self.scene_ready():
+            # reset the camera of the last sample to its initial pose
+            camera = self.scene.camera
+            camera.location.xyz = (0, 0, 0)
+            camera.rotation_euler.x = radians(90)
+            camera.rotation_euler.y = 0
+            camera.rotation_euler.z = 0
+        else:
+            # add lamp
+            self.add_lamp()
+
+            # add camera
+            camera = self.add_camera(lens=50)
 
-        # add and position camera
-        camera = self.add_camera(lens=50)
+        # position camera
         self.camera_look_at_target(camera.name, self.tree)
 
-        # initialize random angles
-        angles = np.random.choice(range(0, 360), self.views, replace=False)
+        # initialize random angles, unless they are given by a sample plan
+        if angles is None:
+            angles = self.random_angles()
         assert len(angles) == self.views
 
+        if self.multi_view and self.pixel_writer is None:
+            self.render_views_animation(camera, seed, angles)
+            return
+
         # multi-view rendering
         for v in range(0, self.views):
 
@@ -301,22 +348,179 @@ class TreeGenerator:
             origin = (0, 0, 0)
             self.rotate_object(camera, angles[v], 'Z', origin)
 
-            # render and save image
-            if self.image_path:
-                render = self.scene.render
-                render.engine = self.render_engine
-                render.use_file_extension = True
-                render.filepath = self.image_path + '_' + str(seed) + '_' + str(angles[v]) + self.file_extension
-                render.resolution_x = self.image_width
-                render.resolution_y = self.image_height
-                render.resolution_percentage = 100.0
+            # render and save image, or send its pixels
+            if self.pixel_writer is not None:
+                self.render_pixels(seed, angles[v])
+            elif self.image_path:
+                self.set_render_properties(self.output_filepath(seed, angles[v]))
                 bpy.ops.render.render(write_still=True)
 
+    def set_render_properties(self, filepath):
+        render = self.scene.render
+        render.engine = self.render_engine
+        render.use_file_extension = True
+        render.filepath = filepath
+        render.resolution_x = self.image_width
+        render.resolution_y = self.image_height
+        render.resolution_percentage = 100.0
+
+    def setup_viewer_node(self):
+        # the compositor's viewer node keeps the pixels of the last render in the image 'Viewer Node'
+        self.scene.use_nodes = True
+        self.scene.render.use_compositing = True
+        nodes = self.scene.node_tree.nodes
+        if any(n.type == 'VIEWER' for n in nodes):
+            return
+        layers = next((n for n in nodes if n.type == 'R_LAYERS'), None) or nodes.new('CompositorNodeRLayers')
+        if not any(n.type == 'COMPOSITE' for n in nodes):
+            # blender refuses to render a node tree without composite output
+            self.scene.node_tree.links.new(layers.outputs['Image'], nodes.new('CompositorNodeComposite').inputs['Image'])
+        viewer = nodes.new('CompositorNodeViewer')
+        viewer.use_alpha = False
+        self.scene.node_tree.links.new(layers.outputs['Image'], viewer.inputs['Image'])
+
+    def render_pixels(self, seed, angle):
+        """
+        Render a view without saving it and send its grey pixels, named like the image file, to the pixel stream.
+        """
+        self.setup_viewer_node()
+        self.set_render_properties(self.output_filepath(seed, angle))
+        bpy.ops.render.render()
+        viewer = bpy.data.images['Viewer Node']
+        width, height = viewer.size[0], viewer.size[1]
+        srgb = self.scene.view_settings.view_transform == 'Default'
+        pixels = pixel_stream.render_to_grey(viewer.pixels[:], width, height, srgb)
+        self.pixel_writer.write(os.path.basename(self.output_filepath(seed, angle)), pixels)
+
+    def render_views_animation(self, camera, seed, angles):
+        """
+        Keyframe the camera pose of every view on its own frame and render all views with one animation render, which
+        sets up the render pipeline only once. The frames are renamed to the file names of the per view renders.
+        """
+        origin = (0, 0, 0)
+        for v in range(0, self.views):
+            # same cumulative camera rotation as the per view renders
+            self.rotate_object(camera, angles[v], 'Z', origin)
+            camera.keyframe_insert(data_path='location', frame=v + 1)
+            camera.keyframe_insert(data_path='rotation_euler', frame=v + 1)
+
+        if self.image_path:
+            self.scene.frame_start = 1
+            self.scene.frame_end = self.views
+            self.set_render_properties(self.image_path + '_' + str(seed) + '_view_')
+            bpy.ops.render.render(animation=True)
+
+            for v in range(0, self.views):
+                os.replace(self.scene.render.frame_path(frame=v + 1), self.output_filepath(seed, angles[v]))
+
+        camera.animation_data_clear()
+
     def export_scene(self, seed=0):
-        filepath = self.image_path + '_' + str(seed) + self.file_extension
+        filepath = self.output_filepath(seed)
         bpy.ops.export_scene.obj(filepath=filepath, axis_forward='-Z', axis_up='Y', use_triangles=True, use_materials=False)
         return filepath
 
+    def tree_geometry(self):
+        """
+        Bezier control points, handles and radii of all splines of the tree curve in world space.
+        """
+        curve = self.tree.data
+        matrix = np.array(self.tree.matrix_world)
+        # radii are relative to the bevel depth, scaled like the object
+        radius_scale = curve.bevel_depth * np.mean(np.abs(self.tree.scale[:]))
+
+        columns = {'co': [], 'handle_left': [], 'handle_right': [], 'radius': []}
+        offsets = [0]
+        for spline in curve.splines:
+            n = len(spline.bezier_points)
+            for name in columns:
+                values = np.zeros(n * (1 if name == 'radius' else 3), dtype=np.float32)
+                spline.bezier_points.foreach_get(name, values)
+                columns[name].append(values.reshape(n, -1))
+            offsets.append(offsets[-1] + n)
+
+        def world(name):
+            local = np.concatenate(columns[name]) if columns[name] else np.zeros((0, 3))
+            return local.dot(matrix[:3, :3].T) + matrix[:3, 3]
+
+        return {
+            'points': world('co'),
+            'handles_left': world('handle_left'),
+            'handles_right': world('handle_right'),
+            'radii': (np.concatenate(columns['radius'])[:, 0] if columns['radius'] else np.zeros(0)) * radius_scale,
+            'spline_offsets': np.array(offsets, dtype=np.int64),
+            'dimensions': np.array(self.tree.dimensions[:]),
+            'resolution': curve.resolution_u,
+        }
+
+    def export_geometry(self, seed, angles):
+        # the view angles of the sample are stored with its geometry
+        filepath = self.output_filepath(seed)
+        np.savez(filepath, angles=np.asarray(angles), **self.tree_geometry())
+        return filepath
+
+    def export_graph(self, seed):
+        filepath = self.image_path + '_' + str(seed) + skeleton_graph.GRAPH_EXTENSION
+        return skeleton_graph.save_graph(filepath, skeleton_graph.tree_graph(self.tree_geometry()))
+
+    def output_filepath(self, seed, angle=None):
+        if angle is None:
+            return self.image_path + '_' + str(seed) + self.file_extension
+        return self.image_path + '_' + str(seed) + '_' + str(angle) + self.file_extension
+
+    def random_angles(self):
+        return np.random.choice(range(0, 360), self.views, replace=False)
+
+    def render_mode(self):
+        if self.export:
+            return 'export'
+        if self.geometry:
+            return 'geometry'
+        return 'silhouette' if self.render_silhouette else 'shaded'
+
+    def sample_keys(self, tree_model, angles):
+        # an exported model does not depend on the view angle
+        if self.export or self.geometry:
+            return [(None, render_cache.sample_key(tree_model, None, self.image_width, self.render_mode()))]
+        return [(a, render_cache.sample_key(tree_model, a, self.image_width, self.render_mode())) for a in angles]
+
+    def process_sample(self, tree_model, seed, angles=None):
+        """
+        Render (or export) a single tree model. With a cache, the sample is only built if any of its views is missing
+        from the cache, and rendered views are added to it.
+        """
+        # angles are drawn before the scene is built, building the scene does not touch numpy's random state
+        if angles is None and not self.export:
+            angles = self.random_angles()
+
+        keys = self.sample_keys(tree_model, angles) if self.cache else []
+        cached = bool(keys) and self.cache.get_all([(k, self.output_filepath(seed, a)) for a, k in keys], self.file_extension)
+        if cached and not self.graph:
+            return
+
+        # create a new scene according to configuration
+        self.create_new_scene(tree_model)
+
+        if self.graph:
+            # graphs are not cached, the tree is built for its graph even if its views are cached
+            self.export_graph(seed)
+            if cached:
+                return
+
+        if self.export:
+            # export tree model
+            self.export_scene(seed=seed)
+        elif self.geometry:
+            # branch geometry for silhouette_rasterizer.py, no rendering
+            self.export_geometry(seed, angles)
+        else:
+            # render a tree based on the tree model
+            self.views = len(angles)
+            self.render_scene(seed=seed, angles=angles)
+
+        for a, k in keys:
+            self.cache.put(k, self.file_extension, self.output_filepath(seed, a))
+
     def generate(self, model, number_samples, total_samples_species):
         # read tree model properties
         tree_model = utils.read_tree_model(model)
@@ -355,24 +559,75 @@ class TreeGenerator:
             """ this block is intentionally inside the loop, as we would like to overwrite any previous changes to the
             tree model """
             if self.render_silhouette:
-                skeleton_radius_damper = 0.005
-                tree_model['closeTip'] = False
-                tree_model['minRadius'] = skeleton_radius_damper * tree_model['scale']  # skeleton radius should depend on tree size
-                tree_model['scale0'] = 0.0
+                sample_plan.apply_silhouette(tree_model)
 
             """ be aware that s is always the same even for different runs which means the seed is fixed and thus the
                 trees look exactly the same """
             tree_model['seed'] = s
 
-            # create a new scene according to configuration
-            self.create_new_scene(tree_model)
+            self.process_sample(tree_model, s)
 
-            if self.export:
-                # export tree model
-                self.export_scene(seed=s)
-            else:
-                # render a tree based on the tree model
-                self.render_scene(seed=s)
+    def generate_from_plan(self, plan_path, start_row, stop_row):
+        """
+        Render the rows [start_row, stop_row) of a precomputed sample plan (see sample_plan.py). Every tree model
+        parameter and view angle comes from the plan, nothing is varied here.
+        """
+        plan = sample_plan.read_plan(plan_path)
+
+        for row in range(start_row, stop_row):
+            tree_model, seed, angles = sample_plan.plan_row(plan, row)
+            self.process_sample(tree_model, seed, angles)
+
+
+def plan_rows(rows):
+    start_row, stop_row = rows.split(':')
+    return int(start_row), int(stop_row)
+
+
+def run_worker():
+    """
+    Long-lived worker mode: jobs arrive over standard input (see worker_protocol.py) and are rendered with one
+    TreeGenerator per species, so add-on registration, module import and generator construction are paid only once.
+    """
+    generators = {}
+    caches = {}
+
+    def handle_job(job):
+        if not utils.valid_file(job['model'], 'worker', message='%s: error: no valid tree model passed: %s'):
+            raise ValueError('no valid tree model: ' + str(job['model']))
+
+        render_path = os.path.join(job['render_path'], utils.get_filename(job['model']))
+        key = (job['model'], job['random'], job['silhouette'], job['export'], job.get('geometry', False), job.get('graph', False))
+        if key not in generators:
+            generators[key] = TreeGenerator(job['start_seed'], job['random'], render_path, job['image_size'],
+                                            job['silhouette'], job['views'], job['export'], job.get('geometry', False),
+                                            job.get('graph', False))
+        tree_generator = generators[key]
+        tree_generator.set_job(job['start_seed'], render_path, job['image_size'], job['views'])
+        tree_generator.multi_view = job.get('multi_view', False)
+        tree_generator.reuse_scene = job.get('reuse_scene', False)
+
+        tree_generator.cache = None
+        if job.get('cache'):
+            if job['cache'] not in caches:
+                caches[job['cache']] = render_cache.RenderCache(job['cache'], job['cache_size'] * 2 ** 20)
+            tree_generator.cache = caches[job['cache']]
+
+        try:
+            if job.get('plan'):
+                start_row, stop_row = job['plan_rows']
+                tree_generator.generate_from_plan(job['plan'], start_row, stop_row)
+                return stop_row - start_row
+
+            # a fresh blender process starts every job with the same random state, do the same here
+            np.random.seed(0)
+            tree_generator.generate(job['model'], job['number_samples'], job['total_samples'])
+            return job['number_samples']
+        finally:
+            if tree_generator.cache is not None:
+                tree_generator.cache.flush_stats()
+
+    worker_protocol.serve(handle_job)
 
 
 def main():
@@ -393,8 +648,8 @@ def main():
             )
 
     parser = argparse.ArgumentParser(description=usage_text)
-    parser.add_argument('render_path', help='render image to a specific path')
-    parser.add_argument('model', help='tree models')
+    parser.add_argument('render_path', nargs='?', help='render image to a specific path')
+    parser.add_argument('model', nargs='?', help='tree models')
     parser.add_argument('--total-samples', default=1000, type=int)
     parser.add_argument('-n', '--number-samples', type=int, default=1, help='number of samples that should be created')
     parser.add_argument('-f', '--filename', help='prefix name for the output files')
@@ -405,9 +660,37 @@ def main():
     parser.add_argument('-S', '--render-silhouette', help='render silhouette if enabled', action='store_true')
     parser.add_argument('-R', '--random', help='enable pure randomness', action='store_true')
     parser.add_argument('-E', '--export', help='export tree model as .obj file', action='store_true')
+    parser.add_argument('-G', '--geometry', help='export the branch geometry as .npz for silhouette_rasterizer.py instead of rendering', action='store_true')
+    parser.add_argument('--graph', help='also export the branch structure as graph (.npz) with CSR adjacency', action='store_true')
+    parser.add_argument('--multi-view', help='render all views of a tree with one animation render', action='store_true')
+    parser.add_argument('--reuse-scene', help='keep lamp, camera, world and materials between samples and only swap the tree', action='store_true')
+    parser.add_argument('--worker', help='keep running and read jobs from standard input', action='store_true')
+    parser.add_argument('--plan', help='render tree models from a precomputed sample plan (.npz)')
+    parser.add_argument('--plan-rows', default=None, help='row range start:stop of the sample plan to render')
+    parser.add_argument('--cache', help='directory of the render cache, rendered samples are reused from and added to it')
+    parser.add_argument('--cache-size', type=int, default=render_cache.DEFAULT_MAX_BYTES // 2 ** 20, help='maximum size of the render cache in megabytes')
+    parser.add_argument(pixel_stream.PIXEL_FD_OPTION, type=int, help='send the rendered pixels over this inherited file descriptor instead of saving images')
 
     args = parser.parse_args(argv)
 
+    if args.worker:
+        run_worker()
+        return
+
+    if args.render_path is None or args.model is None:
+        parser.error('the following arguments are required: render_path, model')
+
+    if args.plan and not args.plan_rows:
+        parser.error('--plan requires --plan-rows start:stop')
+
+    # geometry and graph files have the same name
+    if args.geometry and args.graph:
+        parser.error('-G and --graph cannot be combined')
+
+    # streamed pixels are neither cached nor exported, graphs are still written as files
+    if args.pixel_fd is not None and (args.export or args.geometry or args.cache):
+        parser.error('--pixel-fd renders images only, without -E, -G or --cache')
+
     # check tree model
     if not utils.valid_file(args.model, parser.prog, message='%s: error: no valid tree model passed: %s'):
         return
@@ -422,8 +705,27 @@ def main():
         print('set the override flag -o if you want to proceed anyways')
         return
 
-    tree_generator = TreeGenerator(args.start_seed, args.random, os.path.join(args.render_path, filename), args.image_size, args.render_silhouette, args.number_views, args.export)
-    tree_generator.generate(args.model, args.number_samples, args.total_samples)
+    tree_generator = TreeGenerator(args.start_seed, args.random, os.path.join(args.render_path, filename), args.image_size, args.render_silhouette, args.number_views, args.export, args.geometry, args.graph)
+    tree_generator.multi_view = args.multi_view
+    tree_generator.reuse_scene = args.reuse_scene
+    if args.cache:
+        tree_generator.cache = render_cache.RenderCache(args.cache, args.cache_size * 2 ** 20)
+    if args.pixel_fd is not None:
+        tree_generator.pixel_writer = pixel_stream.PixelWriter(args.pixel_fd)
+
+    try:
+        if args.plan:
+            start_row, stop_row = plan_rows(args.plan_rows)
+            tree_generator.generate_from_plan(args.plan, start_row, stop_row)
+        else:
+            tree_generator.generate(args.model, args.number_samples, args.total_samples)
+    finally:
+        # the reader sees the end of the stream once blender closes its end of the pipe
+        if tree_generator.pixel_writer is not None:
+            tree_generator.pixel_writer.close()
+
+    if tree_generator.cache is not None:
+        print(render_cache.format_stats(tree_generator.cache.close()))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# cost model driven job scheduling
+#
+# The render time of a sample depends on its species and grows with its position within the species, because
+# complexity_variation ramps branches and segSplits from the first to the last sample. Fixed chunks of JOB_CHUNK_SIZE
+# samples therefore leave the last chunks of complex species as stragglers. The scheduler instead
+#   1. models the seconds per view of every species as linear function of the complexity (sample index / total
+#      samples), fitted to the timings of earlier runs (see record_timings) or, for species without timings,
+#      estimated from the preset's branches and segSplits,
+#   2. cuts every species into chunks of about equal expected cost, i.e. later chunks hold fewer samples,
+#   3. orders the chunks longest expected first, so the cheap ones fill the gaps at the end of the run.
+# A schedule is a list of chunks (model, start_seed, number_samples) in dispatch order. It is written next to the
+# output file, so that a resumed run uses the same jobs.
+
+import os
+import json
+import numpy as np
+
+import metrics
+import sample_plan
+import utils
+
+__author__ = "Andrin Jenal"
+__copyright__ = "Copyright 2016, ETH Zurich"
+__license__ = "GPL"
+
+JOBS_PER_WORKER = 4  # target number of jobs per worker, smaller jobs balance better but pay more start up
+MIN_CHUNK_SIZE = 50
+BASE_COST = 1.0  # cost of a sample without any branches (scene set up, rendering, writing) in preset estimate units
+
+SCHEDULE_EXTENSION = '.schedule.json'
+
+
+# Timings
+def timing_record(job, elapsed):
+    # seconds per sample of metrics.py divided by the views, rendering dominates and timings of runs with other views
+    # carry over
+    return {
+        'species': utils.get_filename(job.model),
+        'complexity': metrics.complexity(job),
+        'samples': job.number_samples,
+        'seconds_per_view': metrics.sample_seconds(job, elapsed) / max(job.views, 1),
+    }
+
+
+def read_timings(path):
+    if not path or not os.path.exists(path):
+        return []
+    with open(path) as _file:
+        return json.load(_file)
+
+
+def record_timings(path, finished_jobs):
+    """
+    Append the timings of (job, elapsed) pairs to the timings file shared by all runs.
+    """
+    records = read_timings(path) + [timing_record(job, elapsed) for job, elapsed in finished_jobs]
+    utils.atomic_write(path, lambda _file: json.dump(records, _file))
+    return len(records)
+
+
+# Cost model
+def preset_cost(model, complexity):
+    """
+    Relative cost of samples at the given complexities, from the number of stems the add-on builds: the complexity
+    targets of sample_plan ramp branches and segSplits, every stem is split segSplits times on average.
+    """
+    tree_model = utils.read_tree_model(model)
+    sample_plan.tree_model_defaults(tree_model)
+    targets = dict((param, (start, end)) for param, _, start, end in sample_plan.complexity_targets(tree_model))
+    x = np.asarray(complexity, dtype=np.float64)[:, None]
+
+    def ramp(param):
+        start, end = [np.asarray(v, dtype=np.float64) for v in targets[param]]
+        return start + x * (end - start)
+
+    branches, splits = ramp('branches'), ramp('segSplits')
+    stems = np.ones(len(x))
+    cost = np.full(len(x), BASE_COST)
+    for level in range(tree_model['levels']):
+        if level > 0:
+            stems = stems * np.trunc(branches[:, level])
+        stems = stems * (1 + splits[:, level])
+        cost += stems
+    return cost
+
+
+def fit_linear(complexity, seconds, weights):
+    # weighted least squares seconds = a + b * complexity, constant if all complexities are equal
+    complexity, seconds, weights = [np.asarray(v, dtype=np.float64) for v in (complexity, seconds, weights)]
+    x_mean = np.average(complexity, weights=weights)
+    y_mean = np.average(seconds, weights=weights)
+    variance = np.sum(weights * (complexity - x_mean) ** 2)
+    if variance < 1e-12:
+        return y_mean, 0.0
+    slope = np.sum(weights * (complexity - x_mean) * (seconds - y_mean)) / variance
+    return y_mean - slope * x_mean, slope
+
+
+class CostModel:
+
+    def __init__(self, models, timings=(), views=1):
+        self.models = dict((utils.get_filename(m), m) for m in models)
+        self.views = views
+        self.fits = {}
+        for species in self.models:
+            records = [r for r in timings if r['species'] == species]
+            if records:
+                self.fits[species] = fit_linear([r['complexity'] for r in records],
+                                                [r['seconds_per_view'] for r in records],
+                                                [r['samples'] for r in records])
+
+        # preset estimates are scaled to seconds per view by the species that have timings
+        ratios = [self.measured(s, [0.5])[0] / preset_cost(self.models[s], [0.5])[0] for s in self.fits]
+        self.preset_scale = float(np.median(ratios)) if ratios else 1.0
+
+    def measured(self, species, complexity):
+        intercept, slope = self.fits[species]
+        return np.maximum(intercept + slope * np.asarray(complexity, dtype=np.float64), 0.0)
+
+    def sample_costs(self, model, total_samples):
+        """
+        Expected seconds (or relative cost without any timings) of every sample of a species, with all its views.
+        """
+        complexity = np.arange(total_samples) / float(total_samples)
+        species = utils.get_filename(model)
+        if species in self.fits:
+            return self.measured(species, complexity) * self.views
+        return preset_cost(model, complexity) * self.preset_scale * self.views
+
+
+# Scheduling
+def cut_species(costs, target_cost, min_chunk, max_chunk):
+    """
+    Cut the samples of a species into consecutive chunks of about target_cost each, as (start, number_samples).
+    """
+    cumulative = np.cumsum(costs)
+    chunks = []
+    start = 0
+    while start < len(costs):
+        done = cumulative[start - 1] if start else 0.0
+        stop = int(np.searchsorted(cumulative, done + target_cost)) + 1
+        stop = min(max(stop, start + min_chunk), start + max_chunk, len(costs))
+        # a remainder below the minimum joins the last chunk
+        if len(costs) - stop < min_chunk and len(costs) - start <= max_chunk:
+            stop = len(costs)
+        chunks.append((start, stop - start, cumulative[stop - 1] - done))
+        start = stop
+    return chunks
+
+
+def schedule(models, total_samples, workers, cost_model, min_chunk=MIN_CHUNK_SIZE, max_chunk=None,
+             jobs_per_worker=JOBS_PER_WORKER):
+    """
+    Chunks (model, start_seed, number_samples) of all species in dispatch order, longest expected first.
+    """
+    max_chunk = max_chunk or total_samples
+    min_chunk = max(1, min(min_chunk, max_chunk))
+    costs = dict((model, cost_model.sample_costs(model, total_samples)) for model in models)
+    target_cost = sum(c.sum() for c in costs.values()) / float(max(1, workers * jobs_per_worker))
+
+    chunks = []
+    for model in models:
+        for start, number_samples, cost in cut_species(costs[model], target_cost, min_chunk, max_chunk):
+            chunks.append((cost, model, start, number_samples))
+    # stable sort, equal costs keep the species and seed order
+    chunks.sort(key=lambda c: -c[0])
+    return [(model, start, number_samples) for _, model, start, number_samples in chunks]
+
+
+def schedule_path(output_path, file_name):
+    return os.path.join(output_path, file_name + SCHEDULE_EXTENSION)
+
+
+def write_schedule(path, chunks):
+    with open(path, 'w') as _file:
+        json.dump([list(c) for c in chunks], _file, indent=1)
+    return path
+
+
+def read_schedule(path):
+    with open(path) as _file:
+        return [tuple(c) for c in json.load(_file)]
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# sharded sample archives with a random access index
+#
+# A shard directory <name>.shards holds uncompressed tar files shard_00000.tar, shard_00001.tar, ... of shard_size
+# samples each and a global index index.npz with one row per sample: file name, species, seed and view angle as in the
+# hdf5 files, plus the shard number, the offset of the member data within the shard and its length. The row number is
+# the sample id. Members are stored as rendered (.png or .obj), so
+#   - a sample is read with one seek and one read, without touching any other part of its shard,
+#   - a shard is streamed from start to end by any tar reader, e.g. by training code reading shards from object storage,
+#   - shards are written independently, e.g. one per queue worker job, and their indices merged afterwards.
+# The index can be rebuilt from the tar headers alone, see rebuild_index.
+
+import io
+import os
+import shutil
+import tarfile
+import numpy as np
+
+import file_utils
+import utils
+
+__author__ = "Andrin Jenal"
+__copyright__ = "Copyright 2016, ETH Zurich"
+__license__ = "GPL"
+
+SHARD_SIZE = 1000  # samples per shard
+SHARDS_EXTENSION = '.shards'
+SHARD_NAME = 'shard_%05d.tar'
+INDEX_NAME = 'index.npz'
+
+SHARD = 'shard'
+OFFSET = 'offset'
+LENGTH = 'length'
+SHARD_FILES = 'shard_files'
+INDEX_COLUMNS = (file_utils.FILENAME, file_utils.SPECIES, file_utils.SEED, file_utils.ANGLE, SHARD, OFFSET, LENGTH)
+INDEX_TYPES = {file_utils.FILENAME: str, file_utils.SPECIES: str, file_utils.SEED: np.int64,
+               file_utils.ANGLE: np.int32, SHARD: np.int32, OFFSET: np.int64, LENGTH: np.int64}
+
+
+def padded_size(size):
+    # tar pads the data of every member to whole blocks
+    return -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+
+def read_index(path):
+    with np.load(os.path.join(path, INDEX_NAME)) as index:
+        return dict((key, index[key]) for key in index.files)
+
+
+def write_index(path, columns, shard_files):
+    arrays = dict((column, np.asarray(columns[column], dtype=INDEX_TYPES[column])) for column in INDEX_COLUMNS)
+    arrays[SHARD_FILES] = np.asarray(shard_files, dtype=str)
+    utils.atomic_write(os.path.join(path, INDEX_NAME), lambda _file: np.savez(_file, **arrays), 'wb')
+
+
+def remove_shards(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+
+
+class ShardWriter:
+    """
+    Append files to the shards of a shard directory, a new shard is started every shard_size files. Mode 'a' keeps the
+    shards and the index of an earlier run, drops the members it wrote after its last flush and continues with a new
+    shard.
+    """
+
+    def __init__(self, path, shard_size=SHARD_SIZE, mode='w'):
+        self.path = path
+        self.filename = path
+        self.shard_size = shard_size
+        self.columns = dict((column, []) for column in INDEX_COLUMNS)
+        self.shard_files = []
+        if mode == 'a' and os.path.exists(os.path.join(path, INDEX_NAME)):
+            index = read_index(path)
+            for column in INDEX_COLUMNS:
+                self.columns[column] = index[column].tolist()
+            self.shard_files = index[SHARD_FILES].tolist()
+            self.drop_unindexed()
+        else:
+            # shards without an index hold no sample the ledger knows of
+            remove_shards(path)
+        os.makedirs(path, exist_ok=True)
+        self.tar = None
+        self.shard_samples = 0
+
+    def drop_unindexed(self):
+        # members of an interrupted run that are not in the index would be rebuilt into it by rebuild_index
+        for f in os.listdir(self.path):
+            if f.endswith('.tar') and f not in self.shard_files:
+                os.remove(os.path.join(self.path, f))
+        if not self.shard_files:
+            return
+        last_shard = len(self.shard_files) - 1
+        end = max([offset + padded_size(length) for shard, offset, length in
+                   zip(self.columns[SHARD], self.columns[OFFSET], self.columns[LENGTH]) if shard == last_shard] or [0])
+        with open(os.path.join(self.path, self.shard_files[-1]), 'r+b') as shard_file:
+            shard_file.truncate(end)
+            shard_file.seek(end)
+            # end of archive marker
+            shard_file.write(tarfile.NUL * (2 * tarfile.BLOCKSIZE))
+
+    def __len__(self):
+        return len(self.columns[file_utils.FILENAME])
+
+    def namelist(self):
+        return list(self.columns[file_utils.FILENAME])
+
+    def next_shard(self):
+        self.close_shard()
+        self.shard_files.append(SHARD_NAME % len(self.shard_files))
+        self.tar = tarfile.open(os.path.join(self.path, self.shard_files[-1]), 'w')
+        self.shard_samples = 0
+
+    def close_shard(self):
+        if self.tar is not None:
+            self.tar.close()
+            self.tar = None
+
+    def add(self, name, data):
+        """
+        Add the bytes of a sample as member name.
+        """
+        if self.tar is None or self.shard_samples >= self.shard_size:
+            self.next_shard()
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        self.tar.addfile(info, io.BytesIO(data))
+        self.shard_samples += 1
+
+        # the tar offset is behind the padded data of the new member
+        species, seed, angle = file_utils.parse_sample_name(name)
+        self.columns[file_utils.FILENAME].append(name)
+        self.columns[file_utils.SPECIES].append(species)
+        self.columns[file_utils.SEED].append(seed)
+        self.columns[file_utils.ANGLE].append(angle)
+        self.columns[SHARD].append(len(self.shard_files) - 1)
+        self.columns[OFFSET].append(self.tar.offset - padded_size(info.size))
+        self.columns[LENGTH].append(info.size)
+
+    def add_files(self, file_list, skip_existing=False):
+        # skip_existing leaves samples alone that an earlier, interrupted run already stored
+        existing = set(self.columns[file_utils.FILENAME]) if skip_existing else set()
+        for path in file_list:
+            name = utils.get_filename_with_extension(path)
+            if name not in existing:
+                with open(path, 'rb') as _file:
+                    self.add(name, _file.read())
+
+    def add_shards(self, path):
+        """
+        Append the shards of another shard directory, hard linked if possible, and their index rows.
+        """
+        index = read_index(path)
+        first_shard = len(self.shard_files)
+        self.close_shard()
+        for shard_file in index[SHARD_FILES]:
+            self.shard_files.append(SHARD_NAME % len(self.shard_files))
+            source, target = os.path.join(path, str(shard_file)), os.path.join(self.path, self.shard_files[-1])
+            try:
+                os.link(source, target)
+            except OSError:
+                shutil.copyfile(source, target)
+        for column in INDEX_COLUMNS:
+            values = index[column] + first_shard if column == SHARD else index[column]
+            self.columns[column].extend(values.tolist())
+
+    def flush(self):
+        # the samples stored so far are on disk and in the index
+        if self.tar is not None:
+            self.tar.fileobj.flush()
+        write_index(self.path, self.columns, self.shard_files)
+
+    def close(self):
+        self.close_shard()
+        write_index(self.path, self.columns, self.shard_files)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def merge_shards(writer, path_list):
+    # append the shard directories of path_list in order
+    for path in path_list:
+        writer.add_shards(path)
+
+
+class ShardReader:
+    """
+    Random access to the samples of a shard directory. Shard files are opened on first use and kept open, a reader
+    is not thread safe, every thread or data loader worker opens its own.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index = read_index(path)
+        self.open_shards = {}
+        self.ids = None
+
+    def __len__(self):
+        return len(self.index[file_utils.FILENAME])
+
+    def shard_path(self, shard):
+        return os.path.join(self.path, str(self.index[SHARD_FILES][shard]))
+
+    def sample_id(self, name):
+        if self.ids is None:
+            self.ids = dict((n, i) for i, n in enumerate(self.index[file_utils.FILENAME]))
+        return self.ids[name]
+
+    def metadata(self, sample_id):
+        return dict((column, self.index[column][sample_id].item()) for column in INDEX_COLUMNS)
+
+    def read(self, sample_id):
+        # bytes of a sample, one seek and one read
+        shard = int(self.index[SHARD][sample_id])
+        if shard not in self.open_shards:
+            self.open_shards[shard] = open(self.shard_path(shard), 'rb')
+        shard_file = self.open_shards[shard]
+        shard_file.seek(int(self.index[OFFSET][sample_id]))
+        return shard_file.read(int(self.index[LENGTH][sample_id]))
+
+    def read_images(self, sample_ids, scipy_format='L'):
+        """
+        Decoded images of sample_ids, read in shard and offset order and returned in the order given.
+        """
+        sample_ids = np.asarray(sample_ids)
+        order = np.lexsort((self.index[OFFSET][sample_ids], self.index[SHARD][sample_ids]))
+        images = [None] * len(sample_ids)
+        for i in order:
+            images[i] = io.BytesIO(self.read(sample_ids[i]))
+        return file_utils.read_images(images, scipy_format)
+
+    def stream(self, shards=None):
+        """
+        (name, bytes) of every sample, reading the shards sequentially from start to end.
+        """
+        for shard in range(len(self.index[SHARD_FILES])) if shards is None else shards:
+            for name, data in iterate_shard(self.shard_path(shard)):
+                yield name, data
+
+    def close(self):
+        for shard_file in self.open_shards.values():
+            shard_file.close()
+        self.open_shards = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def iterate_shard(shard):
+    # stream mode never seeks backwards, shard may also be an open file object such as a pipe
+    tar = tarfile.open(shard, 'r|') if isinstance(shard, str) else tarfile.open(fileobj=shard, mode='r|')
+    with tar:
+        for member in tar:
+            if member.isfile():
+                yield member.name, tar.extractfile(member).read()
+
+
+def rebuild_index(path):
+    """
+    Rebuild the index of a shard directory from the headers of its shards, e.g. after the index was lost.
+    """
+    shard_files = sorted(f for f in os.listdir(path) if f.endswith('.tar'))
+    columns = dict((column, []) for column in INDEX_COLUMNS)
+    for shard, shard_file in enumerate(shard_files):
+        with tarfile.open(os.path.join(path, shard_file), 'r') as tar:
+            for member in tar.getmembers():
+                if not member.isfile():
+                    continue
+                species, seed, angle = file_utils.parse_sample_name(member.name)
+                for column, value in zip(INDEX_COLUMNS, (member.name, species, seed, angle, shard, member.offset_data, member.size)):
+                    columns[column].append(value)
+    write_index(path, columns, shard_files)
+    return len(columns[file_utils.FILENAME])
+
+
+def summary(path):
+    index = read_index(path)
+    sizes = np.bincount(index[SHARD], minlength=len(index[SHARD_FILES]))
+    species = sorted(set(index[file_utils.SPECIES].tolist()))
+    return ('%d samples of %d species in %d shards of %d to %d samples, %.1f MB\n' %
+            (len(index[file_utils.FILENAME]), len(species), len(sizes), sizes.min() if len(sizes) else 0,
+             sizes.max() if len(sizes) else 0, index[LENGTH].sum() / 2.0 ** 20))
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='inspect a shard directory')
+    parser.add_argument('path', help='shard directory, <name>' + SHARDS_EXTENSION)
+    parser.add_argument('--rebuild', default=False, action='store_true', help='rebuild the index from the shards')
+    args = parser.parse_args()
+
+    if args.rebuild:
+        print('%d samples indexed' % rebuild_index(args.path))
+    print(summary(args.path))
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# render silhouettes from exported branch geometry with numpy only, without blender
+#
+# sapling_tree_generator.py -G exports the bezier curves of every tree (control points, handles and radii in world
+# space, the object dimensions and the view angles of the sample) as <model>_<seed>.npz. The rasterizer projects them
+# with the camera model of TreeGenerator.add_camera / camera_look_at_target / render_scene and draws every branch as
+# thick line, for all views of a whole batch of trees at once. Output files are named like the blender renders,
+# <model>_<seed>_<angle>.png, black trees on white.
+
+import os
+import argparse
+import numpy as np
+from scipy.misc import toimage
+from time import time
+
+import image_processing
+import utils
+
+__author__ = "Andrin Jenal"
+__copyright__ = "Copyright 2016, ETH Zurich"
+__license__ = "GPL"
+
+# camera of TreeGenerator.render_scene
+LENS = 50
+SENSOR_HEIGHT = 32
+PADDING = 0.8
+CAMERA_HEIGHT = 0.5
+
+DEFAULT_RESOLUTION = 12  # bezier samples per segment if the geometry does not tell
+MAX_PIECE_LENGTH = 1.0  # lines are cut into pieces of at most one pixel before they are drawn
+MIN_RADIUS = 0.5  # thinner branches are still drawn one pixel wide, as blender's anti-aliasing would
+MAX_BLOCK = 2 ** 22  # number of pixel tests per vectorized step, bounds the memory use
+
+
+# Geometry
+def read_geometry(path):
+    with np.load(path) as geometry:
+        return dict((k, geometry[k]) for k in geometry.files)
+
+
+def geometry_files(path):
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith('.npz'))
+    return [path]
+
+
+def bezier_polylines(geometry, resolution=None):
+    """
+    Sample every bezier segment of every spline. Returns polyline segments as start and end points (M, 3) with
+    their radii (M,).
+    """
+    points, left, right = geometry['points'], geometry['handles_left'], geometry['handles_right']
+    radii = geometry['radii']
+    resolution = int(resolution or geometry.get('resolution', DEFAULT_RESOLUTION))
+
+    # a bezier segment connects point i with point i + 1 of the same spline
+    last_points = geometry['spline_offsets'][1:] - 1
+    start = np.setdiff1d(np.arange(len(points) - 1), last_points)
+    stop = start + 1
+
+    t = np.linspace(0, 1, resolution + 1)[None, :, None]
+    p0, p1, p2, p3 = points[start][:, None], right[start][:, None], left[stop][:, None], points[stop][:, None]
+    curve = (1 - t) ** 3 * p0 + 3 * (1 - t) ** 2 * t * p1 + 3 * (1 - t) * t ** 2 * p2 + t ** 3 * p3
+    radius = radii[start][:, None] + (radii[stop] - radii[start])[:, None] * t[..., 0]
+
+    a, b = curve[:, :-1].reshape(-1, 3), curve[:, 1:].reshape(-1, 3)
+    return a, b, radius[:, :-1].ravel(), radius[:, 1:].ravel()
+
+
+# Camera
+def rotation_x(angle):
+    c, s = np.cos(angle), np.sin(angle)
+    return np.array([[1, 0, 0], [0, c, -s], [0, s, c]])
+
+
+def rotation_z(angle):
+    c, s = np.cos(angle), np.sin(angle)
+    return np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]])
+
+
+def camera_pose(dimensions, lens=LENS, sensor_height=SENSOR_HEIGHT, padding=PADDING):
+    """
+    Location and rotation matrix of the camera before any view rotation, see TreeGenerator.camera_look_at_target.
+    """
+    y_offset_height = -(lens * dimensions[2]) / (padding * sensor_height)
+    y_offset_width = -(lens * dimensions[0]) / (padding * sensor_height)
+    y_offset = min(y_offset_height, y_offset_width)
+    tilt = np.arctan(dimensions[2] * 0.5 / np.abs(y_offset))
+    return np.array([0, y_offset, CAMERA_HEIGHT]), rotation_x(np.radians(90) + tilt)
+
+
+def view_angles(angles):
+    # render_scene rotates the camera by every angle starting from the last view, the rotations add up
+    return np.radians(np.cumsum(angles))
+
+
+def project(points, dimensions, angles, image_size, lens=LENS, sensor_height=SENSOR_HEIGHT):
+    """
+    Project (N, 3) world points into every view. Returns pixel coordinates (V, N, 2) as (column, row) and the scale
+    (V, N) from world units to pixels at every point.
+    """
+    location, rotation = camera_pose(dimensions, lens, sensor_height)
+    # rotating the camera around the z-axis equals rotating the tree the other way
+    world_to_view = np.array([rotation.T.dot(rotation_z(-a)) for a in view_angles(angles)])
+    camera = np.einsum('vij,nj->vni', world_to_view, points) - rotation.T.dot(location)
+
+    depth = np.maximum(-camera[..., 2], 1e-6)  # the camera looks along its negative z-axis
+    scale = lens / float(sensor_height) * image_size / depth
+    pixels = np.stack([image_size * 0.5 + camera[..., 0] * scale, image_size * 0.5 - camera[..., 1] * scale], axis=-1)
+    return pixels, scale
+
+
+# Rasterization
+def split_lines(a, b, ra, rb, image_ids, max_length=MAX_PIECE_LENGTH):
+    # cut lines into pieces of at most max_length pixels, radii are interpolated
+    lengths = np.sqrt(((b - a) ** 2).sum(axis=1))
+    pieces = np.maximum(1, np.ceil(lengths / max_length)).astype(np.int64)
+    line = np.repeat(np.arange(len(a)), pieces)
+    k = np.arange(len(line)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    t0, t1 = (k / pieces[line])[:, None], ((k + 1) / pieces[line])[:, None]
+    d, dr = (b - a)[line], (rb - ra)[line][:, None]
+    return (a[line] + d * t0, a[line] + d * t1, (ra[line][:, None] + dr * t0)[:, 0], (ra[line][:, None] + dr * t1)[:, 0],
+            image_ids[line])
+
+
+def draw_pieces(masks, a, b, ra, rb, image_ids, half):
+    """
+    Set every pixel whose center lies within the interpolated radius of a piece. Pixels are tested in the
+    (2 * half + 1)^2 neighbourhood of every piece's center.
+    """
+    number_images, height, width = masks.shape
+    offsets = np.arange(-half, half + 1)
+    dx, dy = [o.ravel()[None] for o in np.meshgrid(offsets, offsets)]
+
+    center = np.floor((a + b) * 0.5).astype(np.int64)
+    px, py = center[:, :1] + dx, center[:, 1:] + dy
+
+    # distance of the pixel centers to the piece
+    ab = b - a
+    ab_length = np.maximum((ab ** 2).sum(axis=1), 1e-12)[:, None]
+    ax, ay = px + 0.5 - a[:, :1], py + 0.5 - a[:, 1:]
+    t = np.clip((ax * ab[:, :1] + ay * ab[:, 1:]) / ab_length, 0, 1)
+    distance = (ax - t * ab[:, :1]) ** 2 + (ay - t * ab[:, 1:]) ** 2
+    radius = ra[:, None] + (rb - ra)[:, None] * t
+
+    hit = (distance <= radius ** 2) & (px >= 0) & (px < width) & (py >= 0) & (py < height)
+    ids = np.broadcast_to(image_ids[:, None], hit.shape)
+    masks.reshape(-1)[(ids[hit] * height + py[hit]) * width + px[hit]] = True
+
+
+def rasterize_lines(a, b, ra, rb, image_ids, number_images, image_size):
+    """
+    Draw thick lines given in pixel coordinates into number_images boolean masks. Pieces are grouped by radius so
+    that thin branches are tested against small neighbourhoods only.
+    """
+    masks = np.zeros((number_images, image_size, image_size), dtype=bool)
+    a, b, ra, rb = [np.asarray(x, dtype=np.float32) for x in (a, b, ra, rb)]
+    a, b, ra, rb, image_ids = split_lines(a, b, np.maximum(ra, MIN_RADIUS), np.maximum(rb, MIN_RADIUS), image_ids)
+
+    # a pixel center within radius r of a piece lies at most floor(r + length / 2 + 0.5) pixels from the piece's center
+    halves = np.floor(np.maximum(ra, rb) + MAX_PIECE_LENGTH * 0.5 + 0.5).astype(np.int64)
+    for half in np.unique(halves):
+        group = np.flatnonzero(halves == half)
+        step = max(1, MAX_BLOCK // (2 * half + 1) ** 2)
+        for s in range(0, len(group), step):
+            g = group[s:s + step]
+            draw_pieces(masks, a[g], b[g], ra[g], rb[g], image_ids[g], int(half))
+    return masks
+
+
+def rasterize_batch(geometries, angles, image_size, resolution=None):
+    """
+    Silhouettes of a batch of trees, every tree seen from its views. angles holds one list of view angles (degrees)
+    per tree, all of the same length. Returns (B, V, image_size, image_size) uint8 images, black trees on white.
+    """
+    views = len(angles[0]) if len(angles) else 0
+    lines = []
+    for n, (geometry, tree_angles) in enumerate(zip(geometries, angles)):
+        a, b, ra, rb = bezier_polylines(geometry, resolution)
+        pixels, scale = project(np.concatenate([a, b]), geometry['dimensions'], tree_angles, image_size)
+        m = len(a)
+        for v in range(views):
+            lines.append((pixels[v, :m], pixels[v, m:], ra * scale[v, :m], rb * scale[v, m:],
+                          np.full(m, n * views + v, dtype=np.int64)))
+
+    if not lines:
+        return np.empty((len(geometries), views, image_size, image_size), dtype=np.uint8)
+    masks = rasterize_lines(*[np.concatenate(column) for column in zip(*lines)],
+                            number_images=len(geometries) * views, image_size=image_size)
+    return image_processing.to_silhouette(masks).reshape(len(geometries), views, image_size, image_size)
+
+
+def render_geometry_files(files, output_path, image_size, batch_size=64):
+    """
+    Render the views stored with every geometry file into output_path, named like the blender renders.
+    """
+    written = 0
+    for start in range(0, len(files), batch_size):
+        batch = files[start:start + batch_size]
+        geometries = [read_geometry(f) for f in batch]
+        angles = [g['angles'] for g in geometries]
+
+        # views of the same number are rasterized together
+        for views in sorted(set(len(a) for a in angles)):
+            group = [i for i, a in enumerate(angles) if len(a) == views]
+            images = rasterize_batch([geometries[i] for i in group], [angles[i] for i in group], image_size)
+            for i, tree_images in zip(group, images):
+                for angle, image in zip(angles[i], tree_images):
+                    toimage(image, cmin=0, cmax=255).save(os.path.join(output_path, '%s_%d.png' % (utils.get_filename(batch[i]), angle)))
+                    written += 1
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description='render silhouettes of exported tree geometry without blender')
+    parser.add_argument('geometry_path', help='geometry file (.npz) or directory of geometry files')
+    parser.add_argument('output_path', help='directory the images are written to')
+    parser.add_argument('-S', '--image-size', type=int, default=64, help='output image size')
+    parser.add_argument('-B', '--batch-size', type=int, default=64, help='number of trees rasterized at once')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.output_path):
+        os.makedirs(args.output_path)
+
+    start_time = time()
+    written = render_geometry_files(geometry_files(args.geometry_path), args.output_path, args.image_size, args.batch_size)
+    elapsed = time() - start_time
+    print('%d images written to %s in %.3f seconds (%.1f us per image)' %
+          (written, args.output_path, elapsed, 1e6 * elapsed / max(written, 1)))
+
+
+if __name__ == '__main__':
+    main()
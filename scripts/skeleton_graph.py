@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# branch structure of trees as graphs with CSR adjacency
+#
+# The nodes of a tree graph are the bezier points of its curve (see TreeGenerator.tree_geometry) with position, radius
+# and branch level. Consecutive points of a spline are connected, and the first point of a branch is connected to the
+# closest point of the splines created before it, its parent. The level of a branch is its attachment depth, i.e. the
+# trunk has level 0, branches on the trunk level 1 and so on. Adjacency is stored undirected in CSR form: the
+# neighbours of node i are indices[indptr[i]:indptr[i + 1]].
+#
+# This module only depends on numpy and is used inside blender, file_utils.py stores the graphs of many trees in hdf5.
+
+import numpy as np
+
+__author__ = "Andrin Jenal"
+__copyright__ = "Copyright 2016, ETH Zurich"
+__license__ = "GPL"
+
+POSITIONS = 'positions'
+RADII = 'radii'
+LEVELS = 'levels'
+INDPTR = 'indptr'  # start of the neighbours of every node, the end of the last node is len(indices)
+INDICES = 'indices'
+GRAPH_EXTENSION = '.npz'  # <model>_<seed>.npz, next to the rendered views of the tree
+
+ATTACHMENT_BLOCK = 256  # branches matched against the nodes at once
+
+
+# Graph construction
+def attach_branches(points, spline_offsets):
+    """
+    Parent node of the first point of every spline, -1 for the first spline. Only points of earlier splines can be
+    parents, as the add-on creates parents before their branches.
+    """
+    number_splines = len(spline_offsets) - 1
+    spline_of_node = np.repeat(np.arange(number_splines), np.diff(spline_offsets))
+    parents = np.full(number_splines, -1, dtype=np.int64)
+
+    for start in range(1, number_splines, ATTACHMENT_BLOCK):
+        splines = np.arange(start, min(start + ATTACHMENT_BLOCK, number_splines))
+        first_points = points[spline_offsets[splines]]
+        distance = ((first_points[:, None] - points[None]) ** 2).sum(axis=2)
+        distance[spline_of_node[None] >= splines[:, None]] = np.inf
+        parents[splines] = np.argmin(distance, axis=1)
+    return parents
+
+
+def csr_adjacency(number_nodes, edges):
+    """
+    Undirected CSR adjacency (indptr, indices) of (E, 2) edges, neighbours sorted by node index.
+    """
+    edges = np.concatenate([edges, edges[:, ::-1]])
+    order = np.lexsort((edges[:, 1], edges[:, 0]))
+    indptr = np.zeros(number_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(edges[:, 0], minlength=number_nodes), out=indptr[1:])
+    return indptr, edges[order, 1].astype(np.int64)
+
+
+def tree_graph(geometry):
+    """
+    Graph of the geometry of a single tree: positions (N, 3), radii (N,), levels (N,), indptr (N + 1,) and indices.
+    """
+    points = np.asarray(geometry['points'], dtype=np.float32)
+    spline_offsets = np.asarray(geometry['spline_offsets'], dtype=np.int64)
+    number_splines = len(spline_offsets) - 1
+
+    # points of a spline form a chain, the first point of a branch hangs on its parent
+    last_points = spline_offsets[1:] - 1
+    chain = np.setdiff1d(np.arange(len(points) - 1), last_points)
+    parents = attach_branches(points, spline_offsets)
+    branches = np.flatnonzero(parents >= 0)
+    edges = np.concatenate([np.stack([chain, chain + 1], axis=1),
+                            np.stack([parents[branches], spline_offsets[branches]], axis=1)]).astype(np.int64)
+
+    # attachment depth, parents always belong to earlier splines
+    spline_of_node = np.repeat(np.arange(number_splines), np.diff(spline_offsets))
+    spline_levels = np.zeros(number_splines, dtype=np.int8)
+    for s in branches:
+        spline_levels[s] = spline_levels[spline_of_node[parents[s]]] + 1
+
+    indptr, indices = csr_adjacency(len(points), edges)
+    return {
+        POSITIONS: points,
+        RADII: np.asarray(geometry['radii'], dtype=np.float32),
+        LEVELS: spline_levels[spline_of_node],
+        INDPTR: indptr,
+        INDICES: indices,
+    }
+
+
+def read_graph(path):
+    with np.load(path) as graph:
+        return dict((k, graph[k]) for k in graph.files)
+
+
+def save_graph(path, graph):
+    np.savez(path, **graph)
+    return path
@@ -0,0 +1,214 @@
+# fake of the parts of blender's bpy and mathutils modules that sapling_tree_generator.py uses
+#
+# Render calls are counted and write empty files instead of images, the sapling add-on adds a tree curve and, like
+# the real add-on, leaves an unused mesh behind. fake_modules() returns a fresh fake of both modules.
+
+import math
+import os
+import types
+import numpy as np
+
+__author__ = "Andrin Jenal"
+__copyright__ = "Copyright 2016, ETH Zurich"
+__license__ = "GPL"
+
+
+# mathutils
+class Vector:
+
+    def __init__(self, values=(0, 0, 0)):
+        self.values = np.array(values, dtype=float)
+
+    def __getitem__(self, i):
+        return self.values[i]
+
+    def __iter__(self):
+        return iter(self.values.tolist())
+
+    x = property(lambda self: self.values[0], lambda self, v: self.values.__setitem__(0, v))
+    y = property(lambda self: self.values[1], lambda self, v: self.values.__setitem__(1, v))
+    z = property(lambda self: self.values[2], lambda self, v: self.values.__setitem__(2, v))
+    xyz = property(lambda self: self, lambda self, v: setattr(self, 'values', np.array(v, dtype=float)))
+
+
+class Euler(Vector):
+
+    def rotate(self, matrix):
+        # only rotations about z occur
+        self.values[2] += math.atan2(matrix.values[1, 0], matrix.values[0, 0])
+
+
+class Matrix:
+
+    def __init__(self, values):
+        self.values = np.asarray(values, dtype=float)
+
+    @staticmethod
+    def Rotation(angle, size, axis):
+        c, s = math.cos(angle), math.sin(angle)
+        values = np.eye(4)
+        values[:2, :2] = [[c, -s], [s, c]]
+        return Matrix(values)
+
+    @staticmethod
+    def Translation(vector):
+        values = np.eye(4)
+        values[:3, 3] = list(vector)
+        return Matrix(values)
+
+    def inverted(self):
+        return Matrix(np.linalg.inv(self.values))
+
+    def __mul__(self, other):
+        if isinstance(other, Matrix):
+            return Matrix(self.values.dot(other.values))
+        return Vector(self.values.dot(np.append(other.values, 1.0))[:3])
+
+
+# bpy.data
+class DataBlock(types.SimpleNamespace):
+    pass
+
+
+class DataBlocks(list):
+
+    def __init__(self, **defaults):
+        super().__init__()
+        self.defaults = defaults
+
+    def new(self, name, *args):
+        block = DataBlock(name=name, users=0, use_fake_user=False, materials=[], **self.defaults)
+        self.append(block)
+        return block
+
+    def get(self, name):
+        return next((block for block in self if block.name == name), None)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.get(key)
+        return list.__getitem__(self, key)
+
+    def __contains__(self, key):
+        if isinstance(key, str):
+            return self.get(key) is not None
+        return any(block is key for block in self)
+
+    def remove(self, block, do_unlink=False):
+        list.remove(self, block)
+
+
+class Object:
+
+    def __init__(self, name, data, object_type):
+        self.name = name
+        self.data = data
+        self.type = object_type
+        self.location = Vector()
+        self.rotation_euler = Euler()
+        self.dimensions = Vector((2.0, 2.0, 10.0))
+        self.select = False
+        self.keyframes = []
+        if data is not None:
+            data.users += 1
+
+    def pose(self):
+        return tuple(np.round(self.location.values, 6)) + tuple(np.round(self.rotation_euler.values, 6))
+
+    def keyframe_insert(self, data_path, frame):
+        self.keyframes.append((frame, data_path, self.pose()))
+
+    def animation_data_clear(self):
+        self.keyframes = []
+
+
+class Objects(DataBlocks):
+
+    def __init__(self, bpy):
+        super().__init__()
+        self.bpy = bpy
+
+    def new(self, name, object_data=None):
+        data = self.bpy.data
+        object_type = 'CAMERA' if object_data in data.cameras else 'LAMP' if object_data in data.lamps else 'CURVE'
+        obj = Object(name, object_data, object_type)
+        self.append(obj)
+        return obj
+
+    def remove(self, obj, do_unlink=False):
+        list.remove(self, obj)
+        if obj.data is not None:
+            obj.data.users -= 1
+        if do_unlink and obj in self.bpy.context.scene.objects:
+            self.bpy.context.scene.objects.remove(obj)
+
+
+class SceneObjects(list):
+
+    def link(self, obj):
+        self.append(obj)
+
+    def unlink(self, obj):
+        self.remove(obj)
+
+
+class Render(types.SimpleNamespace):
+
+    def frame_path(self, frame=0):
+        return '%s%04d.png' % (self.filepath, frame)
+
+
+# bpy.ops
+class Operators:
+
+    def __init__(self, bpy):
+        self.bpy = bpy
+        self.calls = {'render_still': 0, 'render_animation': 0, 'tree_add': 0}
+        self.render_poses = []  # camera pose of every still render
+        self.render = types.SimpleNamespace(render=self.render_scene)
+        self.curve = types.SimpleNamespace(tree_add=self.tree_add)
+        self.object = types.SimpleNamespace(delete=self.delete)
+
+    def render_scene(self, write_still=False, animation=False):
+        scene = self.bpy.context.scene
+        if animation:
+            self.calls['render_animation'] += 1
+            paths = [scene.render.frame_path(frame=f) for f in range(scene.frame_start, scene.frame_end + 1)]
+        else:
+            self.calls['render_still'] += 1
+            self.render_poses.append(scene.camera.pose())
+            paths = [scene.render.filepath] if write_still else []
+        for path in paths:
+            open(path, 'wb').close()
+
+    def tree_add(self, **tree_model):
+        self.calls['tree_add'] += 1
+        data, scene = self.bpy.data, self.bpy.context.scene
+        curve = data.curves.new('tree.%03d' % self.calls['tree_add'])
+        scene.objects.link(data.objects.new(curve.name, curve))
+        # the add-on leaves a mesh without users behind
+        data.meshes.new('leaves.%03d' % self.calls['tree_add'])
+
+    def delete(self, use_global=False):
+        data = self.bpy.data
+        for obj in [o for o in data.objects if o.select]:
+            data.objects.remove(obj, do_unlink=True)
+
+
+def fake_modules():
+    """
+    A fresh fake bpy and mathutils, to be put into sys.modules as 'bpy' and 'mathutils'.
+    """
+    bpy = types.ModuleType('bpy')
+    bpy.data = types.SimpleNamespace(filepath=os.path.join(os.getcwd(), 'fake.blend'), objects=Objects(bpy),
+                                     curves=DataBlocks(), meshes=DataBlocks(), lamps=DataBlocks(),
+                                     cameras=DataBlocks(lens=35, sensor_height=32), materials=DataBlocks())
+    scene = types.SimpleNamespace(objects=SceneObjects(), camera=None, frame_start=1, frame_end=250,
+                                  render=Render(filepath=''), world=types.SimpleNamespace(light_settings=types.SimpleNamespace()))
+    bpy.context = types.SimpleNamespace(scene=scene)
+    bpy.ops = Operators(bpy)
+
+    mathutils = types.ModuleType('mathutils')
+    mathutils.Matrix = Matrix
+    mathutils.Vector = Vector
+    return {'bpy': bpy, 'mathutils': mathutils}
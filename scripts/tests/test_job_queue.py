@@ -0,0 +1,172 @@
+# work() processes sharing one SQLite queue, rendering with worker_stub.stub_job instead of blender
+#
+#   cd scripts && python3 -m pytest tests
+
+import os
+import sys
+import signal
+import multiprocessing
+from collections import namedtuple
+from time import time, sleep
+from zipfile import ZipFile
+
+import file_utils
+import ingest
+import job_queue
+import sample_generation
+import worker_protocol
+import worker_stub
+
+__author__ = "Andrin Jenal"
+__copyright__ = "Copyright 2016, ETH Zurich"
+__license__ = "GPL"
+
+Job = namedtuple('Job', ['index', 'model', 'start_seed', 'number_samples', 'total_samples', 'image_size', 'views',
+                         'export', 'scratch_path', 'plan', 'cache', 'render_options', 'args'])
+
+NUMBER_SAMPLES = 2
+VIEWS = 2
+
+# the runners are closures, which reach the worker processes only when these are forked
+fork = multiprocessing.get_context('fork')
+
+
+def make_jobs(output_path, number_jobs):
+    jobs = []
+    for i in range(number_jobs):
+        scratch_path = ingest.scratch_directory(output_path, i)
+        jobs.append(Job(i, 'presets/pine_template.py', i * NUMBER_SAMPLES, NUMBER_SAMPLES, 1000, 8, VIEWS, False,
+                        scratch_path, None, None, (), ['/coordinator/blender', scratch_path]))
+    return jobs
+
+
+def stub_runner(log_path, slow_jobs=None):
+    """
+    Render a job with the stub and log 'index blender scratch_path' once it started, slow_jobs maps job indices to
+    the seconds they take.
+    """
+    def run(job):
+        with open(log_path, 'a') as log:
+            log.write('%d %s %s\n' % (job.index, job.args[0], job.scratch_path))
+        ingest.write_manifest(job)
+        sleep((slow_jobs or {}).get(job.index, 0.0))
+        worker_stub.stub_job(worker_protocol.job_message(job))
+
+    return run
+
+
+def start_worker(queue_path, output_path, runner, blender, lease_seconds):
+    process = fork.Process(target=job_queue.work,
+                           args=(queue_path, output_path, 'samples', file_utils.FileType.ZIP, runner, Job, blender),
+                           kwargs=dict(threads=2, lease_seconds=lease_seconds, poll_seconds=0.05))
+    process.start()
+    return process
+
+
+def read_log(log_path):
+    if not os.path.exists(log_path):
+        return []
+    with open(log_path) as log:
+        return [line.split() for line in log.read().splitlines()]
+
+
+def queue_rows(queue_path):
+    queue = job_queue.JobQueue(queue_path)
+    try:
+        rows = queue.connection.execute('SELECT job_index, state, owner, attempts FROM jobs ORDER BY job_index').fetchall()
+    finally:
+        queue.close()
+    return rows
+
+
+def enqueue(queue_path, output_path, number_jobs):
+    queue = job_queue.JobQueue(queue_path)
+    queue.enqueue(make_jobs(output_path, number_jobs))
+    queue.close()
+
+
+def join(processes, timeout=60):
+    deadline = time() + timeout
+    for p in processes:
+        p.join(max(0.0, deadline - time()))
+    # a worker that is still running, e.g. because leases keep being stolen, would block the exit of pytest
+    for p in processes:
+        if p.is_alive():
+            os.kill(p.pid, signal.SIGKILL)
+            p.join()
+    assert [p.exitcode for p in processes] == [0] * len(processes)
+
+
+def test_every_job_claimed_once(tmpdir):
+    output_path, queue_path, log_path = str(tmpdir), str(tmpdir.join('queue.db')), str(tmpdir.join('log'))
+    enqueue(queue_path, output_path, 12)
+    runner = stub_runner(log_path)
+    join([start_worker(queue_path, output_path, runner, 'blender_%d' % n, 10.0) for n in range(3)])
+
+    rows = queue_rows(queue_path)
+    assert [(i, state, attempts) for i, state, _, attempts in rows] == [(i, job_queue.DONE, 1) for i in range(12)]
+    assert sorted(int(index) for index, _, _ in read_log(log_path)) == list(range(12))
+    # every worker runs its own blender, not the one of the coordinator
+    assert set(blender for _, blender, _ in read_log(log_path)) <= set('blender_%d' % n for n in range(3))
+
+    merged = job_queue.merge(queue_path, output_path, 'samples', file_utils.FileType.ZIP)
+    with ZipFile(merged) as merged_file:
+        names = merged_file.namelist()
+    assert len(names) == len(set(names)) == 12 * NUMBER_SAMPLES * VIEWS
+
+
+def test_expired_lease_of_killed_worker(tmpdir):
+    output_path, queue_path, log_path = str(tmpdir), str(tmpdir.join('queue.db')), str(tmpdir.join('log'))
+    enqueue(queue_path, output_path, 4)
+
+    # the first worker hangs in job 0 and is killed while it holds the lease
+    hanging = start_worker(queue_path, output_path, stub_runner(log_path, {0: 600.0}), 'blender', 1.0)
+    deadline = time() + 30
+    while not any(index == '0' for index, _, _ in read_log(log_path)):
+        assert time() < deadline
+        sleep(0.05)
+    os.kill(hanging.pid, signal.SIGKILL)
+    hanging.join()
+    dead_owner = [owner for i, _, owner, _ in queue_rows(queue_path) if i == 0][0]
+
+    join([start_worker(queue_path, output_path, stub_runner(log_path), 'blender', 1.0)])
+    rows = queue_rows(queue_path)
+    assert all(state == job_queue.DONE for _, state, _, _ in rows)
+    _, _, owner, attempts = rows[0]
+    assert attempts == 2 and owner != dead_owner
+    # job 0 was started by both workers, in scratch directories of their own
+    started = [scratch_path for index, _, scratch_path in read_log(log_path) if index == '0']
+    assert len(started) == 2 and started[0] != started[1]
+
+
+def test_heartbeat_keeps_lease_of_slow_job(tmpdir):
+    output_path, queue_path, log_path = str(tmpdir), str(tmpdir.join('queue.db')), str(tmpdir.join('log'))
+    enqueue(queue_path, output_path, 6)
+    # job 0 takes several lease times, the other worker threads run out of jobs and keep polling for it
+    runner = stub_runner(log_path, {0: 2.0})
+    join([start_worker(queue_path, output_path, runner, 'blender', 0.5) for _ in range(2)])
+
+    rows = queue_rows(queue_path)
+    assert [(state, attempts) for _, state, _, attempts in rows] == [(job_queue.DONE, 1)] * 6
+    assert sorted(int(index) for index, _, _ in read_log(log_path)) == list(range(6))
+
+
+def test_hanging_and_failing_blender_release_their_jobs(tmpdir):
+    output_path, queue_path = str(tmpdir), str(tmpdir.join('queue.db'))
+    # job 0 hangs, job 1 exits with an error; the scratch path is the last argument
+    script = 'import sys, time; time.sleep(600) if sys.argv[-1].endswith("job_00000/") else sys.exit(3)'
+    queue = job_queue.JobQueue(queue_path)
+    queue.enqueue([job._replace(args=['blender', '-c', script, job.scratch_path]) for job in make_jobs(output_path, 2)])
+    queue.close()
+
+    runner = sample_generation.timed_job_runner(0.5, set())
+    start_time = time()
+    job_queue.work(queue_path, output_path, 'samples', file_utils.FileType.ZIP, runner, Job, sys.executable, threads=2,
+                   lease_seconds=10.0, poll_seconds=0.05)
+    assert time() - start_time < 30
+
+    queue = job_queue.JobQueue(queue_path)
+    rows = queue.connection.execute('SELECT state, attempts, error FROM jobs ORDER BY job_index').fetchall()
+    queue.close()
+    assert [(state, attempts) for state, attempts, _ in rows] == [(job_queue.FAILED, job_queue.MAX_ATTEMPTS)] * 2
+    assert rows[0][2].startswith('killed after') and rows[1][2].startswith('blender exited with code 3')
@@ -0,0 +1,94 @@
+# render calls of TreeGenerator under a fake bpy, see fake_bpy.py
+
+import os
+import sys
+
+import pytest
+
+import fake_bpy
+
+__author__ = "Andrin Jenal"
+__copyright__ = "Copyright 2016, ETH Zurich"
+__license__ = "GPL"
+
+VIEWS = 4
+
+
+@pytest.fixture
+def bpy(monkeypatch):
+    modules = fake_bpy.fake_modules()
+    for name, module in modules.items():
+        monkeypatch.setitem(sys.modules, name, module)
+    import sapling_tree_generator
+    monkeypatch.setattr(sapling_tree_generator, 'bpy', modules['bpy'])
+    return modules['bpy']
+
+
+def generator(tmpdir, number_samples, multi_view=False, reuse_scene=False):
+    import sapling_tree_generator
+    model = os.path.join(os.path.dirname(sapling_tree_generator.__file__), 'presets', 'pine_template.py')
+    tree_generator = sapling_tree_generator.TreeGenerator(0, True, os.path.join(str(tmpdir), 'pine_template'), 16, True,
+                                                          VIEWS, False)
+    tree_generator.multi_view = multi_view
+    tree_generator.reuse_scene = reuse_scene
+    tree_generator.generate(model, number_samples, 1000)
+    return tree_generator
+
+
+def test_one_animation_render_per_multi_view_sample(bpy, tmpdir):
+    generator(tmpdir, 1, multi_view=True)
+    assert bpy.ops.calls['render_animation'] == 1
+    assert bpy.ops.calls['render_still'] == 0
+    # the frames are renamed to the files of the per view renders
+    files = sorted(os.listdir(str(tmpdir)))
+    assert len(files) == VIEWS
+    assert all(f.startswith('pine_template_0_') and f.endswith('.png') and '_view_' not in f for f in files)
+    assert bpy.context.scene.camera.keyframes == []
+
+
+def test_multi_view_keyframes_per_view_poses(bpy, tmpdir, monkeypatch):
+    generator(tmpdir.mkdir('still'), 3)
+    still_files = sorted(os.listdir(str(tmpdir.join('still'))))
+    still_poses = list(bpy.ops.render_poses)
+
+    # keyframed poses are recorded before the camera is cleared
+    poses = []
+    clear = fake_bpy.Object.animation_data_clear
+
+    def record_and_clear(obj):
+        poses.extend(pose for _, path, pose in obj.keyframes if path == 'location')
+        clear(obj)
+
+    monkeypatch.setattr(fake_bpy.Object, 'animation_data_clear', record_and_clear)
+    generator(tmpdir.mkdir('multi'), 3, multi_view=True)
+
+    assert bpy.ops.calls['render_still'] == 3 * VIEWS
+    assert bpy.ops.calls['render_animation'] == 3
+    assert poses == still_poses
+    assert sorted(os.listdir(str(tmpdir.join('multi')))) == still_files
+
+
+def test_reuse_scene_purges_orphans(bpy, tmpdir, monkeypatch):
+    import sapling_tree_generator
+    monkeypatch.setattr(sapling_tree_generator, 'PURGE_INTERVAL', 5)
+    meshes = []
+    tree_add = bpy.ops.curve.tree_add
+
+    def count_meshes(**tree_model):
+        meshes.append(len(bpy.data.meshes))
+        tree_add(**tree_model)
+
+    bpy.ops.curve.tree_add = count_meshes
+    generator(tmpdir, 17, reuse_scene=True)
+
+    # every sample leaves an orphaned mesh, the first one builds the scene, every 5th sample after it purges
+    assert meshes == [0, 1, 2, 3, 4, 0, 1, 2, 3, 4, 0, 1, 2, 3, 4, 0, 1]
+    assert len(bpy.data.cameras) == 1 and len(bpy.data.lamps) == 1
+    assert len(bpy.data.curves) == 1
+    assert bpy.ops.calls['render_still'] == 17 * VIEWS
+
+
+def test_scene_rebuilt_without_reuse(bpy, tmpdir):
+    generator(tmpdir, 3)
+    # a camera and a lamp per sample, clear_scene only unlinks them
+    assert len(bpy.data.cameras) == 3 and len(bpy.data.lamps) == 3
@@ -0,0 +1,138 @@
+# WorkerPool against worker_stub.py, a worker that speaks the protocol without blender
+#
+#   cd scripts && python3 -m pytest tests
+
+import io
+import os
+import sys
+import threading
+from collections import namedtuple
+
+import pytest
+
+import worker_protocol
+
+__author__ = "Andrin Jenal"
+__copyright__ = "Copyright 2016, ETH Zurich"
+__license__ = "GPL"
+
+# the fields of sample_generation.Job that job_message reads
+Job = namedtuple('Job', ['index', 'model', 'start_seed', 'number_samples', 'total_samples', 'image_size', 'views',
+                         'export', 'scratch_path', 'plan', 'cache', 'render_options'])
+
+
+def stub_command(*options):
+    return [sys.executable, os.path.join(os.path.dirname(worker_protocol.__file__), 'worker_stub.py')] + list(options)
+
+
+def make_job(tmpdir, index, number_samples=2, views=2):
+    return Job(index, 'presets/pine_template.py', index * 100, number_samples, 1000, 8, views, False,
+               os.path.join(str(tmpdir), 'job_%05d' % index, ''), None, None, ())
+
+
+def rendered(job):
+    return sorted(os.listdir(job.scratch_path)) if os.path.isdir(job.scratch_path) else []
+
+
+@pytest.fixture
+def pool():
+    pools = []
+
+    def start(*options):
+        pools.append(worker_protocol.WorkerPool(stub_command(*options)))
+        return pools[-1]
+
+    yield start
+    for p in pools:
+        p.close()
+
+
+def test_reply_framing():
+    stream = io.StringIO()
+    worker_protocol.send_reply({'id': 3, 'status': 'done', 'samples': 2}, stream)
+    line = stream.getvalue()
+    assert line.startswith('@treenet-worker ') and line.endswith('\n')
+    assert worker_protocol.decode_reply(line) == {'id': 3, 'status': 'done', 'samples': 2}
+    # anything blender prints is not a reply
+    assert worker_protocol.decode_reply("Saved: 'tree_0_12.png'\n") is None
+    assert worker_protocol.decode_reply('treenet-worker {"status": "done"}\n') is None
+
+
+def test_serve_answers_every_job():
+    jobs = io.StringIO('{"id": 0}\n\n{"id": 1}\n{"op": "quit"}\n{"id": 2}\n')
+    replies = io.StringIO()
+    worker_protocol.serve(lambda job: 1 // job['id'], jobs, replies)
+    replies = [worker_protocol.decode_reply(line) for line in replies.getvalue().splitlines()]
+    assert [r['status'] for r in replies] == ['ready', 'failed', 'done']
+    assert 'ZeroDivisionError' in replies[1]['error']
+    assert replies[2]['id'] == 1 and replies[2]['samples'] == 1
+
+
+def test_pool_skips_output_between_replies(tmpdir, pool):
+    # the stub prints a line per saved image before its reply
+    job = make_job(tmpdir, 0, number_samples=3, views=2)
+    reply = pool().run(job)
+    assert reply['status'] == 'done' and reply['samples'] == 3
+    assert len(rendered(job)) == 6
+
+
+def test_one_worker_per_thread(tmpdir, pool):
+    workers = pool()
+    jobs = [make_job(tmpdir, i) for i in range(6)]
+    used = {}
+    barrier = threading.Barrier(2)
+
+    def run(thread_jobs):
+        # both threads hold a worker at the same time
+        barrier.wait()
+        for job in thread_jobs:
+            workers.run(job)
+            used.setdefault(threading.current_thread().name, set()).add(workers.local.worker.proc.pid)
+
+    threads = [threading.Thread(target=run, args=(jobs[n::2],), name='thread-%d' % n) for n in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sorted(len(pids) for pids in used.values()) == [1, 1]
+    assert len(set.union(*used.values())) == 2
+    assert len(workers.workers) == 2
+    assert all(len(rendered(job)) == 4 for job in jobs)
+
+
+def test_worker_crash_during_job(tmpdir, pool):
+    workers = pool('--crash-after', '2')
+    job = make_job(tmpdir, 0, number_samples=5, views=1)
+    with pytest.raises(RuntimeError, match='worker exited with code 1'):
+        workers.run(job)
+    # the samples before the crash are on disk, the job is incomplete
+    assert len(rendered(job)) == 2
+    crashed = workers.local.worker
+
+    # the next job of the thread starts a new worker
+    reply = workers.run(make_job(tmpdir, 1, number_samples=2, views=1))
+    assert reply['status'] == 'done'
+    assert workers.local.worker is not crashed
+    assert len(workers.workers) == 2
+
+
+def test_clean_shutdown(tmpdir, pool):
+    workers = pool()
+    workers.run(make_job(tmpdir, 0))
+    processes = [w.proc for w in workers.workers]
+    workers.close()
+    # quit message, no signal
+    assert [p.returncode for p in processes] == [0]
+    assert workers.workers == []
+    # closing twice is harmless
+    workers.close()
+
+
+def test_close_after_crash(tmpdir, pool):
+    workers = pool('--crash-after', '0')
+    with pytest.raises(RuntimeError):
+        workers.run(make_job(tmpdir, 0))
+    processes = [w.proc for w in workers.workers]
+    workers.close()
+    assert [p.returncode for p in processes] == [1]
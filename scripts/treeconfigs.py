@@ -18,6 +18,15 @@ class IntParameter:
     def get_jitter(self):
         return self.get_random()
 
+    def get_random_batch(self, n, random_state=np.random):
+        if self.min_val == self.max_val:
+            return np.full(n, self.min_val, dtype=np.int64)
+        else:
+            return random_state.randint(self.min_val, self.max_val, size=n).astype(np.int64)
+
+    def get_jitter_batch(self, n, random_state=np.random):
+        return self.get_random_batch(n, random_state)
+
 
 class IntListParameter(IntParameter):
 
@@ -36,6 +45,12 @@ class IntListParameter(IntParameter):
             res.append(i.get_jitter())
         return tuple(res)
 
+    def get_random_batch(self, n, random_state=np.random):
+        return np.column_stack([i.get_random_batch(n, random_state) for i in self.int_params])
+
+    def get_jitter_batch(self, n, random_state=np.random):
+        return np.column_stack([i.get_jitter_batch(n, random_state) for i in self.int_params])
+
 
 class FloatParameter():
 
@@ -54,6 +69,16 @@ class FloatParameter():
             if self.min_val <= res <= self.max_val:
                 return res
 
+    def get_random_batch(self, n, random_state=np.random):
+        return self.min_val + (self.max_val - self.min_val) * random_state.random_sample(n)
+
+    def get_jitter_batch(self, n, random_state=np.random):
+        if self.min_val == 0 and self.max_val == 0:
+            return np.zeros(n)
+
+        # uniform samples never leave [min_val, max_val), the rejection loop of get_jitter always accepts the first draw
+        return random_state.uniform(self.min_val, self.max_val, size=n)
+
 
 class FloatListParameter(FloatParameter):
     
@@ -72,6 +97,12 @@ class FloatListParameter(FloatParameter):
             res.append(f.get_jitter())
         return tuple(res)
 
+    def get_random_batch(self, n, random_state=np.random):
+        return np.column_stack([f.get_random_batch(n, random_state) for f in self.float_params])
+
+    def get_jitter_batch(self, n, random_state=np.random):
+        return np.column_stack([f.get_jitter_batch(n, random_state) for f in self.float_params])
+
 
 class TreeConfig:
     
@@ -105,6 +136,16 @@ class TreeConfig:
         for param in self.tree_parameters:
             tree_model[param] = self.tree_parameters[param].get_random()
 
+    def jitter_batch(self, n, random_state=np.random):
+        """
+        Vectorized jitter for n tree models at once. Returns an ordered dict of arrays, one row per tree model:
+        shape (n,) for scalar parameters and (n, k) for list parameters. Same ranges and distribution as jitter.
+        """
+        return OrderedDict((param, self.tree_parameters[param].get_jitter_batch(n, random_state)) for param in self.tree_parameters)
+
+    def shuffle_batch(self, n, random_state=np.random):
+        return OrderedDict((param, self.tree_parameters[param].get_random_batch(n, random_state)) for param in self.tree_parameters)
+
     @staticmethod
     def variation(param_default, param_variation, nth_sample):
         """
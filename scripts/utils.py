@@ -4,6 +4,7 @@
 import os
 from os.path import basename
 import glob
+import hashlib
 import ast # abstract syntax tree module (used for string to dictionary parsing)
 
 
@@ -64,3 +65,16 @@ def get_files(path, file_format):
 
 def remove_file(file_path):
     os.remove(file_path)
+
+
+def file_checksum(file_path):
+    with open(file_path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def atomic_write(path, write_fn, mode='w'):
+    # write_fn fills a temporary file that replaces path, readers and crashes never leave a half written file
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, mode) as _file:
+        write_fn(_file)
+    os.replace(tmp_path, path)
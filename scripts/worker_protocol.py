@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# line based protocol between sample_generation.py and long-lived tree generation workers
+#
+# The driver writes one JSON job description per line to the worker's standard input. The worker answers every job
+# with a single JSON line on its standard output, prefixed with REPLY_PREFIX so that replies can be told apart from
+# anything else Blender or the add-on prints. Right after start up a worker announces itself with a 'ready' reply.
+#
+# job:   {"id": 0, "model": "presets/pine_template.py", "render_path": "samples/scratch/job_00000/",
+#         "start_seed": 0, "number_samples": 500, "total_samples": 5000, "image_size": 64, "views": 4,
+#         "silhouette": true, "random": true, "export": false, "plan": "samples/samples.plan.npz", "plan_rows": [0, 500]}
+#        plan and plan_rows are only present if the tree models come from a precomputed sample plan,
+#        cache and cache_size (megabytes) only if a render cache is used, render options such as "multi_view": true
+#        only if they are enabled
+# reply: {"id": 0, "status": "done", "samples": 500, "elapsed": 12.5}
+#        {"id": 0, "status": "failed", "error": "..."}
+# quit:  {"op": "quit"}
+
+import sys
+import json
+import shlex
+import threading
+from subprocess import Popen, PIPE
+from time import time
+
+__author__ = "Andrin Jenal"
+__copyright__ = "Copyright 2016, ETH Zurich"
+__license__ = "GPL"
+
+REPLY_PREFIX = '@treenet-worker '
+
+
+# Worker side
+def send_reply(reply, stream=None):
+    stream = stream or sys.stdout
+    stream.write(REPLY_PREFIX + json.dumps(reply) + '\n')
+    stream.flush()
+
+
+def serve(handle_job, stdin=None, stdout=None):
+    """
+    Read jobs until the input is closed or a quit message arrives. handle_job(job) renders a job and returns the
+    number of samples it produced; any exception is reported back as a failed job and the worker keeps serving.
+    """
+    stdin = stdin or sys.stdin
+    send_reply({'status': 'ready'}, stdout)
+
+    for line in stdin:
+        line = line.strip()
+        if not line:
+            continue
+
+        job = json.loads(line)
+        if job.get('op') == 'quit':
+            break
+
+        start_time = time()
+        try:
+            samples = handle_job(job)
+            send_reply({'id': job.get('id'), 'status': 'done', 'samples': samples, 'elapsed': time() - start_time}, stdout)
+        except Exception as e:
+            send_reply({'id': job.get('id'), 'status': 'failed', 'error': repr(e)}, stdout)
+
+
+# Driver side
+def decode_reply(line):
+    if not line.startswith(REPLY_PREFIX):
+        return None
+    return json.loads(line[len(REPLY_PREFIX):])
+
+
+def job_message(job):
+    message = {
+        'id': job.index,
+        'model': job.model,
+        'render_path': job.scratch_path,
+        'start_seed': job.start_seed,
+        'number_samples': job.number_samples,
+        'total_samples': job.total_samples,
+        'image_size': job.image_size,
+        'views': job.views,
+        'silhouette': True,
+        'random': True,
+        'export': job.export,
+    }
+    if job.plan:
+        plan_path, start_row, stop_row = job.plan
+        message['plan'] = plan_path
+        message['plan_rows'] = [start_row, stop_row]
+    if job.cache:
+        message['cache'], message['cache_size'] = job.cache
+    for option in job.render_options:
+        message[option] = True
+    return message
+
+
+def worker_command(blender, script='sapling_tree_generator.py'):
+    return [blender, '--background', '--python', script, '--', '--worker']
+
+
+class WorkerProcess:
+    """
+    A single long-lived worker process driven over its standard input and output.
+    """
+
+    def __init__(self, command):
+        if isinstance(command, str):
+            command = shlex.split(command)
+        self.command = command
+        self.proc = Popen(command, stdin=PIPE, stdout=PIPE, universal_newlines=True, bufsize=1)
+        reply = self.wait_for_reply()
+        if reply.get('status') != 'ready':
+            raise RuntimeError('unexpected worker greeting: ' + str(reply))
+
+    def wait_for_reply(self):
+        # skip everything the worker prints that is not part of the protocol
+        for line in self.proc.stdout:
+            reply = decode_reply(line)
+            if reply is not None:
+                return reply
+        raise RuntimeError('worker exited with code %s: %s' % (self.proc.wait(), self.command))
+
+    def run(self, message):
+        self.proc.stdin.write(json.dumps(message) + '\n')
+        self.proc.stdin.flush()
+        reply = self.wait_for_reply()
+        if reply.get('status') != 'done':
+            raise RuntimeError('job %s failed: %s' % (message.get('id'), reply.get('error')))
+        return reply
+
+    def close(self):
+        if self.proc.poll() is None:
+            try:
+                self.proc.stdin.write(json.dumps({'op': 'quit'}) + '\n')
+                self.proc.stdin.close()
+            except (BrokenPipeError, OSError):
+                pass
+        self.proc.stdout.close()
+        return self.proc.wait()
+
+
+class WorkerPool:
+    """
+    Hands out one worker process per calling thread, so that a thread pool of N threads drives N workers.
+    Workers are started lazily and stay alive until the pool is closed.
+    """
+
+    def __init__(self, command):
+        self.command = command
+        self.local = threading.local()
+        self.workers = []
+        self.lock = threading.Lock()
+
+    def worker(self):
+        worker = getattr(self.local, 'worker', None)
+        if worker is None or worker.proc.poll() is not None:
+            worker = WorkerProcess(self.command)
+            self.local.worker = worker
+            with self.lock:
+                self.workers.append(worker)
+        return worker
+
+    def run(self, job):
+        return self.worker().run(job_message(job))
+
+    def close(self):
+        with self.lock:
+            for worker in self.workers:
+                worker.close()
+            self.workers = []
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# stand-in for a blender tree generation worker, speaks the worker protocol without Blender being installed
+#
+#   python3 sample_generation.py samples/ 100 presets/ -P --worker-command "python3 worker_stub.py"
+#
+# Like blender, the stub prints a line for every saved image, which the driver has to skip. With --crash-after N it
+# exits without a reply after the first N samples of a job, as a crashing blender would.
+
+import os
+import sys
+import zlib
+import struct
+import random
+import argparse
+from time import sleep
+
+import utils
+import worker_protocol
+
+__author__ = "Andrin Jenal"
+__copyright__ = "Copyright 2016, ETH Zurich"
+__license__ = "GPL"
+
+
+def png_bytes(width, height, value=255):
+    """ minimal 8-bit grayscale png, every pixel set to value """
+    return png_rows_bytes([bytes([value]) * width] * height)
+
+
+def png_rows_bytes(rows):
+    """ 8-bit grayscale png of a list of pixel rows (bytes) """
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    width, height = len(rows[0]), len(rows)
+    raw = b''.join(b'\x00' + bytes(row) for row in rows)
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(raw)) +
+            chunk(b'IEND', b''))
+
+
+def stub_job(job, latency=0.0, crash_after=None):
+    # same file naming as TreeGenerator: <render_path><model>_<seed>_<angle>.png or <render_path><model>_<seed>.obj
+    prefix = os.path.join(job['render_path'], utils.get_filename(job['model']))
+    if not os.path.exists(job['render_path']):
+        os.makedirs(job['render_path'])
+
+    for s in range(job['start_seed'], job['start_seed'] + job['number_samples']):
+        if crash_after is not None and s - job['start_seed'] >= crash_after:
+            sys.stdout.flush()
+            os._exit(1)
+        sleep(latency)
+        if job['export']:
+            with open(prefix + '_' + str(s) + '.obj', 'w') as f:
+                f.write('o tree_%d\nv 0 0 0\nv 0 0 1\nl 1 2\n' % s)
+        else:
+            for angle in random.Random(s).sample(range(0, 360), job['views']):
+                path = prefix + '_' + str(s) + '_' + str(angle) + '.png'
+                with open(path, 'wb') as f:
+                    f.write(png_bytes(job['image_size'], job['image_size']))
+                print("Saved: '%s'" % path)
+
+    return job['number_samples']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='stand-in tree generation worker')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds spent per sample')
+    parser.add_argument('--crash-after', type=int, help='exit without a reply after this many samples of a job')
+    args, _ = parser.parse_known_args()
+
+    worker_protocol.serve(lambda job: stub_job(job, args.latency, args.crash_after))
+
+if __name__ == '__main__':
+    sys.exit(main())